@@ -16,6 +16,7 @@
 #       under the License.
 
 import os
+import json
 import logging
 from urllib import basejoin
 from cStringIO import StringIO
@@ -24,7 +25,7 @@
 from copy import copy
 
 import pkg_resources
-from tg import expose, redirect, flash, validate
+from tg import expose, redirect, flash, validate, jsonify
 from tg.decorators import without_trailing_slash
 from tg import config as tg_config
 from pylons import request, app_globals as g, tmpl_context as c
@@ -44,7 +45,7 @@
 from allura import model
 from allura.controllers import BaseController
 from allura.lib.decorators import require_post, memoize
-from allura.lib.utils import permanent_redirect, ConfigProxy
+from allura.lib.utils import permanent_redirect, ConfigProxy, JSONForExport
 from allura import model as M
 from allura.tasks import index_tasks
 
@@ -163,6 +164,19 @@ def bind_app(self, app):
             tool_name=self.tool_name,
             matching_urls=self.matching_urls)
 
+    def copy(self):
+        """Return a copy of this SitemapEntry and its children, which can be
+        changed without affecting this one.
+
+        :returns: :class:`SitemapEntry`
+
+        """
+        entry = copy(self)
+        entry.children = [ch.copy() for ch in self.children]
+        entry.matching_urls = list(self.matching_urls)
+        entry.extra_html_attrs = dict(self.extra_html_attrs)
+        return entry
+
     def extend(self, sitemap_entries):
         """Extend our children with ``sitemap_entries``.
 
@@ -739,6 +753,46 @@ def bulk_export(self, f, export_path='', with_attachments=False):
         """
         raise NotImplementedError('bulk_export')
 
+    def export_artifacts(self, f, chunks, export_path='', with_attachments=False):
+        """Write a JSON list of artifacts to ``f``, one chunk at a time.
+
+        Each chunk is prefetched with
+        :meth:`~allura.model.artifact.Artifact.prefetch_for_export`, and it and
+        its prefetched threads, posts and attachments are expunged from their
+        sessions once written, so memory use does not grow with the size of
+        the tool.
+
+        :param chunks: iterable of lists of artifacts, e.g. from
+            :func:`allura.lib.utils.chunked_find`
+        """
+        json_cls = JSONForExport if with_attachments else jsonify.GenericJSON
+        f.write('[')
+        first = True
+        for chunk in chunks:
+            if not chunk:
+                continue
+            type(chunk[0]).prefetch_for_export(chunk)
+            if with_attachments:
+                self.export_attachments(chunk, export_path)
+            for artifact in chunk:
+                if not first:
+                    f.write(',')
+                json.dump(artifact, f, cls=json_cls, indent=2)
+                first = False
+            self._expunge_exported(chunk)
+        f.write(']')
+
+    def _expunge_exported(self, objects):
+        for obj in objects:
+            # by class: session(obj) is None once obj is expunged, and the
+            # same attachment can be prefetched for several artifacts
+            session(type(obj)).expunge(obj)
+            prefetched = obj.__dict__
+            if prefetched.get('discussion_thread') is not None:
+                self._expunge_exported([prefetched['discussion_thread']])
+            self._expunge_exported(prefetched.get('_prefetched_posts', []))
+            self._expunge_exported(prefetched.get('attachments', []))
+
     def doap(self, parent):
         """App's representation for DOAP API.
 
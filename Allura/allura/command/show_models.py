@@ -16,6 +16,8 @@
 #       under the License.
 
 import sys
+import time
+import multiprocessing
 from collections import defaultdict
 from contextlib import contextmanager
 from itertools import groupby
@@ -82,6 +84,18 @@ class ReindexCommand(base.Command):
         help='Max number of artifacts to index in one Solr update command')
     parser.add_option('--ming-config', dest='ming_config', help='Path (absolute, or relative to '
                       'Allura root) to .ini file defining ming configuration.')
+    parser.add_option('--workers', dest='workers', type=int, default=0,
+                      help='Split existing artifact references into N ranges and index them in N parallel '
+                           'processes, saving progress so that an interrupted run can be resumed.  '
+                           'Only existing artifact references are indexed: they and their shortlinks are not '
+                           '(re)created, but with --refs what each one links to is updated.')
+    parser.add_option('--checkpoint', dest='checkpoint', default='reindex',
+                      help='With --workers, name to save progress under.  Re-running with the same name '
+                           'resumes where it left off.')
+    parser.add_option('--batch-size', dest='batch_size', type=int, default=1000,
+                      help='With --workers, number of artifacts to index between progress checkpoints')
+
+    checkpoint_collection = 'reindex_checkpoint'
 
     def command(self):
         from allura import model as M
@@ -102,6 +116,12 @@ def command(self):
         if not self.options.solr and not self.options.refs:
             self.options.solr = self.options.refs = True
 
+        if self.options.workers:
+            if self.options.tasks:
+                base.log.warn('--tasks is ignored with --workers')
+            self._parallel_reindex(q_project)
+            return
+
         for projects in utils.chunked_find(M.Project, q_project):
             for p in projects:
                 c.project = p
@@ -144,6 +164,119 @@ def command(self):
                     M.main_orm_session.clear()
         base.log.info('Reindex %s', 'queued' if self.options.tasks else 'done')
 
+    @property
+    def checkpoints(self):
+        from allura import model as M
+        return M.main_doc_session.db[self.checkpoint_collection]
+
+    def _parallel_reindex(self, q_project):
+        name = self.options.checkpoint
+        shards = list(self.checkpoints.find({'run': name}).sort('shard', 1))
+        if shards:
+            base.log.info('Resuming reindex %r from saved checkpoints', name)
+        else:
+            shards = self._make_shards(name, q_project)
+            if shards:
+                self.checkpoints.insert(shards)
+        procs = []
+        for shard in shards:
+            if shard['done']:
+                continue
+            p = multiprocessing.Process(target=self._reindex_shard, args=(shard,))
+            p.start()
+            procs.append(p)
+        for p in procs:
+            p.join()
+        if all(p.exitcode == 0 for p in procs):
+            self.checkpoints.remove({'run': name})
+            base.log.info('Reindex done')
+        else:
+            base.log.error('Reindex incomplete, re-run with --checkpoint=%s to resume', name)
+
+    def _make_shards(self, name, q_project):
+        '''Split the artifact reference _id space into ranges of about the same
+        number of documents, one per worker'''
+        from allura import model as M
+        project_ids = None
+        if q_project:
+            project_ids = [p._id for p in M.Project.query.find(q_project)]
+        for projects in utils.chunked_find(M.Project, q_project):
+            for p in projects:
+                if self.options.solr and not self.options.skip_solr_delete:
+                    g.solr.delete(q='project_id_s:%s' % p._id)
+        q = self._aref_query(project_ids)
+        total = M.ArtifactReference.query.find(q).count()
+        if not total:
+            return []
+        workers = min(self.options.workers, total)
+        bounds = [None]
+        for i in range(1, workers):
+            aref = M.ArtifactReference.query.find(q).sort('_id', 1).skip(total * i // workers).first()
+            bounds.append(aref._id)
+        bounds.append(None)
+        M.main_orm_session.clear()
+        return [dict(_id='%s.%s' % (name, i),
+                     run=name,
+                     shard=i,
+                     project_ids=project_ids,
+                     lower=bounds[i],
+                     upper=bounds[i + 1],
+                     last_id=None,
+                     count=0,
+                     done=False)
+                for i in range(workers)]
+
+    def _aref_query(self, project_ids):
+        if project_ids is None:
+            return {}
+        return {'artifact_reference.project_id': {'$in': project_ids}}
+
+    def _reindex_shard(self, shard):
+        from allura import model as M
+        id_range = {}
+        if shard['last_id'] is not None:
+            id_range['$gt'] = shard['last_id']
+        elif shard['lower'] is not None:
+            id_range['$gte'] = shard['lower']
+        if shard['upper'] is not None:
+            id_range['$lt'] = shard['upper']
+        count = shard['count']
+        started, indexed = time.time(), 0
+        while True:
+            q = self._aref_query(shard['project_ids'])
+            if id_range:
+                q['_id'] = id_range
+            ref_ids = [ref._id for ref in
+                       M.ArtifactReference.query.find(q).sort('_id', 1).limit(self.options.batch_size)]
+            M.main_orm_session.clear()
+            if not ref_ids:
+                break
+            chunk_started = time.time()
+            try:
+                # a shard spans projects, add_artifacts uses each artifact's own
+                with h.push_config(c, project=None, app=None):
+                    add_artifacts(ref_ids,
+                                  update_solr=self.options.solr,
+                                  update_refs=self.options.refs,
+                                  **self.add_artifact_kwargs)
+            except CompoundError, err:
+                base.log.exception('Error indexing artifacts:\n%r', err)
+                base.log.error('%s', err.format_error())
+            chunk_time = time.time() - chunk_started
+            M.main_orm_session.flush()
+            M.main_orm_session.clear()
+            M.artifact_orm_session.clear()
+            id_range.pop('$gte', None)
+            id_range['$gt'] = ref_ids[-1]
+            count += len(ref_ids)
+            indexed += len(ref_ids)
+            self.checkpoints.update({'_id': shard['_id']},
+                                    {'$set': dict(last_id=ref_ids[-1], count=count)})
+            base.log.info('Shard %s: %s artifacts, %.1f/sec, last %s took %.2fs',
+                          shard['shard'], count, indexed / (time.time() - started),
+                          len(ref_ids), chunk_time)
+        self.checkpoints.update({'_id': shard['_id']}, {'$set': dict(done=True)})
+
     @property
     def add_artifact_kwargs(self):
         if self.options.solr_hosts:
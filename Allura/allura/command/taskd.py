@@ -16,6 +16,7 @@
 #       under the License.
 
 import logging
+import multiprocessing
 import os
 import time
 import Queue
@@ -54,6 +55,74 @@ def proctitle(title):
         raise
 
 
+class TaskLimits(object):
+
+    '''Per task name concurrency caps, shared by all the worker processes
+    forked by one taskd supervisor (i.e. they are per host).
+
+    How many tasks of each name every worker is running is kept in shared
+    memory, so the supervisor can give back the slots of a worker that died
+    in the middle of a task (see :meth:`release_worker`).'''
+
+    def __init__(self, limits, workers=1):
+        self.limits = limits
+        self.task_names = sorted(limits)
+        self.workers = workers
+        # running[worker * len(task_names) + i] = tasks named task_names[i] that worker is running
+        self.running = multiprocessing.Array('i', workers * len(self.task_names))
+        # which worker this process is, set in each forked worker
+        self.worker = 0
+
+    @classmethod
+    def parse(cls, value, workers=1):
+        '''Parse a "task.name=N,other.task=M" option string'''
+        limits = {}
+        for item in value.split(','):
+            task_name, limit = item.rsplit('=', 1)
+            limits[task_name.strip()] = int(limit)
+        return cls(limits, workers)
+
+    def _index(self, task_name, worker=None):
+        i = self.task_names.index(task_name)
+        return (self.worker if worker is None else worker) * len(self.task_names) + i
+
+    def _total(self, task_name):
+        return sum(self.running[self._index(task_name, w)] for w in range(self.workers))
+
+    def full(self):
+        '''Names of tasks which are at their limit right now'''
+        with self.running.get_lock():
+            return [task_name for task_name in self.task_names
+                    if self._total(task_name) >= self.limits[task_name]]
+
+    def acquire(self, tasks):
+        '''Take a slot for each task.  Returns (accepted, rejected) lists.'''
+        accepted, rejected = [], []
+        with self.running.get_lock():
+            for task in tasks:
+                if task.task_name not in self.limits:
+                    accepted.append(task)
+                elif self._total(task.task_name) < self.limits[task.task_name]:
+                    self.running[self._index(task.task_name)] += 1
+                    accepted.append(task)
+                else:
+                    rejected.append(task)
+        return accepted, rejected
+
+    def release(self, tasks):
+        with self.running.get_lock():
+            for task in tasks:
+                if task.task_name in self.limits:
+                    i = self._index(task.task_name)
+                    self.running[i] = max(0, self.running[i] - 1)
+
+    def release_worker(self, worker):
+        '''Give back all the slots held by ``worker``, e.g. after it was killed'''
+        with self.running.get_lock():
+            for task_name in self.task_names:
+                self.running[self._index(task_name, worker)] = 0
+
+
 class TaskdCommand(base.Command):
     summary = 'Task server'
     parser = base.Command.standard_parser(verbose=True)
@@ -61,6 +130,13 @@ class TaskdCommand(base.Command):
                       help='only handle tasks of the given name(s) (can be comma-separated list)')
     parser.add_option('--nocapture', dest='nocapture', action="store_true", default=False,
                       help='Do not capture stdout and redirect it to logging.  Useful for development with pdb.set_trace()')
+    parser.add_option('--prefetch', dest='prefetch', type='int', default=1,
+                      help='claim up to N ready tasks at once and run them back to back in a single request')
+    parser.add_option('--workers', dest='workers', type='int', default=0,
+                      help='load the app once and fork N worker processes from it, restarting any that die')
+    parser.add_option('--limit', dest='limit', type='string', default=None,
+                      help='max number of tasks of a given name to run concurrently across all --workers, '
+                           'e.g. allura.tasks.repo_tasks.refresh=2 (can be comma-separated list)')
 
     def command(self):
         setproctitle('taskd')
@@ -77,7 +153,65 @@ def command(self):
         signal.siginterrupt(signal.SIGHUP, False)
         signal.siginterrupt(signal.SIGTERM, False)
         signal.siginterrupt(signal.SIGUSR1, False)
-        self.worker()
+        if self.options.limit:
+            self.limits = TaskLimits.parse(self.options.limit, max(self.options.workers, 1))
+        else:
+            self.limits = None
+        if self.options.workers > 0:
+            self.supervisor()
+        else:
+            self.worker()
+
+    def load_app(self):
+        return loadapp('config:%s#task' % self.args[0], relative_to=os.getcwd())
+
+    def supervisor(self):
+        '''Load the app, then fork the worker processes from it so they share
+        its memory (copy-on-write), and keep them running.'''
+        setproctitle('taskd supervisor')
+        wsgi_app = self.load_app()
+        workers = {}
+
+        def start_worker(slot):
+            p = multiprocessing.Process(target=self.supervised_worker,
+                                        args=(wsgi_app, slot),
+                                        name='taskd worker %s' % slot)
+            p.start()
+            workers[slot] = p
+            base.log.info('taskd supervisor pid %s started worker pid %s' % (os.getpid(), p.pid))
+
+        for slot in range(self.options.workers):
+            start_worker(slot)
+        while self.keep_running:
+            time.sleep(1)
+            self.restart_dead_workers(workers, start_worker)
+        for p in workers.values():
+            if p.is_alive():
+                os.kill(p.pid, signal.SIGTERM)
+        for p in workers.values():
+            p.join()
+        base.log.info('taskd supervisor pid %s stopping gracefully.' % os.getpid())
+
+        if self.restart_when_done:
+            base.log.info('taskd supervisor pid %s restarting itself' % os.getpid())
+            os.execv(sys.argv[0], sys.argv)
+
+    def restart_dead_workers(self, workers, start_worker):
+        for slot, p in workers.items():
+            if not p.is_alive() and self.keep_running:
+                base.log.warn('taskd worker pid %s exited with code %s; restarting it' % (p.pid, p.exitcode))
+                if self.limits:
+                    # it may have been killed without releasing its tasks' slots
+                    self.limits.release_worker(slot)
+                start_worker(slot)
+
+    def supervised_worker(self, wsgi_app, slot=0):
+        # a forked worker never re-execs itself, the supervisor restarts it
+        self.supervised = True
+        if self.limits:
+            self.limits.worker = slot
+        setproctitle('taskd worker')
+        self.worker(wsgi_app)
 
     def graceful_restart(self, signum, frame):
         base.log.info(
@@ -95,18 +229,22 @@ def graceful_stop(self, signum, frame):
     def log_current_task(self, signum, frame):
         entry = 'taskd pid %s is currently handling task %s' % (
             os.getpid(), getattr(self, 'task', None))
+        if len(getattr(self, 'tasks', [])) > 1:
+            # taskd_cleanup looks for the others here, see TaskdCleanupCommand._check_task
+            entry += ', claimed tasks: %s' % ' '.join(str(t._id) for t in self.tasks)
         status_log.info(entry)
         base.log.info(entry)
 
-    def worker(self):
+    def worker(self, wsgi_app=None):
         from allura import model as M
         name = '%s pid %s' % (os.uname()[1], os.getpid())
-        wsgi_app = loadapp('config:%s#task' %
-                           self.args[0], relative_to=os.getcwd())
+        if wsgi_app is None:
+            wsgi_app = self.load_app()
         poll_interval = asint(pylons.config.get('monq.poll_interval', 10))
         only = self.options.only
         if only:
             only = only.split(',')
+        prefetch = self.options.prefetch
 
         def start_response(status, headers, exc_info=None):
             if status != '200 OK':
@@ -117,6 +255,11 @@ def start_response(status, headers, exc_info=None):
         def waitfunc_noq():
             time.sleep(poll_interval)
 
+        signal_listener = M.TaskSignal(only=only)
+
+        def waitfunc_signal():
+            signal_listener.wait(poll_interval)
+
         def check_running(func):
             def waitfunc_checks_running():
                 if self.keep_running:
@@ -125,18 +268,47 @@ def waitfunc_checks_running():
                     raise StopIteration
             return waitfunc_checks_running
 
-        waitfunc = waitfunc_noq
+        if M.TaskSignal.enabled():
+            waitfunc = waitfunc_signal
+        else:
+            waitfunc = waitfunc_noq
         waitfunc = check_running(waitfunc)
         while self.keep_running:
             try:
                 while self.keep_running:
-                    self.task = M.MonQTask.get(
-                        process=name,
-                        waitfunc=waitfunc,
-                        only=only)
-                    if self.task:
-                        with(proctitle("taskd:{0}:{1}".format(
-                                self.task.task_name, self.task._id))):
+                    # with concurrency limits, the excluded task names must be
+                    # recomputed after each wait, so don't let get() loop
+                    exclude = self.limits.full() if self.limits else None
+                    get_waitfunc = None if self.limits else waitfunc
+                    if prefetch > 1:
+                        self.tasks = M.MonQTask.get_batch(
+                            prefetch,
+                            process=name,
+                            waitfunc=get_waitfunc,
+                            only=only,
+                            exclude=exclude)
+                    else:
+                        task = M.MonQTask.get(
+                            process=name,
+                            waitfunc=get_waitfunc,
+                            only=only,
+                            exclude=exclude)
+                        self.tasks = [task] if task else []
+                    if self.limits:
+                        self.tasks, rejected = self.limits.acquire(self.tasks)
+                        M.MonQTask.release_unstarted(rejected)
+                        if not self.tasks:
+                            if not rejected:
+                                try:
+                                    waitfunc()
+                                except StopIteration:
+                                    pass
+                            continue
+                    if self.tasks:
+                        self.task = self.tasks[0]
+                        with(proctitle("taskd:{0}:{1}{2}".format(
+                                self.task.task_name, self.task._id,
+                                '+%d' % (len(self.tasks) - 1) if len(self.tasks) > 1 else ''))):
                             # Build the (fake) request
                             request_path = '/--%s--/%s/' % (self.task.task_name,
                                                             self.task._id)
@@ -144,11 +316,21 @@ def waitfunc_checks_running():
                                               base_url=tg.config['base_url'].rstrip(
                                                   '/') + request_path,
                                               environ={'task': self.task,
+                                                       'tasks': self.tasks,
                                                        'nocapture': self.options.nocapture,
                                                        })
-                            list(wsgi_app(r.environ, start_response))
+                            try:
+                                list(wsgi_app(r.environ, start_response))
+                            finally:
+                                if self.limits:
+                                    self.limits.release(self.tasks)
                             self.task = None
+                            self.tasks = []
             except Exception as e:
+                if getattr(self, 'tasks', None):
+                    M.MonQTask.release_unstarted(self.tasks)
+                    self.task = None
+                    self.tasks = []
                 if self.keep_running:
                     base.log.exception(
                         'taskd error %s; pausing for 10s before taking more tasks' % e)
@@ -157,7 +339,7 @@ def waitfunc_checks_running():
                     base.log.exception('taskd error %s' % e)
         base.log.info('taskd pid %s stopping gracefully.' % os.getpid())
 
-        if self.restart_when_done:
+        if self.restart_when_done and not getattr(self, 'supervised', False):
             base.log.info('taskd pid %s restarting itself' % os.getpid())
             os.execv(sys.argv[0], sys.argv)
 
@@ -46,6 +46,7 @@ def command(self):
         self.taskd_status_log = self.args[1]
         self.stuck_pids = []
         self.error_tasks = []
+        self.released_tasks = []
         self.suspicious_tasks = []
 
         taskd_pids = self._taskd_pids()
@@ -70,7 +71,7 @@ def command(self):
         # find 'forsaken' tasks
         base.log.info('Seeking for forsaken busy tasks')
         tasks = [t for t in self._busy_tasks()
-                 if t not in self.error_tasks]  # skip seen tasks
+                 if t not in self.error_tasks + self.released_tasks]  # skip seen tasks
         base.log.info('Found %s busy tasks on %s' %
                       (len(tasks), self.hostname))
         for task in tasks:
@@ -78,6 +79,13 @@ def command(self):
             pid = task.process.split()[-1]
             if pid not in taskd_pids:
                 # 'forsaken' task
+                if task.time_start is None:
+                    # claimed in a batch, but never started
+                    base.log.info('Task is forsaken '
+                                  '(can\'t find taskd with given pid), but never started. '
+                                  'Setting state to \'ready\'')
+                    self._release_task(task)
+                    continue
                 base.log.info('Task is forsaken '
                               '(can\'t find taskd with given pid). '
                               'Setting state to \'error\'')
@@ -117,6 +125,13 @@ def print_summary(self):
                     '...to kill these processes run command with -k flag if you are sure they are really stuck')
         if self.error_tasks:
             base.log.info('Tasks marked as \'error\': %s' % self.error_tasks)
+        if self.released_tasks:
+            base.log.info('Unstarted tasks marked as \'ready\': %s' % self.released_tasks)
+
+    def _release_task(self, task):
+        task.state = 'ready'
+        task.process = None
+        self.released_tasks.append(task)
 
     def _busy_tasks(self, pid=None):
         regex = '^%s ' % self.hostname
@@ -169,6 +184,11 @@ def _check_task(self, taskd_pid, task):
                 taskd_pid, task)
             if line in status:
                 return 'OK'
+            # or it's waiting its turn in the batch that taskd is running
+            prefix = 'taskd pid %s is currently handling task ' % taskd_pid
+            if prefix in status and ', claimed tasks: ' in status:
+                if str(task._id) in status.split(', claimed tasks: ', 1)[1].split():
+                    return 'OK'
             base.log.info('retrying after one second')
             time.sleep(1)
         return 'FAIL'
@@ -178,8 +198,12 @@ def _kill_stuck_taskd(self, pid):
         # find all 'busy' tasks for this pid and mark them as 'error'
         tasks = list(self._busy_tasks(pid=pid))
         base.log.info('...taskd pid %s has assigned tasks: %s. '
-                      'setting state to \'error\' for all of them' % (pid, tasks))
+                      'setting state to \'error\' for all of them, '
+                      'or \'ready\' if they were never started' % (pid, tasks))
         for task in tasks:
+            if task.time_start is None:
+                self._release_task(task)
+                continue
             task.state = 'error'
             task.result = 'Taskd has stuck with this task'
             self.error_tasks.append(task)
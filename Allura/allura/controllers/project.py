@@ -362,9 +362,7 @@ def _lookup(self, name, *remainder):
             c.app = app
             if app.root:
                 return app.root, remainder
-        subproject = M.Project.query.get(
-            shortname=c.project.shortname + '/' + name,
-            neighborhood_id=c.project.neighborhood_id)
+        subproject = M.Project.by_shortname(c.project.shortname + '/' + name, c.project.neighborhood_id)
         if subproject:
             c.project = subproject
             c.app = None
@@ -23,7 +23,7 @@
 from collections import defaultdict, OrderedDict
 
 from ming.utils import LazyProperty
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 from pylons import tmpl_context as c, app_globals as g
 from pylons import request, response
 from webob import exc
@@ -834,8 +834,16 @@ def __init__(self, commit, tree, filename):
 
     @expose('jinja:allura:templates/repo/file.html')
     def index(self, **kw):
-        if kw.pop('format', 'html') == 'raw':
+        fmt = kw.pop('format', 'html')
+        if fmt == 'raw':
             return self.raw()
+        elif fmt == 'highlight':
+            # one chunk of a big file, requested by file.html after the first one is shown
+            try:
+                chunk = asint(kw.pop('chunk', 0))
+            except ValueError:
+                raise exc.HTTPBadRequest()
+            return g.highlight(self._blob.text, filename=self._blob.name, chunk=chunk)
         elif 'diff' in kw:
             tg.decorators.override_template(
                 self.index, 'jinja:allura:templates/repo/diff.html')
@@ -108,7 +108,7 @@ def _lookup(self, name, *remainder):
         c.api_token = self._authenticate_request()
         if c.api_token:
             c.user = c.api_token.user
-        neighborhood = M.Neighborhood.query.get(url_prefix='/' + name + '/')
+        neighborhood = M.Neighborhood.by_url_prefix('/' + name + '/')
         if not neighborhood:
             raise exc.HTTPNotFound, name
         return NeighborhoodRestController(neighborhood), remainder
@@ -312,7 +312,7 @@ def nbhd_lookup_first_path(nbhd, name, current_user, remainder, api=False):
     except Invalid:
         project = None
     else:
-        project = M.Project.query.get(shortname=prefix + pname, neighborhood_id=nbhd._id)
+        project = M.Project.by_shortname(prefix + pname, nbhd._id)
     if project is None and prefix == 'u/':
         # create user-project if it is missing
         user = M.User.query.get(username=pname, disabled=False, pending=False)
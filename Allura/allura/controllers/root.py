@@ -89,7 +89,7 @@ def __init__(self):
         super(RootController, self).__init__()
 
     def _lookup_neighborhood(self, url_prefix):
-        n = M.Neighborhood.query.get(url_prefix=url_prefix)
+        n = M.Neighborhood.by_url_prefix(url_prefix)
         return n
 
     def _setup_request(self):
@@ -15,6 +15,11 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+from ming.orm import ThreadLocalORMSession
+from pylons import app_globals as g
+
+from allura import model as M
+
 
 class TaskController(object):
 
@@ -23,11 +28,23 @@ class TaskController(object):
     The purpose of this app is to allow us to replicate the
     normal web request environment as closely as possible
     when executing celery tasks.
+
+    If ``environ['tasks']`` is set, all of those tasks are run back to back
+    within this one request.
     '''
 
     def __call__(self, environ, start_response):
-        task = environ['task']
+        tasks = environ.get('tasks') or [environ['task']]
         nocapture = environ['nocapture']
-        result = task(restore_context=False, nocapture=nocapture)
+        results = []
+        for i, task in enumerate(tasks):
+            if i:
+                # make sure each task sees the effects of the previous ones,
+                # and starts with an empty session like a task on its own
+                ThreadLocalORMSession.flush_all()
+                ThreadLocalORMSession.close_all()
+                g.credentials.clear()
+                task = M.MonQTask.query.get(_id=task._id)
+            results.append(task(restore_context=False, nocapture=nocapture))
         start_response('200 OK', [])
-        return [result]
+        return results
@@ -28,8 +28,10 @@
 from urllib import urlencode
 from subprocess import Popen, PIPE
 import os
+import threading
 import time
 import traceback
+from contextlib import contextmanager
 
 import activitystream
 import pkg_resources
@@ -40,10 +42,10 @@
 import pygments.util
 from tg import config
 from pylons import request
-from pylons import tmpl_context as c
+from pylons import tmpl_context as c, app_globals as g
 from paste.deploy.converters import asbool, asint, aslist
 from pypeline.markup import markup as pypeline_markup
-from ming.odm import session
+from ming.odm import session, state
 
 import ew as ew_core
 import ew.jinja2_ew as ew
@@ -55,7 +57,8 @@
 from allura.lib.markdown_extensions import (
     ForgeExtension,
     CommitMessageExtension,
-    EmojiExtension
+    EmojiExtension,
+    ForgeLinkResolvePreprocessor,
 )
 from allura.eventslistener import PostEvent
 
@@ -73,6 +76,26 @@
 
 class ForgeMarkdown(markdown.Markdown):
 
+    def __init__(self, *args, **kwargs):
+        self._in_use = 0
+        markdown.Markdown.__init__(self, *args, **kwargs)
+        self.cache_fingerprint = (kwargs.get('output_format'),) + tuple(
+            ext if isinstance(ext, basestring) else getattr(ext, 'cache_key', type(ext).__name__)
+            for ext in kwargs.get('extensions', []))
+
+    @property
+    def in_use(self):
+        '''Whether this is in the middle of a conversion, and so must not be reset'''
+        return self._in_use > 0
+
+    @contextmanager
+    def _using(self):
+        self._in_use += 1
+        try:
+            yield
+        finally:
+            self._in_use -= 1
+
     def convert(self, source, render_limit=True):
         if render_limit and len(source) > asint(config.get('markdown_render_max_length', 40000)):
             # if text is too big, markdown can take a long time to process it,
@@ -81,7 +104,8 @@ def convert(self, source, render_limit=True):
             escaped = cgi.escape(h.really_unicode(source))
             return h.html.literal(u'<pre>%s</pre>' % escaped)
         try:
-            return markdown.Markdown.convert(self, source)
+            with self._using():
+                return markdown.Markdown.convert(self, source)
         except Exception:
             log.info('Invalid markdown: %s  Upwards trace is %s', source,
                      ''.join(traceback.format_stack()), exc_info=True)
@@ -90,36 +114,112 @@ def convert(self, source, render_limit=True):
             return h.html.literal(u"""<p><strong>ERROR!</strong> The markdown supplied could not be parsed correctly.
             Did you forget to surround a code snippet with "~~~~"?</p><pre>%s</pre>""" % escaped)
 
+    @contextmanager
+    def links_resolved(self, sources):
+        '''Look up the links in all of ``sources`` at once, for the conversions
+        done with this engine inside the ``with`` block'''
+        exts = [ext for ext in self.registeredExtensions if hasattr(ext, 'preresolved_links')]
+        resolved = ForgeLinkResolvePreprocessor.resolve(sources) if exts else None
+        with self._using():
+            for ext in exts:
+                ext.preresolved_links = resolved
+            try:
+                yield
+            finally:
+                for ext in exts:
+                    ext.preresolved_links = None
+
+    def convert_many(self, sources, render_limit=True):
+        """Return a list of the html for each of ``sources``, in order, as
+        :meth:`convert` would.  Links in all of them are looked up together.
+
+        """
+        results = []
+        with self.links_resolved(sources):
+            for source in sources:
+                self.reset()
+                results.append(self.convert(source, render_limit=render_limit))
+        return results
+
+    def cached_convert_many(self, artifacts, field_name):
+        """Return a list of :meth:`cached_convert` for each of ``artifacts``.
+        Links are looked up together, for the ones not already cached.
+
+        """
+        sources = [getattr(a, field_name) for a in artifacts if self._needs_render(a, field_name)]
+        with self.links_resolved(sources):
+            return [self.cached_convert(a, field_name) for a in artifacts]
+
+    def _needs_render(self, artifact, field_name):
+        '''Whether :meth:`cached_convert` probably can't use the html cached on the artifact'''
+        cache = getattr(artifact, field_name + '_cache', None)
+        return (not cache or cache.html is None or "[[" in getattr(artifact, field_name) or
+                getattr(cache, 'fix7528', False) != M.MarkdownCache.bugfix_rev)
+
     def cached_convert(self, artifact, field_name):
         """Convert ``artifact.field_name`` markdown source to html, caching
         the result if the render time is greater than the defined threshold.
 
+        All renders are also kept in :attr:`Globals.markdown_cache` (if
+        enabled), keyed by the source's md5 and the markdown configuration,
+        project and tool, so they are shared by artifacts with the same text.
+        Text using macros is only cached there, per user, for as long as the
+        macros' ``cache_ttl`` allows.
+
         """
         source_text = getattr(artifact, field_name)
-        # Check if contents macro and never cache
-        if "[[" in source_text:
-            return self.convert(source_text)
+        has_macros = "[[" in source_text
         cache_field_name = field_name + '_cache'
         cache = getattr(artifact, cache_field_name, None)
-        if not cache:
+        if not cache and not has_macros:
             log.warn(
                 'Skipping Markdown caching - Missing cache field "%s" on class %s',
                 field_name, artifact.__class__.__name__)
-            return self.convert(source_text)
+        shared_cache = g.markdown_cache
 
-        bugfix_rev = 4  # increment this if we need all caches to invalidated (e.g. xss in markdown rendering fixed)
+        bugfix_rev = M.MarkdownCache.bugfix_rev
         md5 = None
-        # If a cached version exists and it is valid, return it.
-        if cache.md5 is not None:
-            md5 = hashlib.md5(source_text.encode('utf-8')).hexdigest()
-            if cache.md5 == md5 and getattr(cache, 'fix7528', False) == bugfix_rev:
+        if cache and cache.md5 is not None:
+            if getattr(cache, 'fix7528', False) == bugfix_rev and self._is_saved(artifact):
+                # kept up to date with the saved source, see allura.model.session._update_markdown_hashes
+                md5 = cache.md5
+            else:
+                md5 = hashlib.md5(source_text.encode('utf-8')).hexdigest()
+            # If a cached version exists and it is valid, return it.
+            if (not has_macros and cache.html is not None and cache.md5 == md5 and
+                    getattr(cache, 'fix7528', False) == bugfix_rev):
                 return h.html.literal(cache.html)
+        if shared_cache is None and (not cache or has_macros):
+            return self.convert(source_text)
+
+        if shared_cache is not None:
+            if md5 is None:
+                md5 = hashlib.md5(source_text.encode('utf-8')).hexdigest()
+            key = self._cache_key(md5, has_macros)
+            cached = shared_cache.get(key)
+            if cached is not None:
+                html, resources = cached
+                resource_manager = self._resource_manager()
+                if resource_manager is not None:
+                    for r in resources:
+                        resource_manager.register(r)
+                return h.html.literal(html)
 
         # Convert the markdown and time the result.
+        self.reset()
         start = time.time()
-        html = self.convert(source_text, render_limit=False)
+        with utils.captured_resources(self._resource_manager() if shared_cache is not None else None) as resources:
+            html = self.convert(source_text, render_limit=False)
         render_time = time.time() - start
 
+        if shared_cache is not None:
+            ttls = [ttl for ext in self.registeredExtensions for ttl in getattr(ext, 'macro_ttls', [])]
+            ttls = [ttl for ttl in ttls if ttl is not None]
+            if not ttls or min(ttls) > 0:
+                shared_cache.set(key, (html, resources), ttl=min(ttls) if ttls else None)
+        if not cache or has_macros:
+            return html
+
         threshold = config.get('markdown_cache_threshold')
         try:
             threshold = float(threshold) if threshold else None
@@ -146,6 +246,30 @@ def cached_convert(self, artifact, field_name):
                     sess.flush(artifact)
         return html
 
+    def _is_saved(self, artifact):
+        '''Whether artifact is unchanged since it was loaded or saved'''
+        try:
+            st = state(artifact)
+        except AttributeError:
+            return False
+        return st.status == st.clean
+
+    def _resource_manager(self):
+        try:
+            return g.resource_manager
+        except TypeError:
+            # no widget context outside of a request
+            return None
+
+    def _cache_key(self, md5, has_macros):
+        project = getattr(c, 'project', None)
+        app = getattr(c, 'app', None)
+        user = getattr(c, 'user', None) if has_macros else None
+        return (md5, self.cache_fingerprint, M.MarkdownCache.bugfix_rev,
+                getattr(project, '_id', None),
+                getattr(getattr(app, 'config', None), '_id', None),
+                getattr(user, '_id', None))
+
 
 class Globals(object):
 
@@ -195,6 +319,9 @@ def __init__(self):
         # Setup Pypeline
         self.pypeline_markup = pypeline_markup
 
+        # Markdown engines are reused within a thread, see _pooled_markdown
+        self._markdown_pool = threading.local()
+
         # Setup analytics
         accounts = config.get('ga.account', 'UA-XXXXX-X')
         accounts = accounts.split(' ')
@@ -394,18 +521,40 @@ def document_class(self, neighborhood):
             classes += ' mountpoint-%s' % c.app.config.options.mount_point
         return classes
 
-    def highlight(self, text, lexer=None, filename=None):
+    def highlight(self, text, lexer=None, filename=None, lazy=False, chunk=None):
+        """Return ``text`` as syntax highlighted html.
+
+        With ``lazy``, text longer than ``scm.view.highlight_chunk_lines`` only
+        has its first chunk highlighted, followed by placeholders for the rest,
+        which the page loads from ``?format=highlight&chunk=N`` (see
+        :meth:`FileBrowser.index <allura.controllers.repository.FileBrowser.index>`).
+        ``chunk`` returns just that chunk.
+
+        Results are kept in :attr:`highlight_cache` if it is enabled.
+
+        """
         if not text:
             if lexer == 'diff':
                 return h.html.literal('<em>File contents unchanged</em>')
             return h.html.literal('<em>Empty file</em>')
         # Don't use line numbers for diff highlight's, as per [#1484]
-        if lexer == 'diff':
-            formatter = pygments.formatters.HtmlFormatter(
-                cssclass='codehilite', linenos=False)
-        else:
-            formatter = self.pygments_formatter
+        is_diff = lexer == 'diff'
         text = h.really_unicode(text)
+        chunk_lines = asint(config.get('scm.view.highlight_chunk_lines', 5000)) if not is_diff else 0
+        lines = text.split('\n') if chunk_lines and (lazy or chunk is not None) else None
+        if lines is None:
+            chunk = None
+        elif chunk is not None:
+            chunk = max(int(chunk), 0)
+            text = u'\n'.join(lines[chunk * chunk_lines:(chunk + 1) * chunk_lines])
+            if not text:
+                return h.html.literal(u'')
+        elif lines and len(lines) > chunk_lines:
+            placeholders = u''.join(
+                u'<div class="highlight-chunk" data-chunk="%s"><em>Loading...</em></div>' % i
+                for i in range(1, (len(lines) - 1) // chunk_lines + 1))
+            return self.highlight(text, lexer, filename, chunk=0) + h.html.literal(placeholders)
+
         if lexer is None:
             try:
                 lexer = pygments.lexers.get_lexer_for_filename(
@@ -418,16 +567,61 @@ def highlight(self, text, lexer=None, filename=None):
         else:
             lexer = pygments.lexers.get_lexer_by_name(
                 lexer, encoding='chardet')
-        return h.html.literal(pygments.highlight(text, lexer, formatter))
+        if is_diff:
+            formatter = pygments.formatters.HtmlFormatter(
+                cssclass='codehilite', linenos=False)
+        elif chunk:
+            formatter = utils.LineAnchorCodeHtmlFormatter(
+                cssclass='codehilite', linenos='table', linenostart=chunk * chunk_lines + 1)
+        else:
+            formatter = self.pygments_formatter
+
+        cache = self.highlight_cache
+        if cache is not None:
+            # the same content is always highlighted the same way
+            key = '%s %s %s %s %s %s' % (
+                hashlib.sha1(text.encode('utf-8')).hexdigest(), lexer.name, formatter.linenos,
+                formatter.linenostart, formatter.cssclass, pygments.__version__)
+            html = cache.get(key)
+            if html is not None:
+                return h.html.literal(html.decode('utf-8'))
+        html = pygments.highlight(text, lexer, formatter)
+        if cache is not None:
+            cache.set(key, html.encode('utf-8'))
+        return h.html.literal(html)
+
+    @LazyProperty
+    def highlight_cache(self):
+        """A :class:`allura.lib.utils.FileCache` of syntax highlighted html (see
+        :meth:`highlight`) in ``highlight_cache.dir``, or None if that isn't set.
+
+        """
+        path = config.get('highlight_cache.dir')
+        if path:
+            return utils.FileCache(path, asint(config.get('highlight_cache.size', 500)) * 1024 * 1024)
+
+    def _pooled_markdown(self, key, factory):
+        '''Return a reset ForgeMarkdown for ``key`` from this thread's pool, calling
+        ``factory`` to build one if they are all busy converting (e.g. a macro
+        rendering markdown while the page containing it is rendered)'''
+        pool = self._markdown_pool.__dict__.setdefault('engines', {})
+        engines = pool.setdefault(key, [])
+        for md in engines:
+            if not md.in_use:
+                md.reset()
+                return md
+        md = factory()
+        engines.append(md)
+        return md
 
     def forge_markdown(self, **kwargs):
         '''return a markdown.Markdown object on which you can call convert'''
-        return ForgeMarkdown(
+        return self._pooled_markdown(('forge',) + tuple(sorted(kwargs.items())), lambda: ForgeMarkdown(
             # 'fenced_code'
             extensions=['fenced_code', 'codehilite',
                         ForgeExtension(
                             **kwargs), EmojiExtension(), 'tables', 'toc', 'nl2br', 'markdown_checklist.extension'],
-            output_format='html4')
+            output_format='html4'))
 
     @property
     def markdown(self):
@@ -448,13 +642,71 @@ def markdown_commit(self):
 
         """
         app = getattr(c, 'app', None)
-        return ForgeMarkdown(extensions=[CommitMessageExtension(app), EmojiExtension(), 'nl2br'],
-                             output_format='html4')
+        md = self._pooled_markdown(('commit',), lambda: ForgeMarkdown(
+            extensions=[CommitMessageExtension(app), EmojiExtension(), 'nl2br'],
+            output_format='html4'))
+        for ext in md.registeredExtensions:
+            if isinstance(ext, CommitMessageExtension):
+                ext.set_app(app)
+        return md
 
     @property
     def production_mode(self):
         return asbool(config.get('debug')) == False
 
+    @LazyProperty
+    def markdown_cache(self):
+        """A process-wide :class:`allura.lib.utils.LRUCache` of rendered markdown (see
+        :meth:`ForgeMarkdown.cached_convert`), or None if ``markdown_cache.size`` is 0.
+
+        """
+        size = asint(config.get('markdown_cache.size', 0))
+        if size:
+            return utils.LRUCache(size, ttl=asint(config.get('markdown_cache.ttl', 600)) or None)
+
+    @LazyProperty
+    def macro_cache(self):
+        """A process-wide :class:`allura.lib.utils.LRUCache` of macro output (see
+        :class:`allura.lib.macro.macro`), or None if ``macro_cache.size`` is 0.
+
+        """
+        size = asint(config.get('macro_cache.size', 0))
+        if size:
+            return utils.LRUCache(size)
+
+    @LazyProperty
+    def diff_cache(self):
+        """A process-wide :class:`allura.lib.utils.LRUCache` of the number of files changed
+        by commits, for paging through them, or None if ``scm.diff_cache.size`` is 0.
+
+        """
+        size = asint(config.get('scm.diff_cache.size', 20))
+        if size:
+            return utils.LRUCache(size)
+
+    @LazyProperty
+    def route_cache(self):
+        """A process-wide :class:`allura.lib.utils.LRUCache` of where neighborhood
+        urls lead (see :meth:`Neighborhood.by_url_prefix
+        <allura.model.neighborhood.Neighborhood.by_url_prefix>`), or None if ``route_cache.size`` is 0.
+
+        """
+        size = asint(config.get('route_cache.size', 10000))
+        if size:
+            return utils.LRUCache(size, ttl=asint(config.get('route_cache.ttl', 60)) or None)
+
+    @LazyProperty
+    def nav_cache(self):
+        """A process-wide :class:`allura.lib.utils.LRUCache` of project navbar
+        entries, and which of them users with the same roles can see (see
+        :meth:`Project.sitemap <allura.model.project.Project.sitemap>`), or None if
+        ``nav_cache.size`` is 0.
+
+        """
+        size = asint(config.get('nav_cache.size', 1000))
+        if size:
+            return utils.LRUCache(size)
+
     @LazyProperty
     def user_message_time_interval(self):
         """The rolling window of time (in seconds) during which no more than
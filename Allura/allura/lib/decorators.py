@@ -18,6 +18,7 @@
 import inspect
 import sys
 import json
+import hashlib
 import logging
 from Cookie import Cookie
 from collections import defaultdict
@@ -61,6 +62,15 @@ def myotherfunc():
             # No email notifications will be sent for c.project during this task
             pass
 
+        @task(coalesce=True)
+        def update_counts(app_config_id):
+            # Posting this again while an identical post (same args and
+            # c.project/c.app) is still waiting to run won't queue another task
+            pass
+
+    ``coalesce`` may also be a callable, which is given the task's args and
+    kwargs and returns the values that identify duplicate posts.
+
     """
     def task_(func):
         def post(*args, **kwargs):
@@ -68,9 +78,12 @@ def post(*args, **kwargs):
             project = getattr(c, 'project', None)
             cm = (h.notifications_disabled if project and
                   kw.get('notifications_disabled') else h.null_contextmanager)
+            unique_key = None
+            if kw.get('coalesce'):
+                unique_key = _coalesce_key(func, kw['coalesce'], args, kwargs)
             with cm(project):
                 from allura import model as M
-                return M.MonQTask.post(func, args, kwargs, delay=delay)
+                return M.MonQTask.post(func, args, kwargs, delay=delay, unique_key=unique_key)
         # if decorating a class, have to make it a staticmethod
         # or it gets a spurious cls argument
         func.post = staticmethod(post) if inspect.isclass(func) else post
@@ -80,6 +93,20 @@ def post(*args, **kwargs):
     return task_
 
 
+def _coalesce_key(func, coalesce, args, kwargs):
+    if callable(coalesce):
+        parts = coalesce(*args, **kwargs)
+    else:
+        app = getattr(c, 'app', None)
+        project = getattr(c, 'project', None)
+        parts = (project and project._id,
+                 app and app.config._id,
+                 args,
+                 sorted(kwargs.items()))
+    return '%s.%s:%s' % (func.__module__, func.__name__,
+                         hashlib.sha1(repr(parts)).hexdigest())
+
+
 class event_handler(object):
 
     '''Decorator to register event handlers'''
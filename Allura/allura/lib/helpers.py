@@ -70,7 +70,7 @@
 from allura.lib import utils
 
 # import to make available to templates, don't delete:
-from .security import has_access, is_allowed_by_role
+from .security import has_access, has_access_many, is_allowed_by_role
 
 
 log = logging.getLogger(__name__)
@@ -210,21 +210,20 @@ def find_user(email):
 
 def find_project(url_path):
     from allura import model as M
-    for n in M.Neighborhood.query.find():
-        if url_path.strip("/").startswith(n.url_prefix.strip("/")):
+    for url_prefix, shortname_prefix, neighborhood_id in M.Neighborhood.routes():
+        if url_path.strip("/").startswith(url_prefix.strip("/")):
             break
     else:
         return None, url_path
     # easily off-by-one, might be better to join together everything but
     # url_prefix
-    project_part = n.shortname_prefix + url_path[len(n.url_prefix):]
+    project_part = shortname_prefix + url_path[len(url_prefix):]
     parts = project_part.split('/')
     length = len(parts)
     while length:
         shortname = '/'.join(parts[:length])
-        p = M.Project.query.get(shortname=shortname, deleted=False,
-                                neighborhood_id=n._id)
-        if p:
+        p = M.Project.by_shortname(shortname, neighborhood_id)
+        if p and not p.deleted:
             return p, parts[length:]
         length -= 1
     return None, url_path.split('/')
@@ -28,11 +28,13 @@
 import pymongo
 from pylons import tmpl_context as c, app_globals as g
 from pylons import request
+from tg import config
 from paste.deploy.converters import asint
 from BeautifulSoup import BeautifulSoup
 
 from . import helpers as h
 from . import security
+from . import utils
 
 log = logging.getLogger(__name__)
 
@@ -41,11 +43,20 @@
 
 class macro(object):
 
-    def __init__(self, context=None):
+    '''
+    Register a macro.
+
+    :param context: only allow the macro in this markdown macro context (e.g. ``neighborhood-wiki``)
+    :param cache_ttl: seconds for which the macro's output may be reused for the same arguments, user, project and
+                      tool (overridden by ``macro_cache_ttl.<name>`` in the config).  By default it is never reused.
+    '''
+
+    def __init__(self, context=None, cache_ttl=0):
         self._context = context
+        self._cache_ttl = cache_ttl
 
     def __call__(self, func):
-        _macros[func.__name__] = (func, self._context)
+        _macros[func.__name__] = (func, self._context, self._cache_ttl)
         return func
 
 
@@ -54,13 +65,30 @@ class parse(object):
     def __init__(self, context):
         self._context = context
 
+    def _split(self, s):
+        return [unicode(x, 'utf-8') for x in shlex.split(s.encode('utf-8'))]
+
+    def cache_ttl(self, s):
+        '''
+        Seconds for which the output of ``[[s]]`` may be cached, 0 if it must
+        not be cached, or None if it doesn't depend on anything but s.
+        '''
+        if s.startswith('quote '):
+            return None
+        try:
+            parts = self._split(s)
+        except ValueError:
+            return None
+        if not parts or not self._lookup_macro(parts[0]):
+            return None
+        return asint(config.get('macro_cache_ttl.' + parts[0], _macros[parts[0]][2]))
+
     def __call__(self, s):
         try:
             if s.startswith('quote '):
                 return '[[' + s[len('quote '):] + ']]'
             try:
-                parts = [unicode(x, 'utf-8')
-                         for x in shlex.split(s.encode('utf-8'))]
+                parts = self._split(s)
                 if not parts:
                     return '[[' + s + ']]'
                 macro = self._lookup_macro(parts[0])
@@ -70,6 +98,9 @@ def __call__(self, s):
                     if '=' not in t:
                         return '[-%s: missing =-]' % ' '.join(parts)
                 args = dict(t.split('=', 1) for t in parts[1:])
+                ttl = self.cache_ttl(s)
+                if ttl and g.macro_cache is not None:
+                    return self._cached_call(macro, args, s, ttl)
                 response = macro(**h.encode_keys(args))
                 return response
             except (ValueError, TypeError) as ex:
@@ -82,15 +113,35 @@ def __call__(self, s):
             raise
             return '[[Error parsing %s: %s]]' % (s, ex)
 
+    def _cached_call(self, macro, args, s, ttl):
+        '''Call macro, reusing its output (and re-registering any resources it needs) from :attr:`g.macro_cache`'''
+        project = getattr(c, 'project', None)
+        app = getattr(c, 'app', None)
+        user = getattr(c, 'user', None)
+        key = (s, self._context,
+               getattr(project, '_id', None),
+               getattr(getattr(app, 'config', None), '_id', None),
+               getattr(user, '_id', None))
+        cached = g.macro_cache.get(key)
+        if cached is not None:
+            response, resources = cached
+            for r in resources:
+                g.resource_manager.register(r)
+            return response
+        with utils.captured_resources(g.resource_manager) as resources:
+            response = macro(**h.encode_keys(args))
+        g.macro_cache.set(key, (response, resources), ttl=ttl)
+        return response
+
     def _lookup_macro(self, s):
-        macro, context = _macros.get(s, (None, None))
+        macro, context, cache_ttl = _macros.get(s, (None, None, None))
         if context is None or context == self._context:
             return macro
         else:
             return None
 
 
-@macro('neighborhood-wiki')
+@macro('neighborhood-wiki', cache_ttl=60)
 def neighborhood_feeds(tool_name, max_number=5, sort='pubdate'):
     from allura import model as M
     from allura.lib.widgets.macros import NeighborhoodFeeds
@@ -112,7 +163,7 @@ def neighborhood_feeds(tool_name, max_number=5, sort='pubdate'):
     return response
 
 
-@macro('neighborhood-wiki')
+@macro('neighborhood-wiki', cache_ttl=60)
 def neighborhood_blog_posts(max_number=5, sort='timestamp', summary=False):
     from forgeblog import model as BM
     from allura.lib.widgets.macros import BlogPosts
@@ -136,7 +187,7 @@ def neighborhood_blog_posts(max_number=5, sort='timestamp', summary=False):
     return response
 
 
-@macro()
+@macro(cache_ttl=60)
 def project_blog_posts(max_number=5, sort='timestamp', summary=False, mount_point=None):
     from forgeblog import model as BM
     from allura.lib.widgets.macros import BlogPosts
@@ -265,7 +316,7 @@ def get_projects_for_macro(
     return response
 
 
-@macro('neighborhood-wiki')
+@macro('neighborhood-wiki', cache_ttl=60)
 def projects(category=None, sort='last_updated',
              show_total=False, limit=100, labels='', award='', private=False,
              columns=1, show_proj_icon=True, show_download_button=False, show_awards_banner=True,
@@ -280,7 +331,7 @@ def projects(category=None, sort='last_updated',
         initial_q=initial_q)
 
 
-@macro('userproject-wiki')
+@macro('userproject-wiki', cache_ttl=60)
 def my_projects(category=None, sort='last_updated',
                 show_total=False, limit=100, labels='', award='', private=False,
                 columns=1, show_proj_icon=True, show_download_button=False, show_awards_banner=True,
@@ -304,7 +355,7 @@ def my_projects(category=None, sort='last_updated',
         initial_q=initial_q)
 
 
-@macro()
+@macro(cache_ttl=60)
 def project_screenshots():
     from allura.lib.widgets.project_list import ProjectScreenshots
     ps = ProjectScreenshots()
@@ -313,7 +364,7 @@ def project_screenshots():
     return response
 
 
-@macro()
+@macro(cache_ttl=3600)
 def gittip_button(username):
     from allura.lib.widgets.macros import GittipButton
     button = GittipButton(username=username)
@@ -372,7 +423,7 @@ def include_file(repo, path=None, rev=None, **kw):
     return sb.display(text=text, attrs=kw)
 
 
-@macro()
+@macro(cache_ttl=60)
 def include(ref=None, repo=None, **kw):
     from allura import model as M
     from allura.lib.widgets.macros import Include
@@ -410,7 +461,7 @@ def img(src=None, **kw):
         return '<img src="./attachment/%s" %s/>' % (src, ' '.join(attrs))
 
 
-@macro()
+@macro(cache_ttl=60)
 def project_admins():
     admins = c.project.users_with_role('Admin')
     from allura.lib.widgets.macros import ProjectAdmins
@@ -424,7 +475,7 @@ def project_admins():
     return response
 
 
-@macro()
+@macro(cache_ttl=60)
 def members(limit=20):
     from allura.lib.widgets.macros import Members
     limit = asint(limit)
@@ -444,7 +495,7 @@ def members(limit=20):
     return response
 
 
-@macro()
+@macro(cache_ttl=3600)
 def embed(url=None):
     consumer = oembed.OEmbedConsumer()
     endpoint = oembed.OEmbedEndpoint('http://www.youtube.com/oembed',
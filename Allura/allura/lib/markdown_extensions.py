@@ -22,6 +22,7 @@
 from urlparse import urljoin
 
 from tg import config
+from pylons import tmpl_context as c
 from bs4 import BeautifulSoup
 import html5lib
 import html5lib.serializer
@@ -72,12 +73,14 @@ def __init__(self, app):
         markdown.Extension.__init__(self)
         self.app = app
         self._use_wiki = False
+        self.preresolved_links = None
 
     def extendMarkdown(self, md, md_globals):
         md.registerExtension(self)
         # remove default preprocessors and add our own
         md.preprocessors.clear()
-        md.preprocessors['trac_refs'] = PatternReplacingProcessor(TracRef1(), TracRef2(), TracRef3(self.app))
+        self.trac_ref3 = TracRef3(self.app)
+        md.preprocessors['trac_refs'] = PatternReplacingProcessor(TracRef1(), TracRef2(), self.trac_ref3)
         # remove all inlinepattern processors except short refs and links
         md.inlinePatterns.clear()
         md.inlinePatterns["link"] = markdown.inlinepatterns.LinkPattern(markdown.inlinepatterns.LINK_RE, md)
@@ -97,6 +100,17 @@ def extendMarkdown(self, md, md_globals):
     def reset(self):
         self.forge_link_tree_processor.reset()
 
+    def set_app(self, app):
+        '''Link refs to ``app`` from now on, so the extension can be reused'''
+        self.app = self.trac_ref3.app = app
+
+    def lookup_link(self, link):
+        '''Return the Shortlink for link and its ArtifactReference'''
+        if self.preresolved_links and link in self.preresolved_links:
+            return self.preresolved_links[link]
+        shortlink = M.Shortlink.lookup(link)
+        return shortlink, shortlink.ref if shortlink else None
+
 
 class Pattern(object):
 
@@ -245,6 +259,16 @@ def __init__(self, wiki=False, email=False, macro_context=None):
         self._use_wiki = wiki
         self._is_email = email
         self._macro_context = macro_context
+        self.resolved_links = {}
+        self.resolved_links_context = None
+        self.preresolved_links = None
+        self.macro_ttls = []
+
+    @property
+    def cache_key(self):
+        '''Distinguishes the html cached by :meth:`ForgeMarkdown.cached_convert` for differently configured
+        instances'''
+        return 'forge', self._use_wiki, self._is_email, self._macro_context
 
     def extendMarkdown(self, md, md_globals):
         md.registerExtension(self)
@@ -253,6 +277,7 @@ def extendMarkdown(self, md, md_globals):
         md.preprocessors['html_block'].markdown_in_raw = True
         md.preprocessors.add('plain_text_block', PlainTextPreprocessor(md), "_begin")
         md.preprocessors.add('macro_include', ForgeMacroIncludePreprocessor(md), '_end')
+        md.preprocessors.add('resolve_links', ForgeLinkResolvePreprocessor(md, ext=self), '_end')
         # this has to be before the 'escape' processor, otherwise weird
         # placeholders are inserted for escaped chars within urls, and then the
         # autolink can't match the whole url
@@ -274,6 +299,23 @@ def extendMarkdown(self, md, md_globals):
 
     def reset(self):
         self.forge_link_tree_processor.reset()
+        self.resolved_links = {}
+        self.resolved_links_context = None
+        self.macro_ttls = []
+
+    def link_context(self):
+        '''Shortlinks resolve relative to the current project and tool'''
+        project = getattr(c, 'project', None)
+        app = getattr(c, 'app', None)
+        return getattr(project, '_id', None), getattr(getattr(app, 'config', None), '_id', None)
+
+    def lookup_link(self, link):
+        '''Return the Shortlink for link and its ArtifactReference, from those resolved by
+        :class:`ForgeLinkResolvePreprocessor` when possible'''
+        if link in self.resolved_links and self.resolved_links_context == self.link_context():
+            return self.resolved_links[link]
+        shortlink = M.Shortlink.lookup(link)
+        return shortlink, shortlink.ref if shortlink else None
 
 
 class EmojiExtension(markdown.Extension):
@@ -348,10 +390,10 @@ def _expand_alink(self, link, is_link_with_brackets):
         if is_link_with_brackets:
             classes = 'alink'
         href = link
-        shortlink = M.Shortlink.lookup(link)
-        if shortlink and shortlink.ref and not getattr(shortlink.ref.artifact, 'deleted', False):
+        shortlink, ref = self.ext.lookup_link(link)
+        if shortlink and ref and not getattr(ref.artifact, 'deleted', False):
             href = shortlink.url
-            if getattr(shortlink.ref.artifact, 'is_closed', False):
+            if getattr(ref.artifact, 'is_closed', False):
                 classes += ' strikethrough'
             self.ext.forge_link_tree_processor.alinks.append(shortlink)
         elif is_link_with_brackets:
@@ -359,10 +401,10 @@ def _expand_alink(self, link, is_link_with_brackets):
             classes += ' notfound'
         attach_link = link.split('/attachment/')
         if len(attach_link) == 2 and self.ext._use_wiki:
-            shortlink = M.Shortlink.lookup(attach_link[0])
+            shortlink, ref = self.ext.lookup_link(attach_link[0])
             if shortlink:
                 attach_status = ' notfound'
-                for attach in shortlink.ref.artifact.attachments:
+                for attach in ref.artifact.attachments:
                     if attach.filename == attach_link[1]:
                         attach_status = ''
                 classes += attach_status
@@ -408,6 +450,7 @@ def __init__(self, *args, **kwargs):
         markdown.inlinepatterns.Pattern.__init__(self, *args, **kwargs)
 
     def handleMatch(self, m):
+        self.ext.macro_ttls.append(self.macro.cache_ttl(m.group(2)))
         html = self.macro(m.group(2))
         placeholder = self.markdown.htmlStash.store(html)
         return placeholder
@@ -532,6 +575,50 @@ def handleMatch(self, mo):
         return result
 
 
+class ForgeLinkResolvePreprocessor(markdown.preprocessors.Preprocessor):
+
+    '''Find everything that :class:`ForgeLinkPattern` may look up as a shortlink, and resolve them all at once.
+
+    This uses a single :meth:`Shortlink.from_links <allura.model.index.Shortlink.from_links>` call and one artifact
+    query per class, instead of several queries per link.  Anything missed here is still looked up one at a time.
+    Links already resolved for a whole batch of sources (see :meth:`ForgeMarkdown.convert_many
+    <allura.lib.app_globals.ForgeMarkdown.convert_many>`) are not looked up again.
+    '''
+    pattern = re.compile(r'\[([^\[\]]+)\](?:\(\s*<?([^)\s>]+))?')
+
+    def __init__(self, md, ext):
+        markdown.preprocessors.Preprocessor.__init__(self, md)
+        self.ext = ext
+
+    def run(self, lines):
+        if self.ext.preresolved_links is not None:
+            self.ext.resolved_links = self.ext.preresolved_links
+        else:
+            self.ext.resolved_links = self.resolve(['\n'.join(lines)])
+        self.ext.resolved_links_context = self.ext.link_context()
+        return lines
+
+    @classmethod
+    def resolve(cls, sources):
+        '''Return a dict of (Shortlink, ArtifactReference) for each link found in the markdown ``sources``'''
+        links = set()
+        for source in sources:
+            for m in cls.pattern.finditer(source):
+                for link in m.groups():
+                    if link and link.strip() and link != 'TOC':
+                        links.add(link)
+                        links.add(link.split('/attachment/')[0])
+        resolved = {}
+        if links:
+            shortlinks = M.Shortlink.from_links(*links)
+            refs = dict((r._id, r) for r in M.ArtifactReference.query.find(
+                {'_id': {'$in': list(set(s.ref_id for s in shortlinks.values() if s))}}))
+            M.ArtifactReference.load_artifacts(refs.values())
+            for link, shortlink in shortlinks.iteritems():
+                resolved[link] = (shortlink, refs.get(shortlink.ref_id) if shortlink else None)
+        return resolved
+
+
 class ForgeMacroIncludePreprocessor(markdown.preprocessors.Preprocessor):
 
     '''Join include statements to prevent extra <br>'s inserted by nl2br extension.
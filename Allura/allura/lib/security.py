@@ -19,10 +19,15 @@
 This module provides the security predicates used in decorating various models.
 """
 import logging
-from collections import defaultdict
+import threading
+import time
+from collections import defaultdict, OrderedDict
 
+from bson import ObjectId
 from pylons import tmpl_context as c
 from pylons import request
+from paste.deploy.converters import asint
+from tg import config
 from webob import exc
 from itertools import chain
 from ming.utils import LazyProperty
@@ -32,6 +37,132 @@
 log = logging.getLogger(__name__)
 
 
+class RoleGraphCache(object):
+
+    '''
+    Process-wide LRU cache of the named :class:`ProjectRole <allura.model.auth.ProjectRole>` documents
+    (``user_id=None``) of each project, keyed by ``(project_id, version)``.  Per-user roles are not cached: a project
+    can have any number of members, and a request only needs the current user's own role, which is an indexed query.
+
+    The version of a project's role graph is bumped whenever one of its named roles is written through the ORM (see
+    :class:`allura.model.auth.ProjectRoleMapperExtension`).  If ``security.role_cache.memcached_host`` is set, versions
+    are kept in memcached so that a bump is seen by every process; otherwise they are only known to the current
+    process, and other processes rely on ``security.role_cache.ttl`` to pick up changes.
+    '''
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, size, ttl=None, client=None):
+        self.size = size
+        self.ttl = ttl
+        self.client = client
+        self.versions = {}
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        '''
+        get the :class:`RoleGraphCache` for this process, or None if ``security.role_cache.size`` is 0 (the default)
+        '''
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls.from_config(config)
+        return cls._instance or None
+
+    @classmethod
+    def from_config(cls, config):
+        size = asint(config.get('security.role_cache.size', 0))
+        if not size:
+            return False
+        client = None
+        host = config.get('security.role_cache.memcached_host')
+        if host:
+            try:
+                import pylibmc
+                client = pylibmc.Client([host])
+            except Exception:
+                log.exception('Error connecting to memcached %s for the role cache; versions will be per-process',
+                              host)
+        ttl = asint(config.get('security.role_cache.ttl', 60)) or None
+        return cls(size, ttl=ttl, client=client)
+
+    @classmethod
+    def reset(cls):
+        '''forget the current instance, so that it is rebuilt from config on next use'''
+        cls._instance = None
+
+    def _version_key(self, project_id):
+        return 'allura/role_graph/%s' % project_id
+
+    def version(self, project_id):
+        if self.client is None:
+            return self.versions.get(project_id, 0)
+        key = self._version_key(project_id)
+        version = self.client.get(key)
+        if version is None:
+            # a fresh token, so an evicted version can't match an older entry
+            self.client.add(key, str(ObjectId()))
+            version = self.client.get(key)
+        return version
+
+    def bump(self, project_id):
+        with self.lock:
+            self.versions[project_id] = self.versions.get(project_id, 0) + 1
+            self.entries.pop(project_id, None)
+        if self.client is not None:
+            try:
+                self.client.set(self._version_key(project_id), str(ObjectId()))
+            except Exception:
+                log.exception('Error bumping role graph version for %s', project_id)
+
+    def clear(self):
+        with self.lock:
+            for project_id in self.entries:
+                self.versions[project_id] = self.versions.get(project_id, 0) + 1
+            self.entries.clear()
+
+    def get_many(self, project_ids, load):
+        '''
+        :param project_ids: project ids to look up
+        :param load: callable taking a list of project ids and returning ``{project_id: [named role docs]}``, used
+                     for any ids which are not cached or whose version has changed
+        :returns: ``{project_id: [named role docs]}``
+        '''
+        result = {}
+        missing = {}
+        now = time.time()
+        for pid in project_ids:
+            # read the version before loading, so a concurrent bump can't be hidden by a stale load
+            try:
+                version = self.version(pid)
+            except Exception:
+                log.exception('Error reading role graph version for %s', pid)
+                version = None
+            with self.lock:
+                entry = self.entries.get(pid)
+                if (entry is not None and version is not None and entry[0] == version
+                        and (self.ttl is None or now - entry[1] < self.ttl)):
+                    self.entries[pid] = self.entries.pop(pid)  # most recently used
+                    result[pid] = entry[2]
+                    continue
+            missing[pid] = version
+        if missing:
+            loaded = load(missing.keys())
+            with self.lock:
+                for pid, version in missing.iteritems():
+                    roles = result[pid] = loaded.get(pid, [])
+                    if version is None:
+                        continue
+                    self.entries.pop(pid, None)
+                    self.entries[pid] = (version, now, roles)
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return result
+
+
 class Credentials(object):
 
     '''
@@ -63,6 +194,21 @@ def clear(self):
         self.users = {}
         self.projects = {}
 
+    def _find_named_roles(self, project_ids):
+        roles_by_project = dict((pid, []) for pid in project_ids)
+        for role in self.project_role.find({'project_id': {'$in': list(project_ids)}, 'user_id': None}):
+            roles_by_project[role['project_id']].append(role)
+        return roles_by_project
+
+    def _cached_named_roles(self, project_ids):
+        '''
+        :returns: ``{project_id: [named role docs]}`` from the :class:`RoleGraphCache`, or None if it is disabled
+        '''
+        role_cache = RoleGraphCache.get()
+        if role_cache is None:
+            return None
+        return role_cache.get_many(project_ids, self._find_named_roles)
+
     def clear_user(self, user_id, project_id=None):
         if project_id == '*':
             to_remove = [(uid, pid)
@@ -80,6 +226,20 @@ def load_user_roles(self, user_id, *project_ids):
             pid for pid in project_ids if self.users.get((user_id, pid)) is None]
         if not project_ids:
             return
+        cached = self._cached_named_roles(project_ids)
+        if cached is not None:
+            names = ['*anonymous'] if user_id is None else ['*anonymous', '*authenticated']
+            roles_by_project = dict((pid, [r for r in roles if r.get('name') in names])
+                                    for pid, roles in cached.iteritems())
+            if user_id is not None:
+                for role in self.project_role.find({
+                        'user_id': user_id,
+                        'project_id': {'$in': project_ids},
+                        'name': None}):
+                    roles_by_project[role['project_id']].append(role)
+            for pid, roles in roles_by_project.iteritems():
+                self.users[user_id, pid] = RoleCache(self, roles)
+            return
         if user_id is None:
             q = self.project_role.find({
                 'user_id': None,
@@ -247,10 +407,14 @@ def reaching_roles(self):
         def _iter():
             to_visit = self.index.items()
             project_ids = set([r['project_id'] for _id, r in to_visit])
-            pr_index = {r['_id']: r for r in self.cred.project_role.find({
-                'project_id': {'$in': list(project_ids)},
-                'user_id': None,
-            })}
+            cached = self.cred._cached_named_roles(project_ids)
+            if cached is not None:
+                pr_index = {r['_id']: r for r in chain(*cached.values())}
+            else:
+                pr_index = {r['_id']: r for r in self.cred.project_role.find({
+                    'project_id': {'$in': list(project_ids)},
+                    'user_id': None,
+                })}
             visited = set()
             while to_visit:
                 (rid, role) = to_visit.pop()
@@ -334,29 +498,19 @@ def predicate(obj=obj, user=user, project=project, roles=None):
             roles = cred.user_roles(
                 user_id=user._id, project_id=project._id).reaching_ids
 
+        acl = M.ACL.compile(obj.acl)
         # TODO: move deny logic into loop below; see ticket [#6715]
         if user != M.User.anonymous():
             user_roles = Credentials.get().user_roles(user_id=user._id,
                                                       project_id=project.root_project._id)
-            for r in user_roles:
-                deny_user = M.ACE.deny(r['_id'], permission)
-                if M.ACL.contains(deny_user, obj.acl):
-                    return False
-
-        chainable_roles = []
-        for rid in roles:
-            for ace in obj.acl:
-                if M.ACE.match(ace, rid, permission):
-                    if ace.access == M.ACE.ALLOW:
-                        # access is allowed
-                        # log.info('%s: True', txt)
-                        return True
-                    else:
-                        # access is denied for this role
-                        break
-            else:
-                # access neither allowed or denied, may chain to parent context
-                chainable_roles.append(rid)
+            if acl.denies([r['_id'] for r in user_roles], permission):
+                return False
+
+        # roles whose first matching ACE allows access grant it, roles with
+        # no matching ACE may chain to the parent context
+        allowed, chainable_roles = acl.check(roles, permission)
+        if allowed:
+            return True
         parent = obj.parent_security_context()
         if parent and chainable_roles:
             result = has_access(parent, permission, user=user, project=project)(
@@ -372,6 +526,72 @@ def predicate(obj=obj, user=user, project=project, roles=None):
     return TruthyCallable(predicate)
 
 
+def has_access_many(objs, permission, user=None, project=None):
+    '''Return a list of bools, whether the given user has the permission name
+    on each of the given objects.
+
+    This gives the same answers as calling :func:`has_access` on each object,
+    but is meant for filtering list views: the user's roles are looked up
+    once per project, and the parent security contexts the objects share (e.g.
+    their tool, project and neighborhood) are only evaluated once each.
+    '''
+    from allura import model as M
+
+    if user is None:
+        user = c.user
+    assert user, 'c.user should always be at least M.User.anonymous()'
+    cred = Credentials.get()
+    is_anonymous = user == M.User.anonymous()
+    memo = {}
+
+    def check(obj, permission, project, roles):
+        if obj is None:
+            return False
+        if project is None:
+            if isinstance(obj, M.Neighborhood):
+                project = obj.neighborhood_project
+                if project is None:
+                    log.error('Neighborhood project missing for %s', obj)
+                    return False
+            elif isinstance(obj, M.Project):
+                project = obj.root_project
+            else:
+                project = getattr(obj, 'project', None) or c.project
+                project = project.root_project
+        if roles is None:
+            roles = tuple(cred.user_roles(user_id=user._id, project_id=project._id).reaching_ids)
+
+        acl = M.ACL.compile(obj.acl)
+        if not is_anonymous:
+            user_roles = cred.user_roles(user_id=user._id, project_id=project.root_project._id)
+            if acl.denies([r['_id'] for r in user_roles], permission):
+                return False
+
+        allowed, chainable_roles = acl.check(roles, permission)
+        if allowed:
+            return True
+        parent = obj.parent_security_context()
+        if parent and chainable_roles:
+            return check_cached(parent, permission, project, tuple(chainable_roles))
+        elif not isinstance(obj, M.Neighborhood):
+            result = check_cached(project.neighborhood, 'admin', None, None)
+            if not (result or isinstance(obj, M.Project)):
+                result = check_cached(project, 'admin', None, None)
+            return result
+        else:
+            return False
+
+    def check_cached(obj, permission, project, roles):
+        if obj is None:
+            return False
+        key = (obj.__class__, obj._id, permission, project and project._id, roles)
+        if key not in memo:
+            memo[key] = check(obj, permission, project, roles)
+        return memo[key]
+
+    return [check(obj, permission, project, None) for obj in objs]
+
+
 def all_allowed(obj, user_or_role=None, project=None):
     '''
     List all the permission names that a given user or named role
@@ -17,6 +17,7 @@
 
 import shlex
 import logging
+from xml.sax.saxutils import escape
 
 from tg import config
 from paste.deploy.converters import asbool
@@ -110,6 +111,18 @@ def delete(self, *args, **kw):
             responses.append(solr.delete(*args, **kw))
         return responses
 
+    def delete_by_ids(self, ids, **kw):
+        '''Delete many documents by id with one request per server, rather
+        than with a (potentially huge) OR query'''
+        if 'commit' not in kw:
+            kw['commit'] = self._commit
+        message = '<delete>%s</delete>' % ''.join(
+            '<id>%s</id>' % escape(unicode(id)) for id in ids)
+        responses = []
+        for solr in self.push_pool:
+            responses.append(solr._update(message, **kw))
+        return responses
+
     def commit(self, *args, **kw):
         responses = []
         for solr in self.push_pool:
@@ -185,6 +198,10 @@ def search(self, q, fq=None, **kw):
                 result.append(obj)
         return result
 
+    def delete_by_ids(self, ids, **kwargs):
+        for id in ids:
+            self.db.pop(id, None)
+
     def delete(self, *args, **kwargs):
         if kwargs.get('q', None) == '*:*':
             self.db = {}
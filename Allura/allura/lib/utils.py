@@ -26,6 +26,7 @@
 import random
 import mimetypes
 import re
+import threading
 import magic
 from itertools import groupby
 import operator as op
@@ -470,6 +471,144 @@ def __keytransform__(self, key):
         return key.lower()
 
 
+@contextmanager
+def captured_resources(resource_manager):
+    '''
+    Collect the EasyWidgets resources registered with resource_manager within
+    this block, so they can be registered again when its output is reused from
+    a cache.  resource_manager may be None outside of a request.
+    '''
+    captured = []
+    if resource_manager is None:
+        yield captured
+        return
+    before = dict((loc, len(resources)) for loc, resources in resource_manager.resources.items())
+    yield captured
+    for loc, resources in resource_manager.resources.items():
+        captured.extend(resources[before.get(loc, 0):])
+
+
+class LRUCache(object):
+
+    '''
+    A thread-safe cache holding at most ``size`` entries, evicting the least
+    recently used ones first.  Entries may also expire ``ttl`` seconds after
+    they are set.
+    '''
+
+    def __init__(self, size, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                return default
+            self._data[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        ''':param ttl: seconds until this entry expires, instead of the cache's ``ttl``'''
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._data)
+
+
+class FileCache(object):
+
+    '''
+    A cache of strings stored as files in ``path``, shared by all processes
+    using the same directory.  When more than ``max_size`` bytes are stored,
+    the least recently used files are removed.
+    '''
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._written = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                pass  # created by another process meanwhile
+
+    def _filename(self, key):
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest())
+
+    def get(self, key, default=None):
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                value = f.read()
+            os.utime(filename, None)  # mark as recently used
+        except (IOError, OSError):
+            return default
+        return value
+
+    def set(self, key, value):
+        filename = self._filename(key)
+        tmp_filename = '%s.%s.%s.tmp' % (filename, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(tmp_filename, 'wb') as f:
+                f.write(value)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError):
+            log.warn('Could not write to cache %s', self.path, exc_info=True)
+            return
+        with self._lock:
+            self._written += len(value)
+            # only look at the whole directory now and then
+            check = self._written > self.max_size // 10
+            if check:
+                self._written = 0
+        if check:
+            self.evict()
+
+    def evict(self):
+        '''Remove the least recently used files, until no more than ``max_size`` bytes are stored'''
+        entries = []
+        for name in os.listdir(self.path):
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+
 def postmortem_hook(etype, value, tb):  # pragma no cover
     import sys
     import pdb
@@ -21,7 +21,7 @@
 
 from .neighborhood import Neighborhood, NeighborhoodFile
 from .project import Project, ProjectCategory, TroveCategory, ProjectFile, AppConfig
-from .index import ArtifactReference, Shortlink
+from .index import ArtifactReference, Shortlink, IndexBuffer
 from .artifact import Artifact, MovedArtifact, Message, VersionedArtifact, Snapshot, Feed, AwardFile, Award, AwardGrant
 from .artifact import VotableArtifact
 from .discuss import Discussion, Thread, PostHistory, Post, DiscussionAttachment
@@ -34,7 +34,7 @@
 from .repository import MergeRequest, GitLikeTree
 from .stats import Stats
 from .oauth import OAuthToken, OAuthConsumerToken, OAuthRequestToken, OAuthAccessToken
-from .monq_model import MonQTask
+from .monq_model import MonQTask, TaskSignal
 from .webhook import Webhook
 from .multifactor import TotpKey
 
@@ -61,4 +61,4 @@
     'OAuthRequestToken', 'OAuthAccessToken', 'MonQTask', 'Webhook', 'ACE', 'ACL', 'EVERYONE', 'ALL_PERMISSIONS',
     'DENY_ALL', 'MarkdownCache', 'main_doc_session', 'main_orm_session', 'project_doc_session', 'project_orm_session',
     'artifact_orm_session', 'repository_orm_session', 'task_orm_session', 'ArtifactSessionExtension', 'repository',
-    'repo_refresh', 'SiteNotification', 'TotpKey']
+    'repo_refresh', 'SiteNotification', 'TotpKey', 'TaskSignal', 'IndexBuffer']
@@ -16,10 +16,14 @@
 #       under the License.
 
 import logging
+import difflib
 from collections import defaultdict
+from copy import deepcopy
 from datetime import datetime
 
 import pymongo
+from tg import config
+from paste.deploy.converters import asint
 from pylons import tmpl_context as c, app_globals as g
 from pylons import request
 from ming import schema as S
@@ -419,6 +423,39 @@ def discussion_thread(self):
         """
         return self.get_discussion_thread()[0]
 
+    @classmethod
+    def prefetch_for_export(cls, artifacts):
+        """
+        Load what exporting ``artifacts`` needs (attachments, discussion
+        threads and their posts) with a few queries for all of them, rather
+        than a few per artifact.
+        """
+        from .discuss import Thread
+        if not artifacts:
+            return
+        try:
+            attachment_class = cls.attachment_class()
+        except NotImplementedError:
+            attachment_class = None
+        if attachment_class is not None:
+            attachments = defaultdict(list)
+            for att in attachment_class.query.find(dict(
+                    artifact_id={'$in': [a._id for a in artifacts]}, type='attachment')):
+                attachments[(att.app_config_id, att.artifact_id)].append(att)
+            for a in artifacts:
+                a.__dict__['attachments'] = utils.unique_attachments(attachments[(a.app_config_id, a._id)])
+        threads = defaultdict(list)
+        for t in Thread.query.find(dict(ref_id={'$in': [a.index_id() for a in artifacts]})):
+            threads[t.ref_id].append(t)
+        prefetched = []
+        for a in artifacts:
+            found = threads.get(a.index_id(), [])
+            # missing or duplicate threads are left to get_discussion_thread
+            if len(found) == 1:
+                a.__dict__['discussion_thread'] = found[0]
+                prefetched.append(found[0])
+        Thread.prefetch_for_export(prefetched)
+
     def add_multiple_attachments(self, file_info):
         if not isinstance(file_info, list):
             file_info = [file_info]
@@ -484,10 +521,91 @@ def count_in_app():
         return False
 
 
+def _text_patch(new, old):
+    """
+    Line based patch that turns ``new`` back into ``old``: a list of
+    ``[start, end]`` slices of the lines of ``new`` and literal strings.
+    Returns None when the patch would not be much smaller than ``old``.
+    """
+    a = new.splitlines(True)
+    b = old.splitlines(True)
+    ops = []
+    size = 0
+    matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+            size += 16
+        elif j2 > j1:
+            literal = ''.join(b[j1:j2])
+            ops.append(literal)
+            size += len(literal)
+    if size * 2 > len(old):
+        return None
+    return ops
+
+
+def _apply_text_patch(new, ops):
+    a = new.splitlines(True)
+    return u''.join(
+        u''.join(a[op[0]:op[1]]) if isinstance(op, list) else op
+        for op in ops)
+
+
+def snapshot_delta(old, new):
+    """
+    Reverse delta between two snapshot data dicts: what has to be applied
+    to ``new`` (see :func:`apply_snapshot_delta`) to get ``old`` back.
+    """
+    delta = dict(set={}, unset=[], patch={})
+    for k, v in old.iteritems():
+        if k in new and new[k] == v:
+            continue
+        if k in new and isinstance(v, basestring) and isinstance(new[k], basestring):
+            ops = _text_patch(new[k], v)
+            if ops is not None:
+                delta['patch'][k] = ops
+                continue
+        delta['set'][k] = v
+    delta['unset'] = [k for k in new if k not in old]
+    return delta
+
+
+def apply_snapshot_delta(data, delta):
+    data = deepcopy(data)
+    for k, ops in delta.get('patch', {}).iteritems():
+        data[k] = _apply_text_patch(data[k], ops)
+    data.update(deepcopy(delta.get('set', {})))
+    for k in delta.get('unset', []):
+        data.pop(k, None)
+    return data
+
+
+class SnapshotDataProperty(FieldProperty):
+    """
+    Snapshot data, which may be stored as a reverse delta against the next
+    version instead (see :meth:`Snapshot.compact`).  Delta encoded data is
+    rebuilt on first access and kept on the object's state only, so it is not
+    written back.
+    """
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        doc = state(instance).document
+        if doc.get(self.name) is None and doc.get('delta'):
+            instance._expand_data()
+        return super(SnapshotDataProperty, self).__get__(instance, cls)
+
+
 class Snapshot(Artifact):
     """
     A snapshot of an :class:`Artifact <allura.model.artifact.Artifact>`,
     used in :class:`VersionedArtifact <allura.model.artifact.VersionedArtifact>`
+
+    If ``snapshot.keyframe_interval`` is set, older snapshots only store a
+    ``delta`` against the next version, and every Nth version plus the latest
+    one keep the full ``data``.
     """
     class __mongometa__:
         session = artifact_orm_session
@@ -507,7 +625,8 @@ class __mongometa__:
         display_name=str,
         logged_ip=str))
     timestamp = FieldProperty(datetime)
-    data = FieldProperty(None)
+    data = SnapshotDataProperty(None)
+    delta = FieldProperty(None)
 
     def index(self):
         result = Artifact.index(self)
@@ -555,6 +674,60 @@ def attachments(self):
             return None
         return orig.attachments
 
+    def _newer_versions(self):
+        return self.__class__.query.find(dict(
+            artifact_id=self.artifact_id,
+            artifact_class=self.artifact_class,
+            version={'$gt': self.version})).sort('version', pymongo.ASCENDING)
+
+    def _expand_data(self):
+        """Rebuild delta encoded data from the nearest later full snapshot"""
+        chain = [self]
+        for ss in self._newer_versions():
+            if state(ss).document.get('data') is not None:
+                break
+            chain.append(ss)
+        else:
+            log.error('No full snapshot to rebuild version %s of %s %s from',
+                      self.version, self.artifact_class, self.artifact_id)
+            return
+        data = state(ss).document['data']
+        for ss in reversed(chain):
+            st = state(ss)
+            data = apply_snapshot_delta(data, st.document['delta'])
+            st.document['data'] = data
+            st.i_document.pop('data', None)
+
+    @classmethod
+    def is_keyframe(cls, version, keyframe_interval):
+        return not keyframe_interval or version % keyframe_interval == 0
+
+    @classmethod
+    def compact(cls, artifact_id, artifact_class, keyframe_interval):
+        """
+        Rewrite the history of one artifact so that only keyframes and the
+        latest version store full data.  Returns the number of snapshots
+        changed.
+        """
+        snapshots = cls.query.find(dict(
+            artifact_id=artifact_id,
+            artifact_class=artifact_class)).sort('version', pymongo.DESCENDING).all()
+        stored_full = [state(ss).document.get('data') is not None for ss in snapshots]
+        # expand everything before rewriting anything
+        data = [ss.data for ss in snapshots]
+        changed = 0
+        for i, ss in enumerate(snapshots[1:], 1):
+            full = stored_full[i]
+            if cls.is_keyframe(ss.version, keyframe_interval):
+                if not full:
+                    cls.query.update({'_id': ss._id}, {'$set': {'data': data[i]}, '$unset': {'delta': 1}})
+                    changed += 1
+            elif full:
+                delta = snapshot_delta(data[i], data[i - 1])
+                cls.query.update({'_id': ss._id}, {'$set': {'delta': delta}, '$unset': {'data': 1}})
+                changed += 1
+        return changed
+
     def __getattr__(self, name):
         return getattr(self.data, name)
 
@@ -605,6 +778,7 @@ def commit(self, update_stats=True):
                 break
         log.debug('Snapshot version %s of %s',
                   self.version, self.__class__)
+        self._compact_previous(ss)
         if update_stats:
             if self.version > 1:
                 g.statsUpdater.modifiedArtifact(
@@ -614,6 +788,22 @@ def commit(self, update_stats=True):
                     self.type_s, self.mod_date, self.project, c.user)
         return ss
 
+    def _compact_previous(self, ss):
+        """Store the version before ``ss`` as a delta against it, unless it is a keyframe"""
+        HC = self.__mongometa__.history_class
+        interval = asint(config.get('snapshot.keyframe_interval', 0))
+        prev_version = ss.version - 1
+        if prev_version < 1 or HC.is_keyframe(prev_version, interval):
+            return
+        prev = HC.query.get(
+            artifact_id=ss.artifact_id,
+            artifact_class=ss.artifact_class,
+            version=prev_version)
+        if prev is None or state(prev).document.get('data') is None:
+            return
+        delta = snapshot_delta(state(prev).document['data'], state(ss).document['data'])
+        HC.query.update({'_id': prev._id}, {'$set': {'delta': delta}, '$unset': {'data': 1}})
+
     def get_version(self, n):
         if n < 0:
             n = self.version + n + 1
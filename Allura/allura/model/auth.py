@@ -32,7 +32,7 @@
 from pylons import request
 from ming import schema as S
 from ming import Field, collection
-from ming.orm import session, state
+from ming.orm import session, state, MapperExtension
 from ming.orm import FieldProperty, RelationProperty, ForeignIdProperty
 from ming.orm.declarative import MappedClass
 from ming.orm.ormsession import ThreadLocalORMSession
@@ -42,6 +42,7 @@
 import allura.tasks.mail_tasks
 from allura.lib import helpers as h
 from allura.lib import plugin
+from allura.lib import security
 from allura.lib import utils
 from allura.lib.decorators import memoize
 from allura.lib.search import SearchIndexable
@@ -791,6 +792,39 @@ class __mongometa__:
         unique_indexes = [('user_id', 'project_id', 'name')]
 
 
+class ProjectRoleMapperExtension(MapperExtension):
+
+    """Bump the cached role graph version of a project whenever one of its named roles is written"""
+
+    def _bump(self, obj):
+        if obj.user_id is not None:
+            # per-user roles aren't cached, see RoleGraphCache
+            return
+        role_cache = security.RoleGraphCache.get()
+        if role_cache is not None:
+            role_cache.bump(obj.project_id)
+
+    def after_insert(self, obj, state, sess):
+        self._bump(obj)
+
+    def after_update(self, obj, state, sess):
+        self._bump(obj)
+
+    def after_delete(self, obj, state, sess):
+        self._bump(obj)
+
+    def after_remove(self, sess, *args, **kwargs):
+        role_cache = security.RoleGraphCache.get()
+        if role_cache is None:
+            return
+        spec = args[0] if args else kwargs.get('spec_or_id')
+        project_id = spec.get('project_id') if isinstance(spec, dict) else None
+        if project_id is not None and not isinstance(project_id, dict):
+            role_cache.bump(project_id)
+        else:
+            role_cache.clear()
+
+
 class ProjectRole(MappedClass):
     """
     Per-project roles, called "Groups" in the UI.
@@ -806,6 +840,7 @@ class ProjectRole(MappedClass):
     class __mongometa__:
         session = main_orm_session
         name = 'project_role'
+        extensions = [ProjectRoleMapperExtension]
         unique_indexes = [('user_id', 'project_id', 'name')]
         indexes = [
             ('user_id',),
@@ -17,6 +17,7 @@
 
 import os
 import logging
+from collections import defaultdict
 from datetime import datetime
 
 import jinja2
@@ -63,15 +64,17 @@ class __mongometa__:
     threads = RelationProperty('Thread', via='discussion_id')
     posts = RelationProperty('Post', via='discussion_id')
 
-    def __json__(self, limit=None, posts_limit=None, is_export=False):
-        return dict(
+    def __json__(self, limit=None, posts_limit=None, is_export=False, threads=True):
+        result = dict(
             _id=str(self._id),
             shortname=self.shortname,
             name=self.name,
             description=self.description,
-            threads=[t.__json__(limit=posts_limit, is_export=is_export) for t
-                     in self.thread_class().query.find(dict(discussion_id=self._id)).limit(limit or 0)]
         )
+        if threads:
+            result['threads'] = [t.__json__(limit=posts_limit, is_export=is_export) for t
+                                 in self.thread_class().query.find(dict(discussion_id=self._id)).limit(limit or 0)]
+        return result
 
     @property
     def activity_name(self):
@@ -187,6 +190,11 @@ def attachments_for_json(self, page):
                      url=h.absurl(attach.url())) for attach in page.attachments]
 
     def __json__(self, limit=None, page=None, is_export=False):
+        posts = None
+        if limit is None and page is None:
+            posts = self.__dict__.get('_prefetched_posts')
+        if posts is None:
+            posts = self.query_posts(status='ok', style='chronological', limit=limit, page=page)
         return dict(
             _id=self._id,
             discussion_id=str(self.discussion_id),
@@ -201,10 +209,38 @@ def __json__(self, limit=None, page=None, is_export=False):
                         timestamp=p.timestamp,
                         last_edited=p.last_edit_date,
                         attachments=self.attachment_for_export(p) if is_export else self.attachments_for_json(p))
-                   for p in self.query_posts(status='ok', style='chronological', limit=limit, page=page)
+                   for p in posts
                    ]
         )
 
+    @classmethod
+    def prefetch_for_export(cls, threads):
+        """Load the posts of many threads, with their authors and attachments, for :meth:`__json__`"""
+        by_post_class = defaultdict(list)
+        for t in threads:
+            by_post_class[t.post_class()].append(t)
+        for post_class, group in by_post_class.iteritems():
+            posts = post_class.query.find(dict(
+                thread_id={'$in': [t._id for t in group]},
+                status='ok',
+                deleted=False,
+            )).sort('timestamp').all()
+            by_thread = defaultdict(list)
+            for p in posts:
+                by_thread[p.thread_id].append(p)
+            for t in group:
+                t.__dict__['_prefetched_posts'] = by_thread[t._id]
+            if not posts:
+                continue
+            # loads them into the session, for Post.author()
+            User.query.find({'_id': {'$in': list(set(p.author_id for p in posts))}}).all()
+            attachments = defaultdict(list)
+            for att in post_class.attachment_class().query.find(dict(
+                    post_id={'$in': [p._id for p in posts]}, type='attachment')):
+                attachments[att.post_id].append(att)
+            for p in posts:
+                p.__dict__['attachments'] = utils.unique_attachments(attachments[p._id])
+
     @property
     def activity_name(self):
         return 'thread %s' % self.subject
@@ -425,6 +461,12 @@ def find_posts(self, page=None, limit=None, timestamp=None,
         return self.query_posts(page=page, limit=limit,
                                 timestamp=timestamp, style=style).all()
 
+    def render_posts(self, posts):
+        '''Convert the text of all ``posts`` at once, for their :attr:`Post.html_text`'''
+        for post, html in zip(posts, g.markdown.cached_convert_many(posts, 'text')):
+            post.__dict__['_html_text'] = html
+        return posts
+
     def url(self):
         # Can't use self.discussion because it might change during the req
         discussion = self.discussion_class().query.get(_id=self.discussion_id)
@@ -531,6 +573,13 @@ def __json__(self):
             author_id=str(author._id),
             author=author.username)
 
+    @property
+    def html_text(self):
+        html = self.__dict__.get('_html_text')
+        if html is None:
+            html = g.markdown.cached_convert(self, 'text')
+        return html
+
     @property
     def activity_name(self):
         return 'a comment'
@@ -17,7 +17,7 @@
 
 import re
 import logging
-from itertools import groupby
+from itertools import groupby, chain
 from cPickle import dumps, loads
 from collections import defaultdict
 from urllib import unquote
@@ -35,7 +35,7 @@
 from allura.lib import helpers as h
 
 from .session import main_doc_session, main_orm_session
-from .project import Project
+from .project import Project, AppConfig
 
 log = logging.getLogger(__name__)
 
@@ -66,6 +66,13 @@
     Index('project_id', 'link'),
 )
 
+IndexBufferDoc = collection(
+    'index_buffer', main_doc_session,
+    Field('_id', S.ObjectId()),
+    Field('op', S.OneOf('add', 'del')),
+    Field('ref_ids', [str]),
+)
+
 # Class definitions
 
 
@@ -103,6 +110,78 @@ def artifact(self):
             log.exception('Error loading artifact for %s: %r',
                           self._id, aref)
 
+    @classmethod
+    def load_artifacts(cls, refs):
+        '''Look up the artifacts of several references at once (one query per
+        artifact class and project), and cache them as each ref's ``artifact``'''
+        classes = {}
+        refs_by_query = defaultdict(list)
+        for ref in refs:
+            if ref is None or 'artifact' in ref.__dict__:
+                continue
+            aref = ref.artifact_reference
+            refs_by_query[str(aref.cls), aref.project_id].append(ref)
+        for (cls_pickle, project_id), query_refs in refs_by_query.iteritems():
+            try:
+                if cls_pickle not in classes:
+                    classes[cls_pickle] = loads(cls_pickle)
+                artifact_cls = classes[cls_pickle]
+                with h.push_context(project_id):
+                    artifacts = dict((a._id, a) for a in artifact_cls.query.find({
+                        '_id': {'$in': [ref.artifact_reference.artifact_id for ref in query_refs]}}))
+            except Exception:
+                log.exception('Error loading artifacts for %s', [ref._id for ref in query_refs])
+                continue
+            for ref in query_refs:
+                ref.__dict__['artifact'] = artifacts.get(ref.artifact_reference.artifact_id)
+
+
+class IndexBuffer(object):
+
+    '''Search index updates waiting to be sent to solr.
+
+    Each session flush appends one document listing the ArtifactReference ids
+    that were added/modified or deleted.  The
+    :func:`allura.tasks.index_tasks.flush_index_buffer` task periodically
+    merges all pending documents, so an artifact saved many times in a short
+    window is only indexed once, and sends them to solr in large batches.
+    '''
+
+    @classmethod
+    def add(cls, ref_ids):
+        IndexBufferDoc.make(dict(op='add', ref_ids=list(ref_ids))).m.insert()
+
+    @classmethod
+    def delete(cls, ref_ids):
+        IndexBufferDoc.make(dict(op='del', ref_ids=list(ref_ids))).m.insert()
+
+    @classmethod
+    def pending(cls, limit=None):
+        '''Oldest buffered documents first'''
+        cursor = IndexBufferDoc.m.find().sort('_id', pymongo.ASCENDING)
+        if limit:
+            cursor = cursor.limit(limit)
+        return cursor.all()
+
+    @classmethod
+    def merge(cls, docs):
+        '''Collapse buffered documents into (to_add, to_delete) sets of ref ids.
+        The most recent operation on each ref id wins.'''
+        to_add, to_delete = set(), set()
+        for doc in docs:
+            ref_ids = set(doc['ref_ids'])
+            if doc['op'] == 'add':
+                to_add |= ref_ids
+                to_delete -= ref_ids
+            else:
+                to_delete |= ref_ids
+                to_add -= ref_ids
+        return to_add, to_delete
+
+    @classmethod
+    def remove(cls, docs):
+        IndexBufferDoc.m.remove({'_id': {'$in': [doc['_id'] for doc in docs]}})
+
 
 class Shortlink(object):
 
@@ -154,7 +233,8 @@ def from_links(cls, *links):
         if len(links):
             result = {}
             # Parse all the links
-            parsed_links = dict((link, cls._parse_link(link))
+            projects = cls._projects_for_links(links)
+            parsed_links = dict((link, cls._parse_link(link, projects))
                                 for link in links)
             links_by_artifact = defaultdict(list)
             project_ids = set()
@@ -168,22 +248,38 @@ def from_links(cls, *links):
                 link={'$in': links_by_artifact.keys()},
                 project_id={'$in': list(project_ids)}
             ), validate=False)
+            key = lambda s: unquote(s.link)
             matches_by_artifact = dict(
                 (link, list(matches))
-                for link, matches in groupby(q, key=lambda s: unquote(s.link)))
+                for link, matches in groupby(sorted(q, key=key), key=key))
+            # load the projects and tools of all matches up front, rather
+            # than once per match
+            all_matches = list(chain(*matches_by_artifact.values()))
+            match_projects = dict((p._id, p) for p in Project.query.find(
+                {'_id': {'$in': list(set(m.project_id for m in all_matches))}}))
+            match_app_configs = dict((ac._id, ac) for ac in AppConfig.query.find(
+                {'_id': {'$in': list(set(m.app_config_id for m in all_matches))}}))
+            mounted = {}
+
+            def is_mounted(project, app_config):
+                mount_point = app_config.options.mount_point
+                if (project._id, mount_point) not in mounted:
+                    mounted[project._id, mount_point] = bool(project.app_instance(mount_point))
+                return mounted[project._id, mount_point]
+
             for link, d in parsed_links.iteritems():
-                matches = matches_by_artifact.get(unquote(d['artifact']), [])
-                matches = (
-                    m for m in matches
-                    if m.project.shortname == d['project'] and
-                    m.project.neighborhood_id == d['nbhd'] and
-                    m.app_config is not None and
-                    m.project.app_instance(m.app_config.options.mount_point))
-                if d['app']:
-                    matches = (
-                        m for m in matches
-                        if m.app_config.options.mount_point == d['app'])
-                result[link] = cls._get_correct_match(link, list(matches))
+                matches = []
+                for m in matches_by_artifact.get(unquote(d['artifact']), []):
+                    project = match_projects.get(m.project_id)
+                    app_config = match_app_configs.get(m.app_config_id)
+                    if (project is not None and
+                            project.shortname == d['project'] and
+                            project.neighborhood_id == d['nbhd'] and
+                            app_config is not None and
+                            is_mounted(project, app_config) and
+                            (not d['app'] or app_config.options.mount_point == d['app'])):
+                        matches.append(m)
+                result[link] = cls._get_correct_match(link, matches)
             return result
         else:
             return {}
@@ -214,14 +310,36 @@ def log_ambiguous_link(cls, msg, matches, *args):
             log.warn('... %r', m)
 
     @classmethod
-    def _parse_link(cls, s):
-        '''Parse a shortlink into its nbhd/project/app/artifact parts'''
+    def _split_link(cls, s):
         s = s.strip()
         if s.startswith('['):
             s = s[1:]
         if s.endswith(']'):
             s = s[:-1]
-        parts = s.split(':')
+        return s.split(':')
+
+    @classmethod
+    def _projects_for_links(cls, links):
+        '''Look up the projects named by any project:app:artifact links, keyed by shortname'''
+        shortnames = set()
+        for link in links:
+            parts = cls._split_link(link)
+            if len(parts) == 3:
+                shortnames.add(parts[0])
+        if not shortnames:
+            return {}
+        p_nbhd = c.project.neighborhood_id if getattr(c, 'project', None) else None
+        return dict((p.shortname, p) for p in Project.query.find(dict(
+            shortname={'$in': list(shortnames)},
+            neighborhood_id=p_nbhd)))
+
+    @classmethod
+    def _parse_link(cls, s, projects=None):
+        '''Parse a shortlink into its nbhd/project/app/artifact parts
+
+        :param projects: optional result of :meth:`_projects_for_links`, to avoid looking up the project
+        '''
+        parts = cls._split_link(s)
         p_shortname = None
         p_id = None
         p_nbhd = None
@@ -230,7 +348,10 @@ def _parse_link(cls, s):
             p_id = getattr(c.project, '_id', None)
             p_nbhd = c.project.neighborhood_id
         if len(parts) == 3:
-            p = Project.query.get(shortname=parts[0], neighborhood_id=p_nbhd)
+            if projects is not None:
+                p = projects.get(parts[0])
+            else:
+                p = Project.query.get(shortname=parts[0], neighborhood_id=p_nbhd)
             if p:
                 p_id = p._id
             return dict(
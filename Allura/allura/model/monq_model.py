@@ -24,7 +24,7 @@
 import pymongo
 from pylons import tmpl_context as c, app_globals as g
 from tg import config
-from paste.deploy.converters import asbool
+from paste.deploy.converters import asbool, asint
 
 import ming
 from ming.utils import LazyProperty
@@ -38,6 +38,91 @@
 log = logging.getLogger(__name__)
 
 
+class TaskSignal(object):
+
+    '''Wakeup channel for idle taskd workers.
+
+    Every call to :meth:`MonQTask.post` appends a small document to a capped
+    collection.  Idle workers keep a tailable cursor open on that collection
+    and block on it, so a new task is picked up as soon as it is posted
+    instead of after the next ``monq.poll_interval`` sleep.
+
+    Enabled with ``monq.signal = true``.  Delayed tasks and missed signals are
+    still found by the regular poll, which acts as a fallback.
+    '''
+
+    collection_name = 'monq_task_signal'
+    # databases this process has already made sure have the capped collection
+    _ensured = set()
+
+    def __init__(self, only=None):
+        self.only = only
+        self.cursor = None
+
+    @classmethod
+    def enabled(cls):
+        return asbool(config.get('monq.signal', False))
+
+    @classmethod
+    def collection(cls):
+        db = session(MonQTask).impl.db
+        if db.name not in cls._ensured:
+            try:
+                db.create_collection(
+                    cls.collection_name,
+                    capped=True,
+                    size=asint(config.get('monq.signal.size', 1024 * 1024)))
+                # a tailable cursor on an empty capped collection dies
+                # immediately, so always keep at least one document in it
+                db[cls.collection_name].insert(dict(task_name=None))
+            except pymongo.errors.CollectionInvalid:
+                pass  # already exists, or created concurrently by another process
+            cls._ensured.add(db.name)
+        return db[cls.collection_name]
+
+    @classmethod
+    def send(cls, task_name):
+        '''Wake up idle workers that handle ``task_name``.'''
+        try:
+            cls.collection().insert(dict(task_name=task_name), w=0)
+        except pymongo.errors.PyMongoError:
+            log.exception('Error signalling taskd workers for %s', task_name)
+
+    def _open_cursor(self):
+        coll = self.collection()
+        # only react to signals sent after we started listening
+        last = coll.find().sort('$natural', -1).limit(1)
+        spec = {}
+        for doc in last:
+            spec['_id'] = {'$gt': doc['_id']}
+        self.cursor = coll.find(spec, tailable=True, await_data=True)
+
+    def wait(self, timeout):
+        '''Block until a relevant task is posted, or ``timeout`` seconds have
+        passed.  Returns True if woken up by a signal.'''
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                if self.cursor is None or not self.cursor.alive:
+                    self._open_cursor()
+                for doc in self.cursor:
+                    if not self.only or doc.get('task_name') in self.only:
+                        return True
+                    if time.time() >= deadline:
+                        break
+                if not self.cursor.alive:
+                    # avoid spinning if the server keeps killing the cursor
+                    time.sleep(max(0, min(0.1, deadline - time.time())))
+            except pymongo.errors.PyMongoError as e:
+                log.exception('Error waiting for task signal')
+                self.cursor = None
+                if isinstance(e, pymongo.errors.OperationFailure):
+                    # e.g. the collection was dropped, create it again
+                    self._ensured.discard(session(MonQTask).impl.db.name)
+                time.sleep(max(0, min(1, deadline - time.time())))
+        return False
+
+
 class MonQTask(MappedClass):
 
     '''Task to be executed by the taskd daemon.
@@ -58,6 +143,8 @@ class MonQTask(MappedClass):
         - args - ``*args`` to be sent to the task function
         - kwargs - ``**kwargs`` to be sent to the task function
         - result - if the task is complete, the return value. If in error, the traceback.
+        - unique_key - optional coalescing key; posting a task with the same key
+          as a task which is still 'ready' reuses that task instead of adding one
     '''
     states = ('ready', 'busy', 'error', 'complete', 'skipped')
     result_types = ('keep', 'forget')
@@ -77,6 +164,10 @@ class __mongometa__:
                 # used by repo tarball status check, etc
                 'state', 'task_name', 'time_queue'
             ],
+            [
+                # used to coalesce tasks in MonQTask.post()
+                'unique_key', 'state'
+            ],
         ]
 
     _id = FieldProperty(S.ObjectId)
@@ -84,6 +175,8 @@ class __mongometa__:
     priority = FieldProperty(int)
     result_type = FieldProperty(S.OneOf(*result_types))
     time_queue = FieldProperty(datetime, if_missing=datetime.utcnow)
+    # when a worker claimed it; it may wait a while in a batch before time_start
+    time_claim = FieldProperty(datetime, if_missing=None)
     time_start = FieldProperty(datetime, if_missing=None)
     time_stop = FieldProperty(datetime, if_missing=None)
 
@@ -97,6 +190,7 @@ class __mongometa__:
     args = FieldProperty([])
     kwargs = FieldProperty({None: None})
     result = FieldProperty(None, if_missing=None)
+    unique_key = FieldProperty(str, if_missing=None)
 
     def __repr__(self):
         from allura import model as M
@@ -135,8 +229,15 @@ def post(cls,
              kwargs=None,
              result_type='forget',
              priority=10,
-             delay=0):
-        '''Create a new task object based on the current context.'''
+             delay=0,
+             unique_key=None):
+        '''Create a new task object based on the current context.
+
+        If ``unique_key`` is given and a task with the same key is still waiting
+        to run, no new task is created; the waiting one is returned instead
+        (and moved up to run no later than this post asked for).  Note that
+        two concurrent posts can still both create a task.
+        '''
         if args is None:
             args = ()
         if kwargs is None:
@@ -144,6 +245,19 @@ def post(cls,
         task_name = '%s.%s' % (
             function.__module__,
             function.__name__)
+        time_queue = datetime.utcnow() + timedelta(seconds=delay)
+        if unique_key is not None:
+            existing = cls.query.get(state='ready', unique_key=unique_key)
+            if existing is not None:
+                # truncate to milliseconds as ming does for new docs, since
+                # this raw update bypasses validation
+                time_queue = time_queue.replace(microsecond=time_queue.microsecond // 1000 * 1000)
+                # update atomically, a worker may be claiming it right now
+                cls.query.update(
+                    dict(_id=existing._id, state='ready',
+                         time_queue={'$gt': time_queue}),
+                    {'$set': dict(time_queue=time_queue)})
+                return existing
         context = dict(
             project_id=None,
             app_config_id=None,
@@ -167,17 +281,21 @@ def post(cls,
             process=None,
             result=None,
             context=context,
-            time_queue=datetime.utcnow() + timedelta(seconds=delay))
+            time_queue=time_queue,
+            unique_key=unique_key)
         session(obj).flush(obj)
+        if not delay and TaskSignal.enabled():
+            TaskSignal.send(task_name)
         return obj
 
     @classmethod
-    def get(cls, process='worker', state='ready', waitfunc=None, only=None):
+    def get(cls, process='worker', state='ready', waitfunc=None, only=None, exclude=None):
         '''Get the highest-priority, oldest, ready task and lock it to the
         current process.  If no task is available and waitfunc is supplied, call
         the waitfunc before trying to get the task again.  If waitfunc is None
         and no tasks are available, return None.  If waitfunc raises a
-        StopIteration, stop waiting for a task
+        StopIteration, stop waiting for a task.  ``only`` and ``exclude`` are
+        lists of task names to restrict the search to, or to skip.
         '''
         sort = [
             ('priority', ming.DESCENDING),
@@ -188,12 +306,15 @@ def get(cls, process='worker', state='ready', waitfunc=None, only=None):
                 query['time_queue'] = {'$lte': datetime.utcnow()}
                 if only:
                     query['task_name'] = {'$in': only}
+                if exclude:
+                    query.setdefault('task_name', {})['$nin'] = exclude
                 obj = cls.query.find_and_modify(
                     query=query,
                     update={
                         '$set': dict(
                             state='busy',
-                            process=process)
+                            process=process,
+                            time_claim=datetime.utcnow())
                     },
                     new=True,
                     sort=sort)
@@ -209,12 +330,76 @@ def get(cls, process='worker', state='ready', waitfunc=None, only=None):
             except StopIteration:
                 return None
 
+    @classmethod
+    def get_batch(cls, n, process='worker', state='ready', waitfunc=None, only=None, exclude=None):
+        '''Like :meth:`get`, but lock up to ``n`` of the highest-priority, oldest
+        ready tasks to the current process at once.  Returns a list of tasks in
+        the order they should be run (empty if waitfunc is None or raises
+        StopIteration and no tasks are available).
+
+        Candidates are claimed with a single multi-document update which only
+        matches tasks still in ``state``, so a task is never handed to two
+        processes.  ``process`` must be unique per worker.
+        '''
+        sort = [
+            ('priority', ming.DESCENDING),
+            ('time_queue', ming.ASCENDING)]
+        while True:
+            query = dict(state=state)
+            query['time_queue'] = {'$lte': datetime.utcnow()}
+            if only:
+                query['task_name'] = {'$in': only}
+            if exclude:
+                query.setdefault('task_name', {})['$nin'] = exclude
+            candidates = cls.query.find(query).sort(sort).limit(n).all()
+            if candidates:
+                ids = [t._id for t in candidates]
+                claim = dict(query, _id={'$in': ids})
+                cls.query.update(
+                    claim,
+                    {'$set': dict(state='busy', process=process, time_claim=datetime.utcnow())},
+                    multi=True)
+                claimed_ids = set(t._id for t in cls.query.find(
+                    dict(_id={'$in': ids}, state='busy', process=process),
+                    refresh=True))
+                claimed = []
+                for t in candidates:
+                    if t._id in claimed_ids:
+                        claimed.append(t)
+                    else:
+                        # taken by another worker, don't keep a stale copy
+                        session(t).expunge(t)
+                if claimed:
+                    return claimed
+            if waitfunc is None:
+                return []
+            try:
+                waitfunc()
+            except StopIteration:
+                return []
+
+    @classmethod
+    def release_unstarted(cls, tasks):
+        '''Put claimed tasks that were never started back in the ready state,
+        e.g. when a batch is aborted part way through.'''
+        ids = [t._id for t in tasks]
+        if ids:
+            cls.query.update(
+                dict(_id={'$in': ids}, state='busy', time_start=None),
+                {'$set': dict(state='ready', process=None)},
+                multi=True)
+
     @classmethod
     def timeout_tasks(cls, older_than):
         '''Mark all busy tasks older than a certain datetime as 'ready' again.
-        Used to retry 'stuck' tasks.'''
+        Used to retry 'stuck' tasks.  Tasks that were claimed but never started
+        (e.g. the rest of a batch whose worker died) count from when they were
+        claimed.'''
         spec = dict(state='busy')
-        spec['time_start'] = {'$lt': older_than}
+        spec['$or'] = [
+            {'time_start': {'$ne': None, '$lt': older_than}},
+            {'time_start': None, 'time_claim': {'$lt': older_than}},
+        ]
         cls.query.update(spec, {'$set': dict(state='ready')}, multi=True)
 
     @classmethod
@@ -21,7 +21,7 @@
 from collections import OrderedDict
 
 from ming import schema as S
-from ming.orm import FieldProperty, RelationProperty
+from ming.orm import FieldProperty, RelationProperty, MapperExtension
 from ming.orm.declarative import MappedClass
 from ming.utils import LazyProperty
 
@@ -53,6 +53,18 @@ class __mongometa__:
 re_color_titlebar = re.compile('color:([^;}]+);')
 
 
+class NeighborhoodMapperExtension(MapperExtension):
+
+    def after_insert(self, obj, state, sess):
+        Neighborhood.clear_routes()
+
+    def after_update(self, obj, state, sess):
+        Neighborhood.clear_routes()
+
+    def after_delete(self, obj, state, sess):
+        Neighborhood.clear_routes()
+
+
 class Neighborhood(MappedClass):
 
     '''Provide a grouping of related projects.
@@ -63,6 +75,7 @@ class Neighborhood(MappedClass):
     class __mongometa__:
         session = main_orm_session
         name = 'neighborhood'
+        extensions = [NeighborhoodMapperExtension]
         unique_indexes = ['url_prefix']
 
     _id = FieldProperty(S.ObjectId)
@@ -92,6 +105,40 @@ class __mongometa__:
     prohibited_tools = FieldProperty(str, if_missing='')
     use_wiki_page_as_root = FieldProperty(bool, if_missing=False)
 
+    @classmethod
+    def routes(cls):
+        '''Return ``(url_prefix, shortname_prefix, _id)`` of every neighborhood, kept
+        in :attr:`g.route_cache <allura.lib.app_globals.Globals.route_cache>` if enabled.'''
+        cache = g.route_cache
+        routes = cache.get('neighborhoods') if cache is not None else None
+        if routes is None:
+            routes = [(n.url_prefix, n.shortname_prefix, n._id) for n in cls.query.find()]
+            if cache is not None:
+                cache.set('neighborhoods', routes)
+        return routes
+
+    @classmethod
+    def clear_routes(cls):
+        cache = g.route_cache
+        if cache is not None:
+            cache.delete('neighborhoods')
+
+    @classmethod
+    def by_url_prefix(cls, url_prefix):
+        '''Return the neighborhood at ``url_prefix``, or None.  Uses :meth:`routes`
+        so urls which aren't neighborhoods (e.g. /auth/) don't need a query.'''
+        for prefix, shortname_prefix, _id in cls.routes():
+            if prefix == url_prefix:
+                n = cls.query.get(_id=_id)
+                if n is not None and n.url_prefix == url_prefix:
+                    return n
+                break
+        else:
+            return None
+        # changed since the routes were cached
+        cls.clear_routes()
+        return cls.query.get(url_prefix=url_prefix)
+
     def parent_security_context(self):
         return None
 
@@ -16,11 +16,12 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import json
+import hashlib
 import logging
 from calendar import timegm
 from collections import Counter, OrderedDict
 from datetime import datetime
-from copy import deepcopy
 import urllib
 import re
 from xml.etree import ElementTree as ET
@@ -272,6 +273,11 @@ def permissions(self):
         else:
             return self._perms_base
 
+    @classmethod
+    def by_shortname(cls, shortname, neighborhood_id):
+        '''Return the project (deleted or not) named ``shortname`` in a neighborhood, or None'''
+        return cls.query.get(shortname=shortname, neighborhood_id=neighborhood_id)
+
     def parent_security_context(self):
         '''ACL processing should proceed up the project hierarchy.'''
         return self.parent_project
@@ -585,44 +591,112 @@ def sitemap(self, excluded_tools=None, included_tools=None,
         # Keep running count of entries per tool type
         tool_counts = Counter({tool_name: 0 for tool_name in g.entry_points['tool']})
 
+        # just installed tools aren't in app_configs yet, so don't cache anything this time
+        subproject_entries, tool_entries, visible = self._nav_entries(
+            self.app_configs + [a.config for a in new_tools], delta_ordinal, cacheable=not new_tools)
+
         if not tools_only:
-            for sub in self.direct_subprojects:
-                ordinal = sub.ordinal + delta_ordinal
-                if ordinal > max_ordinal:
-                    max_ordinal = ordinal
-                entries.append({'ordinal': sub.ordinal + delta_ordinal,
-                               'entry': SitemapEntry(sub.name, sub.url())})
-
-        for ac in self.app_configs + [a.config for a in new_tools]:
+            entries.extend(subproject_entries)
+
+        for ac_id, tool_name, ac_entries in tool_entries:
             if per_tool_limit:
                 # We already have max entries for every tool type
                 if min(tool_counts.values()) >= per_tool_limit:
                     break
 
                 # We already have max entries for this tool type
-                if tool_counts.get(ac.tool_name, 0) >= per_tool_limit:
+                if tool_counts.get(tool_name, 0) >= per_tool_limit:
                     continue
 
-            if excluded_tools and ac.tool_name in excluded_tools:
+            if excluded_tools and tool_name in excluded_tools:
                 continue
 
-            if included_tools and ac.tool_name not in included_tools:
+            if included_tools and tool_name not in included_tools:
                 continue
 
+            if ac_id in visible:
+                entries.extend(ac_entries)
+                tool_counts.update({tool_name: len(ac_entries)})
+
+        if entries:
+            max_ordinal = max(max_ordinal, max(e['ordinal'] for e in entries))
+
+        if (not tools_only and
+                self == self.neighborhood.neighborhood_project and
+                h.has_access(self.neighborhood, 'admin')):
+            entries.append({
+                'ordinal': max_ordinal + 1,
+                'entry': SitemapEntry(
+                    'Moderate',
+                    "%s_moderate/" % self.neighborhood.url(),
+                    ui_icon="tool-admin")
+                })
+            max_ordinal += 1
+
+        entries = sorted(entries, key=lambda e: e['ordinal'])
+        # the entries may be cached, and callers change them
+        return [e['entry'].copy() for e in entries]
+
+    def _nav_entries(self, app_configs, delta_ordinal, cacheable=True):
+        """Return the navbar entries of subprojects and tools for :meth:`sitemap`, as
+        ``({'ordinal', 'entry'} of each subproject, (app config id, tool name,
+        [{'ordinal', 'entry'}]) of each tool, ids of the tools the current user can see)``.
+
+        If :attr:`g.nav_cache <allura.lib.app_globals.Globals.nav_cache>` is enabled,
+        the entries are kept there by :meth:`nav_hash`, so they are made again whenever
+        tools, their options (e.g. ordinals) or ACLs change.  Which tools can be seen is
+        kept by that and the user's roles, so users with the same roles share it, and
+        tools only need instantiating on a miss.
+        """
+        from allura.app import SitemapEntry
+        anchored_tools = self.neighborhood.get_anchored_tools()
+        subprojects = self.direct_subprojects
+        app_classes = []
+        for ac in app_configs:
             # Tool could've been uninstalled in the meantime
             try:
-                App = ac.load()
+                app_classes.append((ac, ac.load()))
             # If so, we don't want it listed
             except KeyError:
                 log.exception('AppConfig %s references invalid tool %s',
                               ac._id, ac.tool_name)
-                continue
-            if getattr(c, 'app', None) and c.app.config._id == ac._id:
-                # slight performance gain (depending on the app) by using the current app if we're on it
-                app = c.app
-            else:
-                app = App(self, ac)
-            if app.is_visible_to(c.user):
+
+        apps = {}
+
+        def app_instance(ac, App):
+            if ac._id not in apps:
+                if getattr(c, 'app', None) and c.app.config._id == ac._id:
+                    # slight performance gain (depending on the app) by using the current app if we're on it
+                    apps[ac._id] = c.app
+                else:
+                    apps[ac._id] = App(self, ac)
+            return apps[ac._id]
+
+        cache = g.nav_cache if cacheable else None
+        if cache is not None:
+            nav_hash = self.nav_hash(app_configs, subprojects)
+            cred = security.Credentials.get()
+            user_roles = frozenset(cred.user_roles(
+                user_id=c.user._id, project_id=self.root_project._id).reaching_ids)
+            # for neighborhood admins
+            nbhd_roles = frozenset(cred.user_roles(
+                user_id=c.user._id, project_id=self.neighborhood.neighborhood_project._id).reaching_ids)
+            entries_key = ('entries', self._id, nav_hash)
+            # some tools' visibility depends on c.project
+            visible_key = ('visible', self._id, nav_hash, getattr(c.project, '_id', None), user_roles, nbhd_roles)
+            entries = cache.get(entries_key)
+            visible = cache.get(visible_key)
+        else:
+            entries = visible = None
+
+        if entries is None:
+            subproject_entries = [
+                {'ordinal': sub.ordinal + delta_ordinal, 'entry': SitemapEntry(sub.name, sub.url())}
+                for sub in subprojects]
+            tool_entries = []
+            for ac, App in app_classes:
+                app = app_instance(ac, App)
+                ac_entries = []
                 for sm in app.main_menu():
                     entry = sm.bind_app(app)
                     entry.tool_name = ac.tool_name
@@ -639,25 +713,29 @@ def sitemap(self, excluded_tools=None, included_tools=None,
                             delta_ordinal
                     if self.is_nbhd_project and entry.label == 'Admin':
                         entry.matching_urls.append('%s_admin/' % self.url())
-                    if ordinal > max_ordinal:
-                        max_ordinal = ordinal
-                    entries.append({'ordinal': ordinal, 'entry': entry})
-                    tool_counts.update({ac.tool_name: 1})
-
-        if (not tools_only and
-                self == self.neighborhood.neighborhood_project and
-                h.has_access(self.neighborhood, 'admin')):
-            entries.append({
-                'ordinal': max_ordinal + 1,
-                'entry': SitemapEntry(
-                    'Moderate',
-                    "%s_moderate/" % self.neighborhood.url(),
-                    ui_icon="tool-admin")
-                })
-            max_ordinal += 1
-
-        entries = sorted(entries, key=lambda e: e['ordinal'])
-        return [e['entry'] for e in entries]
+                    ac_entries.append({'ordinal': ordinal, 'entry': entry})
+                tool_entries.append((ac._id, ac.tool_name, ac_entries))
+            entries = (subproject_entries, tool_entries)
+            if cache is not None:
+                cache.set(entries_key, entries)
+
+        if visible is None:
+            visible = frozenset(ac._id for ac, App in app_classes if app_instance(ac, App).is_visible_to(c.user))
+            if cache is not None:
+                cache.set(visible_key, visible)
+
+        return entries + (visible,)
+
+    def nav_hash(self, app_configs, subprojects):
+        """Return a hash of everything the navbar entries of this project (see
+        :meth:`_nav_entries`), and whether they can be seen, depend on."""
+        data = dict(
+            project=[self._id, self.url(), self.is_nbhd_project, self.neighborhood.anchored_tools],
+            acls=[p.acl for p in self.parent_iter()] + [self.neighborhood.acl],
+            subprojects=[[sub._id, sub.name, sub.url(), sub.ordinal] for sub in subprojects],
+            tools=[[ac._id, ac.tool_name, ac.options, ac.acl] for ac in app_configs],
+        )
+        return hashlib.sha1(json.dumps(data, sort_keys=True, default=str)).hexdigest()
 
     def install_anchored_tools(self):
         anchored_tools = self.neighborhood.get_anchored_tools()
@@ -744,7 +822,7 @@ def grouped_navbar_entries(self):
             else:
                 # tool of a type we don't have in the navbar yet
                 if tool_name not in grouped_nav:
-                    child = deepcopy(e)
+                    child = e.copy()
                     # change label to be the tool name (type)
                     e.label = g.entry_points['tool'][
                         tool_name].tool_label + u' \u25be'
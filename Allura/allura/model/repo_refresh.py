@@ -15,7 +15,10 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import os
 import logging
+import binascii
+import multiprocessing
 from itertools import chain
 from cPickle import dumps
 from collections import OrderedDict
@@ -24,11 +27,13 @@
 
 import tg
 import jinja2
-from paste.deploy.converters import asint
+from paste.deploy.converters import asint, asbool
 from pylons import tmpl_context as c, app_globals as g
 
+from ming import mim
 from ming.base import Object
 from ming.orm import mapper, session, ThreadLocalORMSession
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 from allura.lib import utils
 from allura.lib import helpers as h
@@ -65,21 +70,29 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False, commits_
     log.info('Refreshing %d commits on %s', len(commit_ids), repo.full_fs_path)
 
     # Refresh commits
-    seen = set()
-    for i, oid in enumerate(commit_ids):
-        repo.refresh_commit_info(oid, seen, not all_commits)
-        if (i + 1) % 100 == 0:
-            log.info('Refresh commit info %d: %s', (i + 1), oid)
+    processes = asint(tg.config.get('scm.refresh.processes', 1))
+    if processes > 1 and len(commit_ids) >= asint(tg.config.get('scm.refresh.parallel_threshold', 1000)):
+        refresh_commits_parallel(repo, commit_ids, not all_commits, processes)
+    else:
+        refresh_commits(repo, commit_ids, not all_commits)
 
-    refresh_commit_repos(all_commit_ids, repo)
+    writer = BulkWriter()
+    refresh_commit_repos(all_commit_ids, repo, writer)
 
     # Refresh child references
-    for i, oid in enumerate(commit_ids):
-        ci = CommitDoc.m.find(dict(_id=oid), validate=False).next()
-        refresh_children(ci)
-        if (i + 1) % 100 == 0:
-            log.info('Refresh child info %d for parents of %s',
-                     (i + 1), ci._id)
+    for i, oids in enumerate(utils.chunked_iter(commit_ids, QSIZE)):
+        for ci in CommitDoc.m.find(dict(_id={'$in': list(oids)}), validate=False):
+            refresh_children(ci, writer)
+        log.info('Refresh child info %d', (i + 1) * QSIZE)
+    writer.flush()
+
+    # Build last commit data for the directories changed by the most recent
+    # new commits, so browsing them doesn't have to.  Not for a new clone,
+    # older history is left to be built when it's viewed
+    if (repo._refresh_precompute and not new_clone
+            and asbool(tg.config.get('scm.refresh.last_commits', True))):
+        limit = asint(tg.config.get('scm.refresh.last_commits.limit', 100))
+        refresh_last_commits(repo, commit_ids[:limit])
 
     # Clear any existing caches for branches/tags
     if repo.cached_branches:
@@ -128,15 +141,127 @@ def refresh_repo(repo, all_commits=False, notify=True, new_clone=False, commits_
         send_notifications(repo, reversed(commit_ids))
 
 
-def refresh_commit_repos(all_commit_ids, repo):
+def refresh_commits(repo, commit_ids, lazy=True, seen=None, writer=None):
+    '''Refresh the commit and tree info for the given commits'''
+    if seen is None:
+        seen = set()
+    if writer is None:
+        writer = BulkWriter()
+    repo._impl.bulk_writer = writer
+    try:
+        for i, oid in enumerate(commit_ids):
+            repo.refresh_commit_info(oid, seen, lazy)
+            if (i + 1) % 100 == 0:
+                log.info('Refresh commit info %d: %s', (i + 1), oid)
+        writer.flush()
+    finally:
+        repo._impl.bulk_writer = None
+
+
+def refresh_commits_parallel(repo, commit_ids, lazy, processes):
+    '''Refresh the commit and tree info for the given commits, split up
+    between several forked processes.
+
+    Each process gets a contiguous run of commits, since neighbouring commits
+    share most of their trees.  A :class:`SharedTreeFilter` lets the
+    processes skip trees another one has already saved.  Since commits are
+    written after their trees, and trees are only shared once written, a
+    process that dies doesn't leave commits with missing trees behind.
+    '''
+    seen = SharedTreeFilter(asint(tg.config.get('scm.refresh.shared_trees', 1 << 20)))
+    chunk_size = -(-len(commit_ids) // processes)
+    procs = []
+    for i in range(0, len(commit_ids), chunk_size):
+        p = multiprocessing.Process(
+            target=_refresh_commits_worker,
+            args=(repo, commit_ids[i:i + chunk_size], lazy, seen))
+        p.start()
+        procs.append(p)
+    log.info('Refreshing %d commits in %d processes', len(commit_ids), len(procs))
+    for p in procs:
+        p.join()
+    failed = [p for p in procs if p.exitcode != 0]
+    if failed:
+        raise RuntimeError('%d of %d commit refresh processes failed' % (len(failed), len(procs)))
+
+
+def _refresh_commits_worker(repo, commit_ids, lazy, seen):
+    # drop the implementation inherited from the parent, so this process
+    # doesn't share its git subprocesses
+    repo.__dict__.pop('_impl', None)
+    try:
+        refresh_commits(repo, commit_ids, lazy, seen, BulkWriter(on_flush=seen.publish))
+    except Exception:
+        log.exception('Error refreshing commits %s..%s', commit_ids[0], commit_ids[-1])
+        raise
+
+
+class SharedTreeFilter(object):
+
+    '''A set of tree ids in shared memory, used as the ``seen`` set when
+    commits are refreshed by several processes.
+
+    Ids added by a process are only seen by the others once it calls
+    :meth:`publish`, which it should do after the trees have been written to
+    mongo: until then the process could still die without saving them.
+
+    Ids are stored in an open addressing hash table of ``size`` slots.  Once
+    the table fills up new ids aren't remembered, which only means that a
+    tree may be saved more than once.
+    '''
+
+    max_probes = 32
+
+    def __init__(self, size):
+        self.size = size
+        self._slots = multiprocessing.RawArray('c', size * 20)
+        self._lock = multiprocessing.Lock()
+        # ids added but not published yet; every forked process has its own
+        self._pending = set()
+
+    def __contains__(self, tree_id):
+        if tree_id in self._pending:
+            return True
+        with self._lock:
+            return self._find(tree_id)[0]
+
+    def add(self, tree_id):
+        self._pending.add(tree_id)
+
+    def publish(self):
+        '''Share the ids added by this process with the others'''
+        with self._lock:
+            for tree_id in self._pending:
+                found, offset = self._find(tree_id)
+                if not found and offset is not None:
+                    self._slots[offset:offset + 20] = binascii.unhexlify(tree_id)
+        self._pending.clear()
+
+    def _find(self, tree_id):
+        '''Return (found, offset) where offset is that of the id, or of the
+        empty slot where it would go'''
+        binsha = binascii.unhexlify(tree_id)
+        start = int(tree_id[:8], 16)
+        for i in xrange(min(self.max_probes, self.size)):
+            offset = (start + i) % self.size * 20
+            slot = self._slots[offset:offset + 20]
+            if slot == binsha:
+                return True, offset
+            if slot == '\0' * 20:
+                return False, offset
+        return False, None
+
+
+def refresh_commit_repos(all_commit_ids, repo, writer=None):
     '''Refresh the list of repositories within which a set of commits are
     contained'''
+    if writer is None:
+        writer = BulkWriter()
     for oids in utils.chunked_iter(all_commit_ids, QSIZE):
         for ci in CommitDoc.m.find(dict(
                 _id={'$in': list(oids)},
                 repo_ids={'$ne': repo._id})):
             oid = ci._id
-            ci.repo_ids.append(repo._id)
             index_id = 'allura.model.repository.Commit#' + oid
             ref = ArtifactReferenceDoc(dict(
                 _id=index_id,
@@ -161,18 +286,180 @@ def refresh_commit_repos(all_commit_ids, repo):
                 app_config_id=repo.app.config._id,
                 link=oid,
                 url=repo.url_for_commit(oid)))
-            ci.m.save(safe=False, validate=False)
-            ref.m.save(safe=False, validate=False)
-            link0.m.save(safe=False, validate=False)
-            link1.m.save(safe=False, validate=False)
+            writer.update(CommitDoc, dict(_id=oid), {'$addToSet': dict(repo_ids=repo._id)})
+            writer.save(ref)
+            writer.insert(link0)
+            writer.insert(link1)
+    writer.flush()
 
 
-def refresh_children(ci):
+def refresh_children(ci, writer=None):
     '''Refresh the list of children of the given commit'''
-    CommitDoc.m.update_partial(
-        dict(_id={'$in': ci.parent_ids}),
-        {'$addToSet': dict(child_ids=ci._id)},
-        multi=True)
+    if writer is None:
+        CommitDoc.m.update_partial(
+            dict(_id={'$in': ci.parent_ids}),
+            {'$addToSet': dict(child_ids=ci._id)},
+            multi=True)
+    else:
+        writer.update(
+            CommitDoc,
+            dict(_id={'$in': ci.parent_ids}),
+            {'$addToSet': dict(child_ids=ci._id)},
+            multi=True)
+
+
+class BulkWriter(object):
+
+    '''Queue up writes of commit, tree and index documents and send them to
+    mongo in unordered bulk operations, rather than one round trip per
+    document.
+
+    Writes are grouped by collection and all of them are sent every
+    ``batch_size`` operations (``scm.refresh.bulk_batch_size``, default 1000)
+    or when :meth:`flush` is called.  Commits are always written after
+    everything else, so as long as a commit is queued after its trees a
+    commit is never in mongo without them.  Anything that reads back what
+    was queued must flush first.  Duplicate key errors on inserts are
+    ignored, matching the ``safe=False`` writes this replaces.
+
+    ``on_flush``, if given, is called after everything queued so far has
+    been written.
+    '''
+
+    def __init__(self, batch_size=None, on_flush=None):
+        if batch_size is None:
+            batch_size = asint(tg.config.get('scm.refresh.bulk_batch_size', 1000))
+        self.batch_size = max(batch_size, 1)
+        self.on_flush = on_flush
+        self._ops = OrderedDict()
+        self._pending = 0
+
+    def save(self, doc):
+        '''Insert the document, or replace the existing one with the same _id'''
+        self._add(type(doc).m.collection, ('save', doc.m.schema.validate(doc)))
+
+    def insert(self, doc):
+        self._add(type(doc).m.collection, ('insert', doc.m.schema.validate(doc)))
+
+    def update(self, cls, spec, updates, multi=False):
+        self._add(cls.m.collection, ('update', spec, updates, multi))
+
+    def flush(self):
+        commits = CommitDoc.m.collection.name
+        for name, (collection, ops) in sorted(self._ops.items(), key=lambda item: item[0] == commits):
+            self._execute(collection, ops)
+        self._pending = 0
+        if self.on_flush:
+            self.on_flush()
+
+    def _add(self, collection, op):
+        collection, ops = self._ops.setdefault(collection.name, (collection, []))
+        ops.append(op)
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+
+    def _execute(self, collection, ops):
+        if not ops:
+            return
+        if isinstance(collection, mim.Collection):
+            # mim doesn't support bulk operations, write them one at a time
+            for op in ops:
+                self._execute_one(collection, op)
+        else:
+            bulk = collection.initialize_unordered_bulk_op()
+            for op in ops:
+                if op[0] == 'save':
+                    bulk.find(dict(_id=op[1]['_id'])).upsert().replace_one(op[1])
+                elif op[0] == 'insert':
+                    bulk.insert(op[1])
+                elif op[3]:
+                    bulk.find(op[1]).update(op[2])
+                else:
+                    bulk.find(op[1]).update_one(op[2])
+            try:
+                bulk.execute()
+            except BulkWriteError as e:
+                errors = [err for err in e.details['writeErrors'] if err['code'] != 11000]
+                if errors:
+                    log.error('%d errors writing to %s, first: %r',
+                              len(errors), collection.full_name, errors[0])
+        del ops[:]
+
+    def _execute_one(self, collection, op):
+        if op[0] == 'save':
+            collection.save(op[1])
+        elif op[0] == 'insert':
+            try:
+                collection.insert(op[1])
+            except DuplicateKeyError:
+                pass
+        else:
+            collection.update(op[1], op[2], multi=op[3])
+
+
+def refresh_last_commits(repo, commit_ids):
+    '''Build the LastCommit docs for the directories changed by the given
+    commits (newest first, as returned by all_commit_ids)'''
+    builder = LastCommitBuilder(repo)
+    for i, oid in enumerate(reversed(commit_ids)):
+        commit = Commit.query.get(_id=oid)
+        if commit is None:
+            continue
+        builder.refresh(commit)
+        if (i + 1) % 100 == 0:
+            log.info('Refresh last commit info %d: %s', (i + 1), oid)
+    session(LastCommit).flush()
+
+
+class LastCommitBuilder(object):
+
+    '''Builds the LastCommit docs for every directory changed by a series
+    of commits, which must be given oldest first.
+
+    Along a run of commits where each is the child of the one before, the
+    previous LCD of a path is known without asking the SCM, so each new LCD
+    is just the previous one updated with the changed entries.
+    '''
+
+    def __init__(self, repo, model_cache=None):
+        self.repo = repo
+        self.model_cache = model_cache or ModelCache(
+            max_instances={LastCommit: 4000},
+            max_queries={LastCommit: 4000},
+        )
+        self.lcids = {}  # path -> id of the last commit that changed it
+        self.prev_commit_id = None
+
+    def refresh(self, commit):
+        commit.set_context(self.repo)
+        if commit.parent_ids != [self.prev_commit_id]:
+            # on another branch, paths may have changed since
+            self.lcids = {}
+        self.prev_commit_id = None
+        try:
+            with h.push_config(c, model_cache=self.model_cache, lcid_cache=self.lcids):
+                if '' in commit.changed_paths:
+                    self._refresh_tree(commit.tree)
+        except Exception:
+            log.exception('Error building last commit data for %s', commit._id)
+            self.lcids = {}
+            return
+        self.prev_commit_id = commit._id
+
+    def _refresh_tree(self, tree):
+        commit = tree.commit
+        path = tree.path().strip('/')
+        if self.model_cache.get(LastCommit, dict(path=path, commit_id=commit._id)) is None:
+            LastCommit._build(tree)
+        for node in tree.tree_ids:
+            if os.path.join(path, node.name) in commit.changed_paths:
+                try:
+                    subtree = tree[node.name]
+                except KeyError:
+                    continue
+                self._refresh_tree(subtree)
+        self.lcids[path] = commit._id
 
 
 def unknown_commit_ids(all_commit_ids):
@@ -203,6 +490,8 @@ def send_notifications(repo, commit_ids):
         index = dict(
             (doc._id, doc)
             for doc in Commit.query.find(dict(_id={'$in': chunk})))
+        messages = [index[oid].message for oid in chunk if index[oid].message]
+        summaries = iter(g.markdown_commit.convert_many(messages))
         for oid in chunk:
             ci = index[oid]
             href = repo.url_for_commit(oid)
@@ -217,7 +506,7 @@ def send_notifications(repo, commit_ids):
                 link=href,
                 unique_id=href)
 
-            summary = g.markdown_commit.convert(ci.message) if ci.message else ""
+            summary = next(summaries) if ci.message else ""
             current_branch = repo.symbolics_for_commit(ci)[0]  # only the head of a branch will have this
             commit_msgs.append(dict(
                 author=ci.authored.name,
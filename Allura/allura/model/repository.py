@@ -101,6 +101,10 @@
 
 class RepositoryImplementation(object):
 
+    # set by refresh_repo to a repo_refresh.BulkWriter while commits are
+    # being refreshed, so commit and tree docs can be saved in batches
+    bulk_writer = None
+
     # Repository-specific code
     def init(self):  # pragma no cover
         raise NotImplementedError('init')
@@ -16,10 +16,15 @@
 #       under the License.
 
 import logging
+import hashlib
 import pymongo
 from collections import defaultdict
 
+from tg import config
+from paste.deploy.converters import asbool, asint
+
 from ming import Session
+from ming.orm import mapper
 from ming.orm.base import state
 from ming.orm.ormsession import ThreadLocalORMSession, SessionExtension
 from contextlib import contextmanager
@@ -36,6 +41,39 @@ def _needs_update(o):
     return o.should_update_index(old, new)
 
 
+_markdown_fields = {}
+
+
+def _update_markdown_hashes(o):
+    '''
+    For each markdown field of o with a ``<field>_cache``
+    :class:`~allura.model.types.MarkdownCache`, store the md5 of the source
+    being written, dropping any html cached for a different source.  This lets
+    :meth:`~allura.lib.app_globals.ForgeMarkdown.cached_convert` skip hashing
+    the source of objects read back from the database, so code that writes a
+    source field directly to mongo must also clear its ``<field>_cache.md5``.
+    '''
+    from .types import MarkdownCache
+    cls = type(o)
+    if cls not in _markdown_fields:
+        props = dict((p.name, p) for p in mapper(cls).all_properties())
+        _markdown_fields[cls] = [
+            name[:-len('_cache')] for name, p in props.iteritems()
+            if name.endswith('_cache') and name[:-len('_cache')] in props
+            and isinstance(getattr(getattr(p, 'field', None), 'schema', None), MarkdownCache)]
+    for field_name in _markdown_fields[cls]:
+        source = getattr(o, field_name, None)
+        cache = getattr(o, field_name + '_cache', None)
+        if source is None or cache is None:
+            continue
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        md5 = hashlib.md5(source).hexdigest()
+        if cache.md5 != md5 or getattr(cache, 'fix7528', None) != MarkdownCache.bugfix_rev:
+            cache.md5, cache.html, cache.render_time = md5, None, None
+            cache.fix7528 = MarkdownCache.bugfix_rev
+
+
 class ManagedSessionExtension(SessionExtension):
 
     def __init__(self, session):
@@ -57,6 +95,8 @@ def before_flush(self, obj=None):
                 self.objects_modified = [obj]
             elif st.status == st.deleted:
                 self.objects_deleted = [obj]
+        for o in self.objects_added + self.objects_modified:
+            _update_markdown_hashes(o)
 
     def after_flush(self, obj=None):
         self.objects_added = []
@@ -137,12 +177,25 @@ def after_flush(self, obj=None):
 
     def update_index(self, objects_deleted, arefs):
         # Post delete and add indexing operations
+        if asbool(config.get('solr.index_buffer', False)):
+            self._buffer_index(objects_deleted, arefs)
+            return
         if objects_deleted:
             index_tasks.del_artifacts.post(
                 [obj.index_id() for obj in objects_deleted])
         if arefs:
             index_tasks.add_artifacts.post([aref._id for aref in arefs])
 
+    def _buffer_index(self, objects_deleted, arefs):
+        from .index import IndexBuffer
+        if objects_deleted:
+            IndexBuffer.delete([obj.index_id() for obj in objects_deleted])
+        if arefs:
+            IndexBuffer.add([aref._id for aref in arefs])
+        if objects_deleted or arefs:
+            window = asint(config.get('solr.index_buffer.window', 5))
+            index_tasks.flush_index_buffer.post(delay=window)
+
 
 class BatchIndexer(ArtifactSessionExtension):
 
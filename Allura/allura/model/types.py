@@ -23,6 +23,9 @@
 
 class MarkdownCache(S.Object):
 
+    # increment this if we need all caches to invalidated (e.g. xss in markdown rendering fixed)
+    bugfix_rev = 4
+
     def __init__(self, **kw):
         super(MarkdownCache, self).__init__(
             fields=dict(
@@ -111,4 +114,83 @@ def clear_reason(ace):
             if clear_reason(a) == ace_without_reason:
                 return a
 
+    _compiled = {}
+    _compiled_max = 10000
+
+    @classmethod
+    def compile(cls, acl):
+        """Return a :class:`CompiledACL` for acl.
+
+        Compiled ACLs are cached by their contents, so objects with identical ACLs share one, and changes to an ACL
+        are picked up on the next call.
+        """
+        key = tuple((ace.access, ace.role_id, ace.permission) for ace in acl)
+        compiled = cls._compiled.get(key)
+        if compiled is None:
+            if len(cls._compiled) >= cls._compiled_max:
+                cls._compiled.clear()
+            compiled = cls._compiled[key] = CompiledACL(key)
+        return compiled
+
+
+class CompiledACL(object):
+    '''
+    Per-permission index of an ACL, so that checking a set of roles against it doesn't have to scan the ACL for each
+    role.  Get one with :meth:`ACL.compile`.
+
+    :param aces: sequence of ``(access, role_id, permission)`` tuples, in ACL order
+    '''
+
+    def __init__(self, aces):
+        self.aces = aces
+        self.index = {}
+
+    def compile(self, permission):
+        '''
+        :returns: a tuple ``(allow_ids, deny_ids, default, exact_deny_ids)``.  ``allow_ids`` and ``deny_ids`` are the
+                  roles whose first matching ACE (see :meth:`ACE.match`) allows or denies permission, ``default`` is the
+                  access for all other roles (from an :data:`EVERYONE` ACE, or None if there is no match), and
+                  ``exact_deny_ids`` are the roles with an ACE denying exactly this permission.
+        '''
+        result = self.index.get(permission)
+        if result is not None:
+            return result
+        allow_ids, deny_ids, exact_deny_ids = set(), set(), set()
+        default = None
+        for access, role_id, perm in self.aces:
+            if access == ACE.DENY and perm == permission:
+                exact_deny_ids.add(role_id)
+            if default is not None or perm not in (permission, ALL_PERMISSIONS):
+                continue
+            if role_id == EVERYONE:
+                default = access
+            elif role_id not in allow_ids and role_id not in deny_ids:
+                (allow_ids if access == ACE.ALLOW else deny_ids).add(role_id)
+        result = self.index[permission] = (allow_ids, deny_ids, default, exact_deny_ids)
+        return result
+
+    def denies(self, role_ids, permission):
+        '''Whether there is an ACE denying exactly this permission to one of role_ids'''
+        exact_deny_ids = self.compile(permission)[3]
+        return any(rid in exact_deny_ids for rid in role_ids)
+
+    def check(self, role_ids, permission):
+        '''
+        :returns: a tuple ``(allowed, chainable_ids)``.  ``allowed`` is True if the first matching ACE for any of
+                  role_ids allows permission.  Otherwise ``chainable_ids`` lists (in order) the role_ids with no
+                  matching ACE at all, which may be checked against a parent security context.
+        '''
+        allow_ids, deny_ids, default, exact_deny_ids = self.compile(permission)
+        chainable_ids = []
+        for rid in role_ids:
+            if rid in allow_ids:
+                return True, []
+            if rid in deny_ids:
+                continue
+            if default == ACE.ALLOW:
+                return True, []
+            if default is None:
+                chainable_ids.append(rid)
+        return False, chainable_ids
+
 DENY_ALL = ACE.deny(EVERYONE, ALL_PERMISSIONS)
@@ -0,0 +1,86 @@
+#       Licensed to the Apache Software Foundation (ASF) under one
+#       or more contributor license agreements.  See the NOTICE file
+#       distributed with this work for additional information
+#       regarding copyright ownership.  The ASF licenses this file
+#       to you under the Apache License, Version 2.0 (the
+#       "License"); you may not use this file except in compliance
+#       with the License.  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#       Unless required by applicable law or agreed to in writing,
+#       software distributed under the License is distributed on an
+#       "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+#       KIND, either express or implied.  See the License for the
+#       specific language governing permissions and limitations
+#       under the License.
+
+import argparse
+import logging
+
+from ming.orm import Mapper
+from tg import config
+from paste.deploy.converters import asint
+
+from allura.scripts import ScriptTask
+from allura import model as M
+
+
+log = logging.getLogger(__name__)
+
+
+class CompactSnapshots(ScriptTask):
+
+    @classmethod
+    def execute(cls, options):
+        interval = options.keyframe_interval
+        if interval is None:
+            interval = asint(config.get('snapshot.keyframe_interval', 0))
+        if not interval:
+            log.error('No keyframe interval given or set in snapshot.keyframe_interval')
+            return
+        for history_class in cls.history_classes(options.collection):
+            log.info('Compacting %s', history_class.__mongometa__.name)
+            changed = 0
+            for artifact_class in history_class.query.find().distinct('artifact_class'):
+                ids = history_class.query.find({'artifact_class': artifact_class}).distinct('artifact_id')
+                for artifact_id in ids:
+                    changed += history_class.compact(artifact_id, artifact_class, interval)
+                    M.artifact_orm_session.clear()
+            log.info('Rewrote %s snapshots in %s', changed, history_class.__mongometa__.name)
+
+    @classmethod
+    def history_classes(cls, collections=None):
+        seen = set()
+        for m in Mapper.all_mappers():
+            hc = m.mapped_class
+            if not issubclass(hc, M.Snapshot):
+                continue
+            name = hc.__mongometa__.name
+            if name in seen or (collections and name not in collections):
+                continue
+            seen.add(name)
+            yield hc
+
+    @classmethod
+    def parser(cls):
+        parser = argparse.ArgumentParser(
+            description='Store artifact history as deltas against the next version, '
+                        'keeping full copies of every Nth version and the latest one')
+        parser.add_argument(
+            '-i', '--keyframe-interval',
+            type=int,
+            dest='keyframe_interval',
+            default=None,
+            help='Keep every Nth version in full. Defaults to snapshot.keyframe_interval; '
+                 'use 1 to expand all history back to full copies')
+        parser.add_argument(
+            '-c', '--collection',
+            action='append',
+            dest='collection',
+            help='Only compact these history collections, e.g. page_history')
+        return parser
+
+
+if __name__ == '__main__':
+    CompactSnapshots.main()
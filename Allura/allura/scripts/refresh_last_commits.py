@@ -26,6 +26,7 @@
 
 from allura import model as M
 from allura.lib.utils import chunked_find
+from allura.model.repo_refresh import LastCommitBuilder
 from allura.tasks.repo_tasks import refresh
 from allura.scripts import ScriptTask
 
@@ -139,6 +140,7 @@ def refresh_repo_lcds(cls, commit_ids, options):
             max_queries={M.repository.LastCommit: 4000},
         )
         c.model_cache = model_cache
+        builder = LastCommitBuilder(c.app.repo, model_cache)
         timings = []
         print 'Processing last commits'
         for i, commit_id in enumerate(commit_ids):
@@ -146,10 +148,8 @@ def refresh_repo_lcds(cls, commit_ids, options):
             if commit is None:
                 print "Commit missing, skipping: %s" % commit_id
                 continue
-            commit.set_context(c.app.repo)
             with time(timings):
-                tree = commit.tree
-                cls._get_lcds(tree, model_cache)
+                builder.refresh(commit)
                 ThreadLocalORMSession.flush_all()
             if i % 100 == 0:
                 cls._print_stats(i, timings, 100)
@@ -157,21 +157,6 @@ def refresh_repo_lcds(cls, commit_ids, options):
                 break
         ThreadLocalORMSession.flush_all()
 
-    @classmethod
-    def _get_lcds(cls, tree, cache):
-        M.repository.LastCommit.get(tree)
-        """
-        FIXME: if its needed to recurse into subdirectories, and compute their LCDs as well, something along these
-        lines should be enabled.  This is not working as-is, and is not really necessary as this script doesn't
-        get used any more anyway.
-
-        for subtree in tree.tree_ids:
-            if subtree.name in tree.commit.changed_paths:
-                subtree_doc = cache.get(M.repository.Tree, dict(_id=subtree.id))
-                subtree_doc.set_context(tree)
-                cls._get_lcds(subtree_doc, cache)
-        """
-
     @classmethod
     def _clean(cls, commit_ids):
         # delete LastCommitDocs
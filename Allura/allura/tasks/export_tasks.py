@@ -17,16 +17,21 @@
 
 import os
 import os.path
+import copy
 import logging
 import shutil
+import threading
+import zipfile
+from multiprocessing.pool import ThreadPool
 
 import tg
 from pylons import app_globals as g, tmpl_context as c
+from paste.deploy.converters import asint
+from ming.orm import ThreadLocalORMSession
 
 from allura.tasks import mail_tasks
 from allura.lib.decorators import task
 from allura.lib import helpers as h
-from allura.model.repository import zipdir
 
 
 log = logging.getLogger(__name__)
@@ -49,9 +54,10 @@ class BulkExport(object):
 
     def process(self, project, tools, user, filename=None, send_email=True, with_attachments=False):
         export_filename = filename or project.bulk_export_filename()
+        export_name = os.path.splitext(export_filename)[0]  # e.g. test-backup-2018-06-26-210524 without the .zip
         tmp_path = os.path.join(
             project.bulk_export_path(rootdir=tg.config.get('bulk_export_tmpdir', tg.config['bulk_export_path'])),
-            os.path.splitext(export_filename)[0],  # e.g. test-backup-2018-06-26-210524 without the .zip
+            export_name,
         )
         export_path = project.bulk_export_path(rootdir=tg.config['bulk_export_path'])
         export_fullpath = os.path.join(export_path, export_filename)
@@ -61,10 +67,15 @@ def process(self, project, tools, user, filename=None, send_email=True, with_att
             os.makedirs(export_path)
         apps = [project.app_instance(tool) for tool in tools]
         exportable = self.filter_exportable(apps)
-        results = [self.export(tmp_path, app, with_attachments) for app in exportable]
+        # build it under another name, so nobody picks up a half written zip
+        partial_fullpath = export_fullpath + '.partial'
+        with zipfile.ZipFile(partial_fullpath, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+            results = self.export_all(tmp_path, exportable, with_attachments, zf, export_name)
         exported = self.filter_successful(results)
         if exported:
-            zipdir(tmp_path, export_fullpath)
+            os.rename(partial_fullpath, export_fullpath)
+        else:
+            os.remove(partial_fullpath)
         shutil.rmtree(tmp_path.encode('utf8'))  # must encode into bytes or it'll fail on non-ascii filenames
 
         if not user:
@@ -92,6 +103,74 @@ def process(self, project, tools, user, filename=None, send_email=True, with_att
                                             u'Bulk export for project %s completed' % project.shortname,
                                             tmpl.render(tmpl_context))
 
+    def export_all(self, export_path, apps, with_attachments, zf, zip_root):
+        '''
+        Export each app and add its files to the zip ``zf`` as soon as it is
+        done.  Up to ``bulk_export_threads`` apps are exported at once.
+        '''
+        lock = threading.Lock()
+
+        def export_app(app):
+            result = self.export(export_path, app, with_attachments)
+            try:
+                if result is not None:
+                    with lock:
+                        self.add_to_zip(zf, export_path, app, zip_root)
+            finally:
+                self.remove_app_files(export_path, app)
+            return result
+
+        num_threads = min(asint(tg.config.get('bulk_export_threads', 1)), len(apps))
+        if num_threads <= 1:
+            return [export_app(app) for app in apps]
+        pool = ThreadPool(num_threads)
+        try:
+            return pool.map(self.in_current_context(export_app), apps)
+        finally:
+            pool.close()
+
+    def in_current_context(self, func):
+        '''Wrap ``func`` to run in another thread with the current ``c`` and ``g``'''
+        proxies = []
+        for proxy in (c, g):
+            try:
+                proxies.append((proxy, proxy._current_obj()))
+            except TypeError:
+                pass  # nothing registered in this thread
+
+        def wrapper(*args):
+            for proxy, obj in proxies:
+                proxy._push_object(copy.copy(obj) if proxy is c else obj)
+            try:
+                return func(*args)
+            finally:
+                ThreadLocalORMSession.flush_all()
+                ThreadLocalORMSession.close_all()
+                for proxy, obj in reversed(proxies):
+                    proxy._pop_object()
+        return wrapper
+
+    def app_files(self, export_path, app):
+        tool = app.config.options.mount_point
+        return os.path.join(export_path, '%s.json' % tool), app.get_attachment_export_path(export_path)
+
+    def add_to_zip(self, zf, export_path, app, zip_root):
+        json_file, attachments_path = self.app_files(export_path, app)
+        zf.write(json_file, os.path.join(zip_root, os.path.relpath(json_file, export_path)))
+        # must encode into bytes or it'll fail on non-ascii filenames
+        export_path = export_path.encode('utf8')
+        for dirpath, dirnames, filenames in os.walk(attachments_path.encode('utf8')):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                arcname = os.path.relpath(path, export_path).decode('utf8', 'replace')
+                zf.write(path, os.path.join(zip_root, arcname))
+
+    def remove_app_files(self, export_path, app):
+        json_file, attachments_path = self.app_files(export_path, app)
+        if os.path.exists(json_file):
+            os.remove(json_file)
+        shutil.rmtree(attachments_path.encode('utf8'), ignore_errors=True)
+
     def filter_exportable(self, apps):
         return [app for app in apps if app and app.exportable]
 
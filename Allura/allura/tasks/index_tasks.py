@@ -21,6 +21,8 @@
 
 from pylons import app_globals as g
 from pylons import tmpl_context as c
+from tg import config
+from paste.deploy.converters import asint
 
 from allura.lib import helpers as h
 from allura.lib.decorators import task
@@ -42,8 +44,7 @@ def __add_objects(objects, solr_hosts=None):
 
 def __del_objects(object_solr_ids):
     solr_instance = __get_solr()
-    solr_query = 'id:({0})'.format(' || '.join(object_solr_ids))
-    solr_instance.delete(q=solr_query)
+    solr_instance.delete_by_ids(object_solr_ids)
 
 
 @task
@@ -89,8 +90,10 @@ def add_artifacts(ref_ids, update_solr=True, update_refs=True, solr_hosts=None):
                 artifact = ref.artifact
                 if artifact is None:
                     continue
-                # c.app is normally set, so keep using it.  During a reindex its not though, so set it from artifact
-                with h.push_config(c, app=getattr(c, 'app', None) or artifact.app):
+                # c.app is normally set, so keep using it.  During a reindex or an index buffer flush
+                # it's not though, so set it from artifact.  Relative shortlinks need c.project too
+                with h.push_config(c, project=getattr(c, 'project', None) or artifact.project,
+                                   app=getattr(c, 'app', None) or artifact.app):
                     s = artifact.solarize()
                     if s is None:
                         continue
@@ -124,12 +127,48 @@ def del_artifacts(ref_ids):
         M.Shortlink.query.remove(dict(ref_id={'$in': ref_ids}))
 
 
+# coalesce site-wide, not per project/app: one pending flush is enough.  A retry
+# is kept separate, so it isn't merged into a flush that's due sooner
+@task(coalesce=lambda retry=False: (retry,))
+def flush_index_buffer(retry=False):
+    '''
+    Send the index updates accumulated in :class:`allura.model.index.IndexBuffer`
+    to solr, de-duplicated, in as few requests as possible.
+
+    If that fails they stay buffered, and a retry is posted to run after
+    ``solr.index_buffer.retry_delay`` seconds.  Flushes posted for new updates
+    meanwhile still run when they're due, and send the failed ones too.
+    '''
+    from allura import model as M
+    batch_size = asint(config.get('solr.index_buffer.batch_size', 1000))
+    docs = M.IndexBuffer.pending(limit=batch_size)
+    if not docs:
+        return
+    to_add, to_delete = M.IndexBuffer.merge(docs)
+    try:
+        # artifacts come from many projects, don't use the context
+        # of whichever flush happened to post this task
+        with h.push_config(c, project=None, app=None):
+            if to_delete:
+                del_artifacts(list(to_delete))
+            if to_add:
+                add_artifacts(list(to_add))
+    except Exception:
+        # keep the updates buffered so they aren't lost, and try again later
+        flush_index_buffer.post(retry=True, delay=asint(config.get('solr.index_buffer.retry_delay', 60)))
+        raise
+    M.IndexBuffer.remove(docs)
+    if len(docs) == batch_size:
+        # there may be more waiting
+        flush_index_buffer.post()
+
+
 @task
 def solr_del_project_artifacts(project_id):
     g.solr.delete(q='project_id_s:%s' % project_id)
 
 
-@task
+@task(coalesce=True)
 def commit():
     g.solr.commit()
 
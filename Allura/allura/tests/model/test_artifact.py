@@ -24,11 +24,12 @@
 from datetime import datetime
 
 from pylons import tmpl_context as c
+from tg import config
 from nose.tools import assert_raises, assert_equal
 from nose import with_setup
 from mock import patch
 from ming.orm.ormsession import ThreadLocalORMSession
-from ming.orm import Mapper
+from ming.orm import Mapper, state
 from bson import ObjectId
 from webob import Request
 
@@ -190,6 +191,37 @@ def test_versioning():
     assert pg.history().count() == 3
 
 
+@with_setup(setUp, tearDown)
+def test_versioning_deltas():
+    texts = ['line %s\n' % i * 20 for i in range(7)]
+    texts[2] = 'completely different'
+    pg = WM.Page(title='TestPage4')
+    with h.push_config(config, **{'snapshot.keyframe_interval': '3'}):
+        for text in texts:
+            pg.text = text
+            pg.commit()
+            ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    docs = WM.PageHistory.query.find({'artifact_id': pg._id}).sort('version').all()
+    stored = [(ss.version, state(ss).document.get('data') is not None) for ss in docs]
+    assert_equal(stored, [(1, False), (2, False), (3, True), (4, False), (5, False), (6, True), (7, True)])
+    ThreadLocalORMSession.close_all()
+    pg = WM.Page.query.get(title='TestPage4')
+    for version, text in enumerate(texts, 1):
+        assert_equal(pg.get_version(version).text, text)
+    pg.revert(1)
+    assert_equal(pg.text, texts[0])
+
+    ThreadLocalORMSession.close_all()
+    assert_equal(WM.PageHistory.compact(pg._id, docs[0].artifact_class, 1), 4)
+    assert_equal(WM.PageHistory.query.find({'artifact_id': pg._id, 'data': None}).count(), 0)
+    ThreadLocalORMSession.close_all()
+    assert_equal(WM.PageHistory.compact(pg._id, docs[0].artifact_class, 2), 3)
+    ThreadLocalORMSession.close_all()
+    pg = WM.Page.query.get(title='TestPage4')
+    assert_equal([ss.text for ss in pg.history()], texts[::-1])
+
+
 @with_setup(setUp, tearDown)
 def test_messages_unknown_lookup():
     from bson import ObjectId
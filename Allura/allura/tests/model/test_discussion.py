@@ -25,7 +25,7 @@
 from datetime import datetime, timedelta
 from cgi import FieldStorage
 
-from pylons import tmpl_context as c
+from pylons import tmpl_context as c, app_globals as g
 from nose.tools import assert_equals, with_setup
 import mock
 from mock import patch
@@ -170,6 +170,18 @@ def test_post_methods():
     assert t.num_replies == 1
 
 
+@with_setup(setUp, tearDown)
+def test_thread_render_posts():
+    d = M.Discussion(shortname='test', name='test')
+    t = M.Thread.new(discussion_id=d._id, subject='Test Thread')
+    posts = [t.post('This is a *post*'), t.post('[[include ref=Home]]')]
+    assert_equals(t.render_posts(posts), posts)
+    assert_equals(posts[0].html_text, g.markdown.cached_convert(posts[0], 'text'))
+    assert_in('<em>post</em>', posts[0].html_text)
+    del posts[0].__dict__['_html_text']
+    assert_in('<em>post</em>', posts[0].html_text)
+
+
 @with_setup(setUp, tearDown)
 def test_attachment_methods():
     d = M.Discussion(shortname='test', name='test')
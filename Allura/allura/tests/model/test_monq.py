@@ -16,7 +16,10 @@
 #       under the License.
 
 import pprint
-from nose.tools import with_setup
+from datetime import datetime, timedelta
+from nose.tools import with_setup, assert_equal
+from mock import patch, MagicMock
+from tg import config
 
 from ming.orm import ThreadLocalORMSession
 
@@ -40,3 +43,110 @@ def test_basic_task():
     assert task
     task()
     assert task.result == 'I[5, 6]', task.result
+
+
+@with_setup(setUp)
+@patch.dict(config, {'monq.signal': 'true'})
+@patch.object(M.TaskSignal, 'send')
+def test_post_sends_signal(send):
+    M.MonQTask.post(pprint.pformat, ([5, 6],))
+    send.assert_called_once_with('pprint.pformat')
+    send.reset_mock()
+    M.MonQTask.post(pprint.pformat, ([5, 6],), delay=60)
+    assert not send.called
+
+
+@with_setup(setUp)
+@patch.object(M.TaskSignal, 'send')
+def test_post_no_signal_when_disabled(send):
+    M.MonQTask.post(pprint.pformat, ([5, 6],))
+    assert not send.called
+
+
+def test_task_signal_wait():
+    listener = M.TaskSignal(only=['allura.tasks.foo'])
+    listener.cursor = MagicMock(alive=True)
+    listener.cursor.__iter__.return_value = iter([
+        {'task_name': 'allura.tasks.bar'},
+        {'task_name': 'allura.tasks.foo'},
+    ])
+    assert listener.wait(5)
+
+    listener.cursor.__iter__.return_value = iter([
+        {'task_name': 'allura.tasks.bar'},
+    ])
+    assert not listener.wait(0.01)
+
+
+@patch.object(M.TaskSignal, '_ensured', set())
+@patch('allura.model.monq_model.session')
+def test_task_signal_collection_created_once(session):
+    db = session.return_value.impl.db
+    db.name = 'test'
+    M.TaskSignal.send('allura.tasks.foo')
+    M.TaskSignal.send('allura.tasks.foo')
+    assert_equal(db.create_collection.call_count, 1)
+    assert not db.collection_names.called
+    assert_equal(db['monq_task_signal'].insert.call_count, 3)  # first one keeps the tailable cursor alive
+
+
+@with_setup(setUp)
+def test_get_batch():
+    for i in range(5):
+        M.MonQTask.post(pprint.pformat, ([i],), priority=20 if i == 3 else 10)
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    batch = M.MonQTask.get_batch(3, process='worker1')
+    assert len(batch) == 3, batch
+    assert batch[0].args == [[3]], batch[0].args
+    assert all(t.state == 'busy' and t.process == 'worker1' for t in batch)
+    rest = M.MonQTask.get_batch(10, process='worker2')
+    assert len(rest) == 2, rest
+    assert not set(t._id for t in batch) & set(t._id for t in rest)
+    assert M.MonQTask.get_batch(10, process='worker3') == []
+
+
+@with_setup(setUp)
+def test_release_unstarted():
+    M.MonQTask.post(pprint.pformat, ([5, 6],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    batch = M.MonQTask.get_batch(5, process='worker1')
+    M.MonQTask.release_unstarted(batch)
+    ThreadLocalORMSession.close_all()
+    task = M.MonQTask.get()
+    assert task._id == batch[0]._id
+
+
+@with_setup(setUp)
+def test_timeout_claimed_tasks():
+    for i in range(2):
+        M.MonQTask.post(pprint.pformat, ([i],))
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    started, waiting = M.MonQTask.get_batch(2, process='worker1')
+    assert waiting.time_claim is not None
+    started.time_start = datetime.utcnow()
+    ThreadLocalORMSession.flush_all()
+    ThreadLocalORMSession.close_all()
+    M.MonQTask.timeout_tasks(datetime.utcnow() - timedelta(minutes=5))
+    assert_equal(M.MonQTask.query.find(dict(state='busy')).count(), 2)
+    M.MonQTask.timeout_tasks(datetime.utcnow() + timedelta(minutes=5))
+    ThreadLocalORMSession.close_all()
+    assert_equal(M.MonQTask.query.find(dict(state='ready')).count(), 2)
+
+
+@with_setup(setUp)
+def test_post_unique_key():
+    task1 = M.MonQTask.post(pprint.pformat, ([5, 6],), unique_key='foo', delay=60)
+    task2 = M.MonQTask.post(pprint.pformat, ([5, 6],), unique_key='foo')
+    task3 = M.MonQTask.post(pprint.pformat, ([5, 6],), unique_key='bar', delay=60)
+    assert task1._id == task2._id
+    assert task1._id != task3._id
+    ThreadLocalORMSession.close_all()
+    # merged post asked to run now, so the delay is dropped
+    assert M.MonQTask.get()._id == task1._id
+
+    # a running task doesn't absorb new posts
+    task4 = M.MonQTask.post(pprint.pformat, ([5, 6],), unique_key='foo')
+    assert task4._id != task1._id
@@ -20,7 +20,9 @@
 """
 Model tests for neighborhood
 """
-from nose.tools import with_setup
+from nose.tools import with_setup, assert_equal
+from mock import patch
+from ming.orm.ormsession import ThreadLocalORMSession
 
 from allura import model as M
 from allura.tests import decorators as td
@@ -89,3 +91,22 @@ def test_neighborhood():
 
     # Check properties
     assert neighborhood.shortname == "p"
+
+
+@with_setup(setUp)
+def test_by_url_prefix():
+    neighborhood = M.Neighborhood.query.get(name='Projects')
+    assert M.Neighborhood.by_url_prefix('/p/') is neighborhood
+    with patch.object(M.Neighborhood, 'query') as query:
+        # routes are cached, only the neighborhood itself is fetched
+        query.get.return_value = neighborhood
+        assert M.Neighborhood.by_url_prefix('/p/') is neighborhood
+        query.get.assert_called_once_with(_id=neighborhood._id)
+        assert M.Neighborhood.by_url_prefix('/auth/') is None
+        assert not query.find.called
+        assert_equal(query.get.call_count, 1)
+
+    neighborhood.url_prefix = '/projects/'
+    ThreadLocalORMSession.flush_all()
+    assert M.Neighborhood.by_url_prefix('/p/') is None
+    assert M.Neighborhood.by_url_prefix('/projects/') is neighborhood
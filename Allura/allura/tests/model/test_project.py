@@ -21,13 +21,14 @@
 Model tests for project
 """
 from nose import with_setup
-from nose.tools import assert_equals, assert_in
-from pylons import tmpl_context as c
+from nose.tools import assert_equals, assert_in, assert_not_in
+from pylons import tmpl_context as c, app_globals as g
 from ming.orm.ormsession import ThreadLocalORMSession
 from formencode import validators as fev
 
 from allura import model as M
 from allura.lib import helpers as h
+from allura.lib.utils import LRUCache
 from allura.tests import decorators as td
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura.lib.exceptions import ToolError, Invalid
@@ -158,6 +159,37 @@ def test_set_ordinal_to_admin_tool():
         assert_equals(sm[-1].tool_name, 'admin')
 
 
+@with_setup(setUp)
+def test_sitemap_cached():
+    project = M.Project.query.get(shortname='test')
+    with h.push_config(c, user=M.User.by_username('test-admin'), project=project, app=None), \
+            patch.object(g, 'nav_cache', LRUCache(10)):
+        labels = [e.label for e in project.sitemap()]
+        assert_in('Admin', labels)
+        with patch('allura.app.Application.main_menu') as main_menu, \
+                patch('allura.app.Application.is_visible_to') as is_visible_to:
+            assert_equals([e.label for e in project.sitemap()], labels)
+            assert not main_menu.called
+            assert not is_visible_to.called
+
+        # the entries can be changed by callers without affecting the cache
+        project.sitemap()[0].label = 'changed'
+        assert_equals([e.label for e in project.sitemap()], labels)
+
+        # users with other roles have their own list of visible tools
+        c.user = M.User.anonymous()
+        assert_not_in('Admin', [e.label for e in project.sitemap()])
+
+        # changes to tools make new entries
+        c.user = M.User.by_username('test-admin')
+        wiki = project.app_instance('wiki')
+        wiki.config.options.ordinal = 99
+        wiki.config.options.mount_label = 'Docs'
+        ThreadLocalORMSession.flush_all()
+        project = M.Project.query.get(shortname='test')
+        assert_equals([e.label for e in project.sitemap()][-2:], ['Docs', 'Admin'])
+
+
 @with_setup(setUp)
 def test_users_and_roles():
     p = M.Project.query.get(shortname='test')
@@ -202,3 +234,21 @@ def test_screenshot_unicode_serialization():
     assert screenshots[1]['url'] == 'http://localhost/p/test/screenshot/test_file.jpg'
     assert screenshots[1]['caption'] == 'test-screenshot'
     assert screenshots[1]['thumbnail_url'] == 'http://localhost/p/test/screenshot/test_file.jpg/thumb'
+
+
+def test_by_shortname():
+    nbhd = M.Neighborhood.query.get(name='Projects')
+    project = M.Project.query.get(shortname='test', neighborhood_id=nbhd._id)
+    assert M.Project.by_shortname('test', nbhd._id) is project
+    assert M.Project.by_shortname('test-proj-nose', nbhd._id) is None
+
+    assert M.Project.by_shortname('test/test-proj-nose', nbhd._id) is None
+    sp = project.new_subproject('test-proj-nose')
+    ThreadLocalORMSession.flush_all()
+    assert M.Project.by_shortname('test/test-proj-nose', nbhd._id) is sp
+
+    # renamed
+    sp.shortname = 'test-proj-nose'
+    ThreadLocalORMSession.flush_all()
+    assert M.Project.by_shortname('test-proj-nose', nbhd._id) is sp
+    assert M.Project.by_shortname('test/test-proj-nose', nbhd._id) is None
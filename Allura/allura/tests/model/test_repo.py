@@ -29,6 +29,7 @@
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura import model as M
 from allura.lib import helpers as h
+from allura.model.repo_refresh import LastCommitBuilder
 
 
 class TestGitLikeTree(object):
@@ -365,6 +366,28 @@ def test_loop(self):
         self.assertEqual(lcd.by_name['dir1'], commit2._id)
         self.assertEqual(lcd.by_name['file2'], commit3._id)
 
+    def test_builder(self):
+        commit1 = self._add_commit('Commit 1', ['file1', 'dir1/file2'])
+        commit2 = self._add_commit('Commit 2', ['file1', 'dir1/file2', 'dir1/file3'], ['dir1/file3'], [commit1])
+        commit3 = self._add_commit('Commit 3', ['file1', 'dir1/file2', 'dir1/file3'], ['file1'], [commit2])
+        self.repo.log = mock.Mock(side_effect=self._log)
+        builder = LastCommitBuilder(self.repo)
+        for commit in (commit1, commit2, commit3):
+            builder.refresh(commit)
+        session(M.repository.LastCommit).flush()
+        # previous LCDs all came from the builder, not the SCM
+        assert not self.repo.log.called
+        lcds = M.repository.LastCommit.query.find().all()
+        self.assertEqual(sorted((lcd.path, lcd.commit_id) for lcd in lcds), sorted([
+            ('', commit1._id), ('dir1', commit1._id),
+            ('', commit2._id), ('dir1', commit2._id),
+            ('', commit3._id),
+        ]))
+        lcd = M.repository.LastCommit.query.get(path='dir1', commit_id=commit2._id)
+        self.assertEqual(lcd.by_name, {'file2': commit1._id, 'file3': commit2._id})
+        lcd = M.repository.LastCommit.query.get(path='', commit_id=commit3._id)
+        self.assertEqual(lcd.by_name, {'file1': commit3._id, 'dir1': commit2._id})
+
 
 class TestModelCache(unittest.TestCase):
     def setUp(self):
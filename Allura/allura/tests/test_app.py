@@ -126,6 +126,19 @@ def test_sitemap():
     assert len(sm.children) == 3
 
 
+def test_sitemap_copy():
+    sm = app.SitemapEntry('test', 'test/', matching_urls=['x/'])[
+        app.SitemapEntry('a', 'a/')]
+    copy = sm.copy()
+    copy.label = 'changed'
+    copy.matching_urls.append('y/')
+    copy.children[0].url = 'b/'
+    copy.children.append(app.SitemapEntry('c', 'c/'))
+    assert_equal(sm.label, 'test')
+    assert_equal(sm.matching_urls, ['x/'])
+    assert_equal([(ch.label, ch.url) for ch in sm.children], [('a', 'a/')])
+
+
 @mock.patch('allura.app.Application.PostClass.query.get')
 def test_handle_artifact_unicode(qg):
     """
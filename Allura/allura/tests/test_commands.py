@@ -15,18 +15,25 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import os
+import time
+import signal
+import multiprocessing
+
 from nose.tools import assert_raises, assert_in
 from datadiff.tools import assert_equal
 
+from pylons import tmpl_context as c
 from ming.base import Object
 from ming.orm import ThreadLocalORMSession
 from mock import Mock, call, patch
+import bson
 import pymongo
 import pkg_resources
 
 from alluratest.controller import setup_basic_test, setup_global_objects
 from allura.command import base, script, set_neighborhood_features, \
-    create_neighborhood, show_models, taskd_cleanup
+    create_neighborhood, show_models, taskd_cleanup, taskd
 from allura import model as M
 from allura.lib.exceptions import InvalidNBFeatureValueError
 from allura.tests import decorators as td
@@ -300,6 +307,18 @@ def test_forsaken_tasks(self):
         assert task.result == 'Can\'t find taskd with given pid', task.result
         assert cmd.error_tasks == [task]
 
+        # forsaken before it was started (e.g. queued up in a batch)
+        task = Mock(state='busy', process='host pid 1111', result='', time_start=None)
+        self.cmd_class._busy_tasks = lambda x: [task]
+        self.cmd_class._taskd_pids = lambda x: ['2222']
+
+        cmd = self.cmd_class('taskd_command')
+        cmd.run([test_config, 'fake.log'])
+        assert task.state == 'ready', task.state
+        assert task.process is None, task.process
+        assert cmd.error_tasks == []
+        assert cmd.released_tasks == [task]
+
         # task actually running taskd pid == task.process pid == 2222
         task = Mock(state='busy', process='host pid 2222', result='')
         self.cmd_class._busy_tasks = lambda x: [task]
@@ -358,6 +377,57 @@ def test_suspicious_tasks(self):
         assert task1.state == 'complete'
 
 
+def test_task_limits():
+    limits = taskd.TaskLimits.parse('allura.tasks.repo_tasks.refresh=1, allura.tasks.index_tasks.commit=2')
+    refresh = Mock(task_name='allura.tasks.repo_tasks.refresh')
+    commit = Mock(task_name='allura.tasks.index_tasks.commit')
+    notify = Mock(task_name='allura.tasks.notification_tasks.notify')
+    assert_equal(limits.full(), [])
+
+    accepted, rejected = limits.acquire([refresh, refresh, notify])
+    assert_equal(accepted, [refresh, notify])
+    assert_equal(rejected, [refresh])
+    assert_equal(limits.full(), ['allura.tasks.repo_tasks.refresh'])
+
+    accepted, rejected = limits.acquire([commit, commit])
+    assert_equal(len(accepted), 2)
+    assert_equal(sorted(limits.full()), ['allura.tasks.index_tasks.commit', 'allura.tasks.repo_tasks.refresh'])
+
+    limits.release([refresh, notify, commit])
+    assert_equal(limits.full(), [])
+
+
+def test_task_limits_worker_killed():
+    limits = taskd.TaskLimits.parse('allura.tasks.repo_tasks.refresh=1', workers=2)
+    refresh = Mock(task_name='allura.tasks.repo_tasks.refresh')
+
+    def run_task():
+        limits.worker = 1
+        limits.acquire([refresh])
+        time.sleep(60)
+
+    p = multiprocessing.Process(target=run_task)
+    p.start()
+    for i in range(100):
+        if limits.full():
+            break
+        time.sleep(0.05)
+    assert_equal(limits.full(), ['allura.tasks.repo_tasks.refresh'])
+    os.kill(p.pid, signal.SIGKILL)
+    p.join()
+    assert_equal(limits.full(), ['allura.tasks.repo_tasks.refresh'])
+
+    cmd = taskd.TaskdCommand('taskd')
+    cmd.keep_running = True
+    cmd.limits = limits
+    start_worker = Mock()
+    cmd.restart_dead_workers({1: p}, start_worker)
+    start_worker.assert_called_once_with(1)
+    assert_equal(limits.full(), [])
+    accepted, rejected = limits.acquire([refresh])
+    assert_equal(accepted, [refresh])
+
+
 # taskd_cleanup unit tests
 def test_status_log_retries():
     cmd = taskd_cleanup.TaskdCleanupCommand('taskd_command')
@@ -376,6 +446,22 @@ def test_status_log_retries():
     assert cmd._taskd_status.mock_calls == expected_calls
 
 
+def test_check_task_in_batch():
+    cmd = taskd_cleanup.TaskdCleanupCommand('taskd_command')
+    cmd.options = Mock(num_retry=1)
+    current = Mock(_id='id1')
+    current.__str__ = lambda self: '<MonQTask id1>'
+    waiting = Mock(_id='id2')
+    other = Mock(_id='id3')
+    cmd._taskd_status = Mock(return_value='taskd pid 123 is currently handling task <MonQTask id1>, '
+                                          'claimed tasks: id1 id2')
+    assert_equal(cmd._check_task(123, current), 'OK')
+    assert_equal(cmd._check_task(123, waiting), 'OK')
+    with patch('allura.command.taskd_cleanup.time.sleep'):
+        assert_equal(cmd._check_task(123, other), 'FAIL')
+        assert_equal(cmd._check_task(456, waiting), 'FAIL')
+
+
 class TestBackgroundCommand(object):
 
     cmd = 'allura.command.show_models.ReindexCommand'
@@ -445,6 +531,56 @@ def test_project_regex(self, utils):
         utils.chunked_find.assert_called_once_with(
             M.Project, {'shortname': {'$regex': '^test'}})
 
+    def _make_arefs(self, n):
+        M.ArtifactReference.query.remove({})
+        for i in range(n):
+            M.ArtifactReference(_id='test/aref#%02d' % i, artifact_reference=dict(
+                cls=bson.Binary(''), project_id=None, app_config_id=None, artifact_id=None))
+        M.main_orm_session.flush()
+        M.main_orm_session.clear()
+        return ['test/aref#%02d' % i for i in range(n)]
+
+    @patch('allura.command.show_models.base.log')
+    @patch('allura.command.show_models.add_artifacts')
+    def test_parallel_reindex_shards(self, add_artifacts, log):
+        ref_ids = self._make_arefs(10)
+        cmd = show_models.ReindexCommand('reindex')
+        cmd.options, args = cmd.parser.parse_args([
+            '--workers', '3', '--batch-size', '2', '--solr', '--skip-solr-delete'])
+        cmd.checkpoints.remove({})
+        shards = cmd._make_shards('test', {})
+        assert_equal([s['shard'] for s in shards], [0, 1, 2])
+        assert_equal(shards[0]['lower'], None)
+        assert_equal(shards[-1]['upper'], None)
+        cmd.checkpoints.insert(shards)
+        for shard in shards:
+            cmd._reindex_shard(shard)
+        indexed = [ref_id for c in add_artifacts.call_args_list for ref_id in c[0][0]]
+        assert_equal(indexed, ref_ids)
+        assert all(len(c[0][0]) <= 2 for c in add_artifacts.call_args_list)
+        checkpoints = list(cmd.checkpoints.find({'run': 'test'}).sort('shard', 1))
+        assert all(cp['done'] for cp in checkpoints)
+        assert_equal(sum(cp['count'] for cp in checkpoints), 10)
+
+    @patch('allura.command.show_models.base.log')
+    @patch('allura.command.show_models.add_artifacts')
+    def test_parallel_reindex_resume(self, add_artifacts, log):
+        ref_ids = self._make_arefs(10)
+        cmd = show_models.ReindexCommand('reindex')
+        cmd.options, args = cmd.parser.parse_args(['--workers', '1', '--batch-size', '100', '--solr'])
+        shard = dict(_id='test.0', run='test', shard=0, project_ids=None, lower=None, upper=None,
+                     last_id=ref_ids[5], count=6, done=False)
+        cmd.checkpoints.remove({})
+        cmd.checkpoints.insert(shard)
+        context = []
+        add_artifacts.side_effect = lambda *a, **kw: context.append((c.project, c.app))
+        c.project = M.Project.query.get(shortname='test')
+        cmd._reindex_shard(shard)
+        add_artifacts.assert_called_once_with(ref_ids[6:], update_solr=True, update_refs=None)
+        # left to add_artifacts to use each artifact's project and app
+        assert_equal(context, [(None, None)])
+        assert_equal(cmd.checkpoints.find_one({'_id': 'test.0'})['count'], 10)
+
     @patch('allura.command.show_models.add_artifacts')
     def test_chunked_add_artifacts(self, add_artifacts):
         cmd = show_models.ReindexCommand('reindex')
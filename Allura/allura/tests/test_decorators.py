@@ -43,7 +43,7 @@ def test_post(self, c, MonQTask):
         def func(s, foo=None, **kw):
             pass
 
-        def mock_post(f, args, kw, delay=None):
+        def mock_post(f, args, kw, delay=None, unique_key=None):
             self.assertTrue(c.project.notifications_disabled)
             self.assertFalse('delay' in kw)
             self.assertEqual(delay, 1)
@@ -54,3 +54,28 @@ def mock_post(f, args, kw, delay=None):
         c.project.notifications_disabled = False
         MonQTask.post.side_effect = mock_post
         func.post('test', foo=2, delay=1)
+
+    @patch('allura.lib.decorators.c')
+    @patch('allura.model.MonQTask')
+    def test_post_coalesce(self, MonQTask, c):
+        @task(coalesce=True)
+        def func(s):
+            pass
+
+        func.post('test')
+        func.post('test')
+        func.post('other')
+        keys = [kw['unique_key'] for args, kw in MonQTask.post.call_args_list]
+        self.assertEqual(keys[0], keys[1])
+        self.assertNotEqual(keys[0], keys[2])
+        self.assertTrue(keys[0].startswith('allura.tests.test_decorators.func:'))
+
+        @task(coalesce=lambda s: s[0])
+        def func2(s):
+            pass
+
+        MonQTask.post.reset_mock()
+        func2.post('test')
+        func2.post('tx')
+        keys = [kw['unique_key'] for args, kw in MonQTask.post.call_args_list]
+        self.assertEqual(keys[0], keys[1])
@@ -20,6 +20,7 @@
 
 import re
 import os
+import threading
 import allura
 import unittest
 import hashlib
@@ -27,7 +28,7 @@
 from mock import patch, Mock
 
 from bson import ObjectId
-from nose.tools import with_setup, assert_equal, assert_in, assert_not_in
+from nose.tools import with_setup, assert_equal, assert_not_equal, assert_in, assert_not_in
 from pylons import tmpl_context as c, app_globals as g
 import tg
 
@@ -43,6 +44,8 @@
 from allura import model as M
 from allura.lib import helpers as h
 from allura.lib.app_globals import ForgeMarkdown
+from allura.lib.utils import LRUCache
+from allura.model.session import _update_markdown_hashes
 from allura.tests import decorators as td
 
 from forgewiki import model as WM
@@ -377,6 +380,132 @@ def test_wiki_artifact_links():
         assert '<a class="alink" href="/p/test/wiki/Home/">[test:wiki:Home]</a>' in text, text
 
 
+@td.with_wiki
+def test_markdown_links_resolved_together():
+    with h.push_context('test', 'wiki', neighborhood='Projects'):
+        WM.Page.upsert('Other').text = 'foo'
+        ThreadLocalORMSession.flush_all()
+        with patch.object(M.Shortlink, 'lookup') as lookup:
+            text = g.markdown.convert('[Home] and [Other] and [here](Home) and [test:wiki:Home] and [Missing]')
+        assert not lookup.called
+        assert '<a class="alink" href="/p/test/wiki/Home/">[Home]</a>' in text, text
+        assert '<a class="alink" href="/p/test/wiki/Other/">[Other]</a>' in text, text
+        assert '<a class="" href="/p/test/wiki/Home/">here</a>' in text, text
+        assert '<a class="alink" href="/p/test/wiki/Home/">[test:wiki:Home]</a>' in text, text
+        assert '<span>[Missing]</span>' in text, text
+
+
+def test_highlight():
+    assert_equal(g.highlight(''), '<em>Empty file</em>')
+    assert_equal(g.highlight('', lexer='diff'), '<em>File contents unchanged</em>')
+    html = g.highlight('import os\n', filename='foo.py')
+    assert_in('<span class="kn">import</span>', html)
+    assert_in('id="l1"', html)
+
+
+@patch.dict('allura.lib.app_globals.config', {'scm.view.highlight_chunk_lines': '2'})
+def test_highlight_lazy():
+    text = u'a = 1\nb = 2\nc = 3\nd = 4\ne = 5'
+    html = g.highlight(text, filename='foo.py', lazy=True)
+    assert_in('id="l2"', html)
+    assert_not_in('id="l3"', html)
+    assert_in('<div class="highlight-chunk" data-chunk="1">', html)
+    assert_in('<div class="highlight-chunk" data-chunk="2">', html)
+    assert_not_in('data-chunk="3"', html)
+
+    html = g.highlight(text, filename='foo.py', chunk=1)
+    assert_in('id="l3"', html)
+    assert_in('id="l4"', html)
+    assert_not_in('id="l2"', html)
+    assert_not_in('highlight-chunk', html)
+    assert_equal(g.highlight(text, filename='foo.py', chunk=3), '')
+
+    # small files are done all at once
+    html = g.highlight(u'a = 1\nb = 2', filename='foo.py', lazy=True)
+    assert_not_in('highlight-chunk', html)
+
+
+def test_highlight_cache():
+    cache = LRUCache(10)
+    with patch.object(g, 'highlight_cache', cache):
+        html = g.highlight('import os\n', filename='foo.py')
+        assert_equal(len(cache), 1)
+        key = cache._data.keys()[0]
+        assert_equal(cache.get(key), html.encode('utf-8'))
+        cache.set(key, 'cached')
+        assert_equal(g.highlight('import os\n', filename='bar.py'), 'cached')
+        # different lexer, different html
+        assert_not_equal(g.highlight('import os\n', filename='bar.rb'), 'cached')
+
+
+def test_markdown_pooled():
+    md = g.markdown
+    assert md is g.markdown
+    assert md is not g.forge_markdown(email=True)
+    assert md is not g.markdown_commit
+
+    # a conversion in progress gets its own engine for anything nested in it
+    nested = []
+    with md._using():
+        nested.append(g.markdown)
+    assert nested[0] is not md
+    assert g.markdown is md
+
+    # each thread has its own
+    other = []
+    globals_ = g._current_obj()
+    t = threading.Thread(target=lambda: other.append(globals_.forge_markdown()))
+    t.start()
+    t.join()
+    assert other[0] is not md
+
+    # state from the last conversion is reset
+    md.treeprocessors['links'].alinks.append('x')
+    assert_equal(g.markdown.treeprocessors['links'].alinks, [])
+
+
+@td.with_wiki
+def test_markdown_commit_pooled_app():
+    with h.push_context('test', 'wiki', neighborhood='Projects'):
+        md = g.markdown_commit
+        assert md.preprocessors['trac_refs'].patterns[2].app is c.app
+    with h.push_context('test', 'admin', neighborhood='Projects'):
+        assert g.markdown_commit is md
+        assert md.preprocessors['trac_refs'].patterns[2].app is c.app
+
+
+@td.with_wiki
+@td.with_tool('test', 'Tickets', 'tickets')
+def test_markdown_commit_links():
+    from forgetracker import model as TM
+    with h.push_context('test', 'tickets', neighborhood='Projects'):
+        TM.Ticket.new().summary = 'a ticket'
+        ThreadLocalORMSession.flush_all()
+        M.MonQTask.run_ready()
+        ThreadLocalORMSession.flush_all()
+    with h.push_context('test', 'wiki', neighborhood='Projects'):
+        text = g.markdown_commit.convert('fix [#1]')
+        assert '<a href="/p/test/tickets/1/"' in text, text
+        text = g.markdown_commit.convert('Update the [Home] page')
+        assert '<a href="/p/test/wiki/Home/" class=alink>[Home]</a>' in text, text
+
+
+@td.with_wiki
+def test_markdown_convert_many():
+    with h.push_context('test', 'wiki', neighborhood='Projects'):
+        sources = ['[Home]', '**bold** and [Missing]', '[here](Home) <script>alert(1)</script>', '']
+        with patch.object(M.Shortlink, 'from_links', wraps=M.Shortlink.from_links) as from_links, \
+                patch.object(M.Shortlink, 'lookup') as lookup:
+            html = g.markdown.convert_many(sources)
+        assert_equal(from_links.call_count, 1)
+        assert not lookup.called
+        assert_equal(html, [g.markdown.convert(s) for s in sources])
+        assert '<a class="alink" href="/p/test/wiki/Home/">[Home]</a>' in html[0], html[0]
+        assert '<script>' not in html[2], html[2]
+        assert_equal(g.markdown_commit.convert_many(['fix [Home]']),
+                     [g.markdown_commit.convert('fix [Home]')])
+
+
 def test_markdown_links():
     with patch.dict(tg.config, {'nofollow_exempt_domains': 'foobar.net'}):
         text = g.markdown.convert('Read [here](http://foobar.net/) about our project')
@@ -749,6 +878,58 @@ def test_all_expected_keys_exist_in_cache(self):
         keys = sorted(self.post.text_cache.keys())
         self.assertEqual(required_keys, keys)
 
+    @patch.dict('allura.lib.app_globals.config', markdown_cache_threshold='-0.01')
+    def test_hash_updated_on_save(self):
+        self.md.cached_convert(self.post, 'text')
+        _update_markdown_hashes(self.post)
+        self.assertEqual(self.post.text_cache.html, self.expected_html)
+        self.post.text = u'*changed*'
+        _update_markdown_hashes(self.post)
+        self.assertEqual(self.post.text_cache.md5, hashlib.md5(self.post.text).hexdigest())
+        self.assertIsNone(self.post.text_cache.html)
+        # the hash of a saved artifact's source is trusted
+        with patch.object(self.md, '_is_saved', return_value=True), \
+                patch('allura.lib.app_globals.hashlib') as hashlib_:
+            self.assertEqual(self.md.cached_convert(self.post, 'text'), u'<p><em>changed</em></p>')
+            self.assertEqual(self.md.cached_convert(self.post, 'text'), u'<p><em>changed</em></p>')
+        self.assertFalse(hashlib_.md5.called)
+
+    def test_shared_cache(self):
+        other = M.Post()
+        other.text = self.post.text
+        with patch.object(g, 'markdown_cache', LRUCache(10)):
+            self.md.cached_convert(self.post, 'text')
+            with patch.object(self.md, 'convert') as convert_func:
+                self.assertEqual(self.md.cached_convert(other, 'text'), self.expected_html)
+                self.assertFalse(convert_func.called)
+            # differently configured instances don't share renders
+            with patch.object(ForgeMarkdown, 'convert') as convert_func:
+                g.forge_markdown(wiki=True).cached_convert(other, 'text')
+                self.assertTrue(convert_func.called)
+
+    def test_shared_cache_macros(self):
+        calls = []
+
+        def cached_macro():
+            calls.append(1)
+            return 'cached'
+
+        def uncached_macro():
+            calls.append(1)
+            return 'uncached'
+
+        macros = {'cached_macro': (cached_macro, None, 30), 'uncached_macro': (uncached_macro, None, 0)}
+        with patch.object(g, 'markdown_cache', LRUCache(10)), patch.dict('allura.lib.macro._macros', macros):
+            md = g.forge_markdown()
+            self.post.text = u'[[cached_macro]]'
+            self.assertIn('cached', md.cached_convert(self.post, 'text'))
+            self.assertIn('cached', md.cached_convert(self.post, 'text'))
+            self.assertEqual(len(calls), 1)
+            self.post.text = u'[[cached_macro]] [[uncached_macro]]'
+            md.cached_convert(self.post, 'text')
+            md.cached_convert(self.post, 'text')
+            self.assertEqual(len(calls), 5)
+
 
 class TestEmojis(unittest.TestCase):
 
@@ -112,6 +112,14 @@ def test_find_project():
     assert_equals(proj.neighborhood.name, 'Projects')
     proj, rest = h.find_project('/p/testable/foo')
     assert proj is None
+    proj, rest = h.find_project('/p/test/sub1/foo')
+    assert_equals(proj.shortname, 'test/sub1')
+    assert_equals(rest, ['foo'])
+    proj.deleted = True
+    proj, rest = h.find_project('/p/test/sub1/foo')
+    assert_equals(proj.shortname, 'test')
+    assert_equals(rest, ['sub1', 'foo'])
+    M.Project.query.get(shortname='test/sub1').deleted = False
 
 
 def test_make_users():
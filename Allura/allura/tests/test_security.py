@@ -15,14 +15,18 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import random
+
+from bson import ObjectId
 from pylons import tmpl_context as c
 from nose.tools import assert_equal
+from mock import patch, PropertyMock, Mock, call
 
 from ming.odm import ThreadLocalODMSession
 from allura.tests import decorators as td
 from allura.tests import TestController
 
-from allura.lib.security import Credentials, all_allowed, has_access
+from allura.lib.security import Credentials, RoleGraphCache, all_allowed, has_access, has_access_many
 from allura import model as M
 from forgewiki import model as WM
 
@@ -190,3 +194,81 @@ def test_deny_access_for_single_user(self):
             M.ACE.deny(M.ProjectRole.by_user(user, upsert=True)._id, 'read', 'Spammer'))
         Credentials.get().clear()
         assert not has_access(wiki, 'read', user)()
+
+    @td.with_wiki
+    def test_has_access_many(self):
+        wiki = c.project.app_instance('wiki')
+        page = WM.Page.query.get(app_config_id=wiki.config._id)
+        private = WM.Page.upsert('private')
+        private.acl = [M.ACE.deny(M.ProjectRole.by_name('*anonymous')._id, 'read')]
+        ThreadLocalODMSession.flush_all()
+        objs = [page, private, wiki.config, c.project, c.project.neighborhood, None]
+        for user in (M.User.anonymous(), M.User.by_username('test-user'), M.User.by_username('test-admin')):
+            for perm in ('read', 'post', 'admin'):
+                expected = [bool(has_access(obj, perm, user)()) for obj in objs]
+                assert_equal(has_access_many(objs, perm, user), expected)
+        assert_equal(has_access_many([page, private], 'read', M.User.anonymous()), [True, False])
+        assert_equal(has_access_many([], 'read'), [])
+
+    @td.with_wiki
+    def test_role_graph_cache(self):
+        user = M.User.by_username('test-user')
+        pid = c.project.root_project._id
+        admin = M.ProjectRole.by_name('Admin')
+        uncached = Credentials()
+        expected = uncached.user_roles(user._id, pid).reaching_ids_set
+        with patch.object(RoleGraphCache, '_instance', RoleGraphCache(10)):
+            assert_equal(Credentials().user_roles(user._id, pid).reaching_ids_set, expected)
+            assert_equal(Credentials().user_roles(None, pid).reaching_ids_set,
+                         uncached.user_roles(None, pid).reaching_ids_set)
+
+            # a warm cache only queries the user's own role, not the whole project
+            project_role = Credentials().project_role
+            with patch.object(Credentials, 'project_role', new_callable=PropertyMock) as mock_project_role:
+                mock_project_role.return_value = Mock(wraps=project_role)
+                cred = Credentials()
+                assert_equal(cred.user_roles(user._id, pid).reaching_ids_set, expected)
+                assert_equal(mock_project_role.return_value.find.call_args_list,
+                             [call({'user_id': user._id, 'project_id': {'$in': [pid]}, 'name': None})])
+                mock_project_role.reset_mock()
+                assert_equal(Credentials().user_roles(None, pid).reaching_ids_set,
+                             uncached.user_roles(None, pid).reaching_ids_set)
+                assert not mock_project_role.called
+
+            # the cache only holds named roles
+            cached = RoleGraphCache.get().get_many([pid], None)[pid]
+            assert cached and all(r['user_id'] is None for r in cached), cached
+
+            # the user's own role is always read fresh
+            assert admin._id not in expected
+            _add_to_group(user, admin)
+            assert admin._id in Credentials().user_roles(user._id, pid).reaching_ids_set
+
+
+def test_compiled_acl():
+    def linear_check(acl, role_ids, permission):
+        chainable = []
+        for rid in role_ids:
+            for ace in acl:
+                if M.ACE.match(ace, rid, permission):
+                    if ace.access == M.ACE.ALLOW:
+                        return True, []
+                    break
+            else:
+                chainable.append(rid)
+        return False, chainable
+
+    rnd = random.Random(42)
+    role_ids = [ObjectId() for i in range(5)]
+    perms = ['read', 'write', 'admin']
+    for i in range(200):
+        acl = [getattr(M.ACE, rnd.choice(['allow', 'deny']))(
+            rnd.choice(role_ids + [M.EVERYONE]), rnd.choice(perms + [M.ALL_PERMISSIONS]))
+            for j in range(rnd.randint(0, 8))]
+        compiled = M.ACL.compile(acl)
+        for perm in perms:
+            roles = rnd.sample(role_ids, 3)
+            assert_equal(compiled.check(roles, perm), linear_check(acl, roles, perm))
+            for rid in role_ids:
+                assert_equal(compiled.denies([rid], perm), bool(M.ACL.contains(M.ACE.deny(rid, perm), acl)))
+    assert M.ACL.compile([M.ACE.allow(role_ids[0], 'read')]) is M.ACL.compile([M.ACE.allow(role_ids[0], 'read')])
@@ -18,9 +18,11 @@
 #       under the License.
 
 import operator
+import os
 import shutil
 import sys
 import unittest
+import zipfile
 from base64 import b64encode
 import logging
 
@@ -28,7 +30,7 @@
 import mock
 from pylons import tmpl_context as c, app_globals as g
 from datadiff.tools import assert_equal
-from nose.tools import assert_in, assert_less
+from nose.tools import assert_in, assert_less, assert_raises
 from ming.orm import FieldProperty, Mapper
 from ming.orm import ThreadLocalORMSession
 from testfixtures import LogCapture
@@ -138,9 +140,9 @@ def test_del_projects(self):
 
         with mock.patch('allura.tasks.index_tasks.g.solr') as solr:
             index_tasks.del_projects([p.index_id() for p in projects])
-            assert solr.delete.call_count, 1
+            assert solr.delete_by_ids.call_count, 1
             for project in projects:
-                assert project.index_id() in solr.delete.call_args[1]['q']
+                assert project.index_id() in solr.delete_by_ids.call_args[0][0]
 
     @td.with_wiki
     def test_add_artifacts(self):
@@ -197,8 +199,71 @@ def test_del_artifacts(self, solr):
         M.main_orm_session.clear()
         new_shortlinks = M.Shortlink.query.find().count()
         assert old_shortlinks == new_shortlinks, 'Shortlinks not deleted'
-        solr_query = 'id:({0})'.format(' || '.join(ref_ids))
-        solr.delete.assert_called_once_with(q=solr_query)
+        solr.delete_by_ids.assert_called_once_with(ref_ids)
+
+    @td.with_wiki
+    @mock.patch('allura.tasks.index_tasks.g.solr')
+    def test_flush_index_buffer(self, solr):
+        M.IndexBuffer.remove(M.IndexBuffer.pending())
+        artifacts = [_TestArtifact(_shorthand_id='tb_%s' % x)
+                     for x in range(3)]
+        M.artifact_orm_session.flush()
+        arefs = [M.ArtifactReference.from_artifact(a) for a in artifacts]
+        ref_ids = [r._id for r in arefs]
+        M.artifact_orm_session.flush()
+        M.IndexBuffer.add(ref_ids)
+        M.IndexBuffer.add(ref_ids[:2])
+        M.IndexBuffer.delete(ref_ids[2:])
+        index_tasks.flush_index_buffer()
+        # deduplicated, one request each, most recent operation wins
+        assert_equal(solr.add.call_count, 1)
+        assert_equal(sorted(d['id'] for d in solr.add.call_args[0][0]),
+                     sorted(ref_ids[:2]))
+        solr.delete_by_ids.assert_called_once_with(ref_ids[2:])
+        assert_equal(M.IndexBuffer.pending(), [])
+
+    @td.with_wiki
+    @mock.patch('allura.tasks.index_tasks.g.solr')
+    def test_flush_index_buffer_solr_error(self, solr):
+        M.IndexBuffer.remove(M.IndexBuffer.pending())
+        artifact = _TestArtifact(_shorthand_id='tb_err')
+        M.artifact_orm_session.flush()
+        aref = M.ArtifactReference.from_artifact(artifact)
+        M.artifact_orm_session.flush()
+        M.IndexBuffer.add([aref._id])
+        M.MonQTask.query.remove(dict(task_name='allura.tasks.index_tasks.flush_index_buffer'))
+        index_tasks.flush_index_buffer.post(delay=5)
+        with mock.patch.object(index_tasks, 'add_artifacts') as add_artifacts:
+            add_artifacts.side_effect = Exception('solr is down')
+            assert_raises(Exception, index_tasks.flush_index_buffer)
+        # nothing is lost, and a retry is scheduled separately from the pending flush
+        assert_equal([d['ref_ids'] for d in M.IndexBuffer.pending()], [[aref._id]])
+        tasks = M.MonQTask.query.find(dict(
+            task_name='allura.tasks.index_tasks.flush_index_buffer', state='ready')).sort('time_queue').all()
+        assert_equal([t.kwargs for t in tasks], [{}, {'retry': True}])
+        assert_less(tasks[0].time_queue, tasks[1].time_queue)
+
+    @td.with_wiki
+    @mock.patch('allura.tasks.index_tasks.g.solr')
+    def test_flush_index_buffer_references(self, solr):
+        from forgewiki import model as WM
+        M.IndexBuffer.remove(M.IndexBuffer.pending())
+        WM.Page.upsert('Other').text = 'other page'
+        page = WM.Page.upsert('Linking')
+        page.text = 'See [Other] and [test:wiki:Home]'
+        ThreadLocalORMSession.flush_all()
+        index_tasks.add_artifacts([page.index_id()])
+        ref = M.ArtifactReference.query.get(_id=page.index_id())
+        references = ref.references
+        assert_equal(len(references), 2)
+        M.IndexBuffer.add([page.index_id()])
+        # the flush doesn't run in any project's context
+        with h.push_config(c, project=None, app=None):
+            index_tasks.flush_index_buffer()
+        ThreadLocalORMSession.flush_all()
+        ThreadLocalORMSession.close_all()
+        ref = M.ArtifactReference.query.get(_id=page.index_id())
+        assert_equal(ref.references, references)
 
 
 class TestMailTasks(unittest.TestCase):
@@ -565,18 +630,20 @@ def test_bulk_export_filter_successful(self):
         self.assertEqual(
             BE.filter_successful(['foo', None, '0']), ['foo', '0'])
 
-    @mock.patch('allura.tasks.export_tasks.shutil')
-    @mock.patch('allura.tasks.export_tasks.zipdir')
     @mock.patch('forgewiki.wiki_main.ForgeWikiApp.bulk_export')
     @td.with_wiki
-    def test_bulk_export(self, wiki_bulk_export, zipdir, shutil):
+    def test_bulk_export(self, wiki_bulk_export):
+        wiki_bulk_export.side_effect = lambda f, *a: f.write('{"pages": []}')
         M.MonQTask.query.remove()
         export_tasks.bulk_export([u'wiki'])
         assert_equal(wiki_bulk_export.call_count, 1)
         temp = '/tmp/bulk_export/p/test/test'
         zipfn = '/tmp/bulk_export/p/test/test.zip'
-        zipdir.assert_called_with(temp, zipfn)
-        shutil.rmtree.assert_called_once_with(temp)
+        assert not os.path.exists(temp)
+        assert not os.path.exists(zipfn + '.partial')
+        with zipfile.ZipFile(zipfn) as zf:
+            assert_equal(zf.namelist(), ['test/wiki.json'])
+            assert_equal(zf.read('test/wiki.json'), '{"pages": []}')
         # check notification
         tasks = M.MonQTask.query.find(
             dict(task_name='allura.tasks.mail_tasks.sendsimplemail')).all()
@@ -590,6 +657,28 @@ def test_bulk_export(self, wiki_bulk_export, zipdir, shutil):
         assert_in('The following tools were exported:\n- wiki', text)
         assert_in('Sample instructions for test', text)
 
+    def test_bulk_export_threads(self):
+        def app(mount_point, fail=False):
+            def bulk_export(f, *a):
+                if fail:
+                    raise ValueError(mount_point)
+                f.write(mount_point)
+            return mock.Mock(config=mock.Mock(options=mock.Mock(mount_point=mount_point)),
+                             bulk_export=bulk_export,
+                             get_attachment_export_path=lambda path: os.path.join(path, mount_point))
+        apps = [app('one'), app('two', fail=True), app('three')]
+        export_path = '/tmp/bulk_export/p/test/tmp'
+        os.makedirs(export_path)
+        zipfn = '/tmp/bulk_export/p/test/test.zip'
+        BE = export_tasks.BulkExport()
+        with h.push_config(tg.config, bulk_export_threads='2'), \
+                zipfile.ZipFile(zipfn, 'w') as zf:
+            results = BE.export_all(export_path, apps, False, zf, 'test')
+        assert_equal(results, [apps[0], None, apps[2]])
+        assert_equal(os.listdir(export_path), [])
+        with zipfile.ZipFile(zipfn) as zf:
+            assert_equal(sorted(zf.namelist()), ['test/one.json', 'test/three.json'])
+
     def test_bulk_export_status(self):
         assert_equal(c.project.bulk_export_status(), None)
         export_tasks.bulk_export.post(['wiki'])
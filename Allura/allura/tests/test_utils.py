@@ -17,8 +17,11 @@
 #       specific language governing permissions and limitations
 #       under the License.
 
+import os
 import json
 import time
+import shutil
+import tempfile
 import unittest
 import datetime as dt
 from ming.odm import session
@@ -199,6 +202,67 @@ def test_everything(self):
         assert d == utils.CaseInsensitiveDict(Foo=1, bar=2)
 
 
+class TestLRUCache(unittest.TestCase):
+
+    def test_lru(self):
+        cache = utils.LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        assert 'a' in cache
+        assert 'b' not in cache
+        assert cache.get('b', 'missing') == 'missing'
+        assert len(cache) == 2
+        cache.delete('c')
+        cache.delete('c')
+        assert 'c' not in cache
+        cache.set('c', 3)
+        cache.clear()
+        assert len(cache) == 0
+
+    @patch('allura.lib.utils.time')
+    def test_ttl(self, time):
+        time.time.return_value = 100
+        cache = utils.LRUCache(10, ttl=5)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=20)
+        time.time.return_value = 110
+        assert cache.get('a') is None
+        assert cache.get('b') == 2
+
+
+class TestFileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp(prefix='filecache-test')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_get_set(self):
+        cache = utils.FileCache(self.path, 1000)
+        assert cache.get('a') is None
+        assert cache.get('a', 'missing') == 'missing'
+        cache.set('a', 'foo')
+        cache.set('b', 'bar')
+        assert cache.get('a') == 'foo'
+        # shared with other instances on the same directory
+        assert utils.FileCache(self.path, 1000).get('b') == 'bar'
+
+    def test_evict(self):
+        cache = utils.FileCache(self.path, 1000)
+        for key, mtime in [('a', 100), ('b', 200), ('c', 300)]:
+            cache.set(key, 'x' * 10)
+            os.utime(cache._filename(key), (mtime, mtime))
+        cache.get('a')  # now the most recently used
+        cache.max_size = 25
+        cache.evict()
+        assert cache.get('b') is None
+        assert cache.get('a') == 'x' * 10
+        assert cache.get('c') == 'x' * 10
+
+
 class TestLineAnchorCodeHtmlFormatter(unittest.TestCase):
 
     def test_render(self):
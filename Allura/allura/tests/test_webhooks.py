@@ -20,6 +20,7 @@
 import hashlib
 import datetime as dt
 
+from bson import ObjectId
 from mock import Mock, MagicMock, patch, call
 from nose.tools import (
     assert_raises,
@@ -41,6 +42,7 @@
     send_webhook,
     RepoPushWebhookSender,
     SendWebhookHelper,
+    http_session,
 )
 from allura.tests import decorators as td
 from alluratest.controller import (
@@ -447,18 +449,26 @@ def test_log_msg(self):
     @patch('allura.webhooks.SendWebhookHelper', autospec=True)
     def test_send_webhook_task(self, swh):
         send_webhook(self.wh._id, self.payload)
-        swh.assert_called_once_with(self.wh, self.payload)
+        swh.assert_called_once_with(self.wh, self.payload, 0)
+        send_webhook(self.wh._id, self.payload, 2)
+        swh.assert_called_with(self.wh, self.payload, 2)
 
-    @patch('allura.webhooks.requests', autospec=True)
+    @patch('allura.webhooks.SendWebhookHelper', autospec=True)
+    def test_send_webhook_task_removed(self, swh):
+        send_webhook(ObjectId(), self.payload)
+        assert_equal(swh.call_count, 0)
+
+    @patch('allura.webhooks.http_session', autospec=True)
     @patch('allura.webhooks.log', autospec=True)
-    def test_send(self, log, requests):
-        requests.post.return_value = Mock(status_code=200)
+    def test_send(self, log, http_session):
+        post = http_session.return_value.post
+        post.return_value = Mock(status_code=200)
         self.h.sign = Mock(return_value='sha1=abc')
         self.h.send()
         headers = {'content-type': 'application/json',
                    'User-Agent': 'Allura Webhook (https://allura.apache.org/)',
                    'X-Allura-Signature': 'sha1=abc'}
-        requests.post.assert_called_once_with(
+        post.assert_called_once_with(
             self.wh.hook_url,
             data=json.dumps(self.payload),
             headers=headers,
@@ -467,47 +477,55 @@ def test_send(self, log, requests):
             'Webhook successfully sent: %s %s %s' % (
                 self.wh.type, self.wh.hook_url, self.wh.app_config.url()))
 
-    @patch('allura.webhooks.time', autospec=True)
-    @patch('allura.webhooks.requests', autospec=True)
+    @patch('allura.webhooks.send_webhook', autospec=True)
+    @patch('allura.webhooks.http_session', autospec=True)
     @patch('allura.webhooks.log', autospec=True)
-    def test_send_error_response_status(self, log, requests, time):
-        requests.post.return_value = Mock(status_code=500)
+    def test_send_error_response_status(self, log, http_session, send_webhook):
+        post = http_session.return_value.post
+        post.return_value = Mock(status_code=500)
         self.h.send()
-        assert_equal(requests.post.call_count, 4)  # initial call + 3 retries
-        assert_equal(time.sleep.call_args_list,
-                     [call(60), call(120), call(240)])
-        assert_equal(log.info.call_args_list, [
-            call('Retrying webhook in: %s', [60, 120, 240]),
-            call('Retrying webhook in %s seconds', 60),
-            call('Retrying webhook in %s seconds', 120),
-            call('Retrying webhook in %s seconds', 240)])
-        assert_equal(log.error.call_count, 4)
+        assert_equal(post.call_count, 1)
+        send_webhook.post.assert_called_once_with(self.wh._id, self.payload, 1, delay=60)
+        log.info.assert_called_once_with('Retrying webhook in %s seconds', 60)
+        assert_equal(log.error.call_count, 1)
         log.error.assert_called_with(
             'Webhook send error: %s %s %s %s %s %s' % (
                 self.wh.type, self.wh.hook_url,
                 self.wh.app_config.url(),
-                requests.post.return_value.status_code,
-                requests.post.return_value.text,
-                requests.post.return_value.headers))
+                post.return_value.status_code,
+                post.return_value.text,
+                post.return_value.headers))
+
+        # later attempts back off further, then give up
+        SendWebhookHelper(self.wh, self.payload, 2).send()
+        send_webhook.post.assert_called_with(self.wh._id, self.payload, 3, delay=240)
+        send_webhook.post.reset_mock()
+        SendWebhookHelper(self.wh, self.payload, 3).send()
+        assert_equal(send_webhook.post.call_count, 0)
+        log.info.assert_called_with('Giving up on webhook after %s retries', 3)
 
-    @patch('allura.webhooks.time', autospec=True)
-    @patch('allura.webhooks.requests', autospec=True)
+    @patch('allura.webhooks.send_webhook', autospec=True)
+    @patch('allura.webhooks.http_session', autospec=True)
     @patch('allura.webhooks.log', autospec=True)
-    def test_send_error_no_retries(self, log, requests, time):
-        requests.post.return_value = Mock(status_code=500)
+    def test_send_error_no_retries(self, log, http_session, send_webhook):
+        post = http_session.return_value.post
+        post.return_value = Mock(status_code=500)
         with h.push_config(config, **{'webhook.retry': ''}):
             self.h.send()
-            assert_equal(requests.post.call_count, 1)
-            assert_equal(time.call_count, 0)
-            log.info.assert_called_once_with('Retrying webhook in: %s', [])
+            assert_equal(post.call_count, 1)
+            assert_equal(send_webhook.post.call_count, 0)
+            log.info.assert_called_once_with('Giving up on webhook after %s retries', 0)
             assert_equal(log.error.call_count, 1)
             log.error.assert_called_with(
                 'Webhook send error: %s %s %s %s %s %s' % (
                     self.wh.type, self.wh.hook_url,
                     self.wh.app_config.url(),
-                    requests.post.return_value.status_code,
-                    requests.post.return_value.text,
-                    requests.post.return_value.headers))
+                    post.return_value.status_code,
+                    post.return_value.text,
+                    post.return_value.headers))
+
+    def test_http_session(self):
+        assert_equal(http_session(), http_session())
 
 
 class TestRepoPushWebhookSender(TestWebhookBase):
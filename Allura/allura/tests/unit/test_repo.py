@@ -17,6 +17,7 @@
 
 import datetime
 import unittest
+import multiprocessing
 from mock import patch, Mock, MagicMock, call
 from nose.tools import assert_equal
 from datadiff import tools as dd
@@ -28,6 +29,9 @@
 from allura.model.repository import zipdir, prefix_paths_union
 from allura.model.repo_refresh import (
     _group_commits,
+    BulkWriter,
+    SharedTreeFilter,
+    refresh_commits_parallel,
 )
 
 
@@ -334,3 +338,136 @@ def test_multiple_branches(self):
                             'test2': ['1']})
         dd.assert_equal(t, {'v1.1': ['3'],
                             'v1.0': ['2', '1']})
+
+
+class TestBulkWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.coll = MagicMock()
+        self.coll.name = 'repo_ci'
+        self.bulk = self.coll.initialize_unordered_bulk_op.return_value
+        patcher = patch.object(type(M.repository.CommitDoc.m), 'collection', self.coll)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _doc(self, oid):
+        return M.repository.CommitDoc(dict(_id=oid, tree_id='t', parent_ids=[], child_ids=[]))
+
+    def test_flush(self):
+        w = BulkWriter(batch_size=10)
+        w.insert(self._doc('a'))
+        w.save(self._doc('b'))
+        w.update(M.repository.CommitDoc, {'_id': {'$in': ['a', 'b']}}, {'$addToSet': {'child_ids': 'c'}}, multi=True)
+        assert not self.coll.initialize_unordered_bulk_op.called
+        w.flush()
+        assert_equal(self.bulk.insert.call_args[0][0]['_id'], 'a')
+        self.bulk.find.assert_any_call({'_id': 'b'})
+        assert_equal(self.bulk.find.return_value.upsert.return_value.replace_one.call_count, 1)
+        self.bulk.find.return_value.update.assert_called_once_with({'$addToSet': {'child_ids': 'c'}})
+        self.bulk.execute.assert_called_once_with()
+        w.flush()
+        assert_equal(self.bulk.execute.call_count, 1)
+
+    def test_batch_size(self):
+        w = BulkWriter(batch_size=2)
+        for oid in 'abcde':
+            w.insert(self._doc(oid))
+        assert_equal(self.bulk.execute.call_count, 2)
+        w.flush()
+        assert_equal(self.bulk.execute.call_count, 3)
+        assert_equal(self.bulk.insert.call_count, 5)
+
+    def test_commits_last(self):
+        trees = MagicMock()
+        trees.name = 'repo_tree'
+        collections = {M.repository.CommitDoc: self.coll, M.repository.TreeDoc: trees}
+        order = []
+        self.bulk.execute.side_effect = lambda: order.append('commits')
+        trees.initialize_unordered_bulk_op.return_value.execute.side_effect = lambda: order.append('trees')
+        tree = M.repository.TreeDoc(dict(_id='t', tree_ids=[], blob_ids=[], other_ids=[]))
+        with patch.object(type(M.repository.TreeDoc.m), 'collection', property(lambda m: collections[m.cls])):
+            w = BulkWriter(batch_size=3)
+            w.insert(self._doc('a'))
+            w.save(tree)
+            assert_equal(order, [])
+            w.insert(self._doc('b'))
+            # the batch is full: everything is written, commits after trees
+            assert_equal(order, ['trees', 'commits'])
+            w.save(tree)
+            w.insert(self._doc('c'))
+            w.flush()
+            assert_equal(order, ['trees', 'commits', 'trees', 'commits'])
+
+    def test_on_flush(self):
+        on_flush = Mock(side_effect=lambda: self.bulk.execute.assert_called_once_with())
+        w = BulkWriter(batch_size=10, on_flush=on_flush)
+        w.insert(self._doc('a'))
+        assert not on_flush.called
+        w.flush()
+        on_flush.assert_called_once_with()
+
+
+class TestSharedTreeFilter(unittest.TestCase):
+
+    def test_add(self):
+        seen = SharedTreeFilter(8)
+        assert 'ab' * 20 not in seen
+        seen.add('ab' * 20)
+        seen.add('ab' * 20)
+        seen.add('cd' * 20)
+        assert 'ab' * 20 in seen
+        assert 'cd' * 20 in seen
+        assert 'ef' * 20 not in seen
+        seen.publish()
+        assert 'ab' * 20 in seen
+        assert 'cd' * 20 in seen
+        assert 'ef' * 20 not in seen
+
+    def test_full(self):
+        seen = SharedTreeFilter(2)
+        for tree_id in ('01' * 20, '02' * 20, '03' * 20):
+            seen.add(tree_id)
+        seen.publish()
+        assert '01' * 20 in seen
+        assert '02' * 20 in seen
+        assert '03' * 20 not in seen
+
+    def test_shared(self):
+        seen = SharedTreeFilter(8)
+        p = multiprocessing.Process(target=_add_trees, args=(seen, ['ab' * 20], True))
+        p.start()
+        p.join()
+        assert 'ab' * 20 in seen
+
+    def test_not_published(self):
+        # a process that dies before its trees are written doesn't share them
+        seen = SharedTreeFilter(8)
+        p = multiprocessing.Process(target=_add_trees, args=(seen, ['ab' * 20], False))
+        p.start()
+        p.join()
+        assert 'ab' * 20 not in seen
+
+
+def _add_trees(seen, tree_ids, publish):
+    for tree_id in tree_ids:
+        seen.add(tree_id)
+    if publish:
+        seen.publish()
+
+
+class TestRefreshCommitsParallel(unittest.TestCase):
+
+    @patch('allura.model.repo_refresh.multiprocessing.Process')
+    def test_chunks(self, Process):
+        Process.return_value.exitcode = 0
+        repo = Mock()
+        refresh_commits_parallel(repo, ['1', '2', '3', '4', '5'], True, 2)
+        chunks = [kw['args'][1] for args, kw in Process.call_args_list]
+        assert_equal(chunks, [['1', '2', '3'], ['4', '5']])
+        assert_equal(Process.return_value.join.call_count, 2)
+
+    @patch('allura.model.repo_refresh.multiprocessing.Process')
+    def test_failure(self, Process):
+        Process.return_value.exitcode = 1
+        with self.assertRaises(RuntimeError):
+            refresh_commits_parallel(Mock(), ['1', '2'], True, 2)
@@ -17,6 +17,7 @@
 
 import pymongo
 import mock
+from tg import config
 
 from unittest import TestCase
 
@@ -149,6 +150,19 @@ def test_flush_skips_task_if_all_objects_filtered_out(self, index_tasks):
         self.extension.after_flush()
         assert index_tasks.add_artifacts.post.call_count == 0
 
+    @mock.patch.dict(config, {'solr.index_buffer': 'true'})
+    @mock.patch.object(allura.model.index, 'IndexBuffer')
+    @mock.patch('allura.model.session.index_tasks')
+    def test_update_index_buffered(self, index_tasks, IndexBuffer):
+        deleted = [self._mock_indexable(_id=i) for i in (1, 2)]
+        arefs = [mock.Mock(_id=i) for i in (3, 4)]
+        self.extension.update_index(deleted, arefs)
+        IndexBuffer.delete.assert_called_once_with(map(id, deleted))
+        IndexBuffer.add.assert_called_once_with([3, 4])
+        index_tasks.flush_index_buffer.post.assert_called_once_with(delay=5)
+        assert index_tasks.add_artifacts.post.call_count == 0
+        assert index_tasks.del_artifacts.post.call_count == 0
+
 
 class TestBatchIndexer(TestCase):
 
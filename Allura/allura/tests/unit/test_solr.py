@@ -70,6 +70,14 @@ def test_delete(self, pysolr):
         calls = [mock.call('bar', commit=False, somekw='value')] * 2
         pysolr.Solr().delete.assert_has_calls(calls)
 
+    @mock.patch('allura.lib.solr.pysolr')
+    def test_delete_by_ids(self, pysolr):
+        servers = ['server1', 'server2']
+        solr = Solr(servers, commit=False, commitWithin='10000')
+        solr.delete_by_ids(['foo', 'bar<&>'])
+        calls = [mock.call('<delete><id>foo</id><id>bar&lt;&amp;&gt;</id></delete>', commit=False)] * 2
+        pysolr.Solr()._update.assert_has_calls(calls)
+
     @mock.patch('allura.lib.solr.pysolr')
     def test_commit(self, pysolr):
         servers = ['server1', 'server2']
@@ -19,9 +19,9 @@
 import json
 import hmac
 import hashlib
-import time
 import socket
 import ssl
+import threading
 
 import requests
 from bson import ObjectId
@@ -313,10 +313,23 @@ def _delete(self, webhook):
         return {'result': 'ok'}
 
 
+_http = threading.local()
+
+
+def http_session():
+    """Return this thread's :class:`requests.Session`, so connections to
+    webhook endpoints are kept alive and reused between deliveries"""
+    session = getattr(_http, 'session', None)
+    if session is None:
+        session = _http.session = requests.Session()
+    return session
+
+
 class SendWebhookHelper(object):
-    def __init__(self, webhook, payload):
+    def __init__(self, webhook, payload, attempt=0):
         self.webhook = webhook
         self.payload = payload
+        self.attempt = attempt
 
     @property
     def timeout(self):
@@ -356,17 +369,22 @@ def send(self):
                    'X-Allura-Signature': signature}
         ok = self._send(self.webhook.hook_url, json_payload, headers)
         if not ok:
-            log.info('Retrying webhook in: %s', self.retries)
-            for t in self.retries:
-                log.info('Retrying webhook in %s seconds', t)
-                time.sleep(t)
-                ok = self._send(self.webhook.hook_url, json_payload, headers)
-                if ok:
-                    return
+            self.retry()
+
+    def retry(self):
+        """Post a new delayed task for the next attempt, rather than tying up
+        the worker while waiting for the endpoint to come back"""
+        retries = self.retries
+        if self.attempt >= len(retries):
+            log.info('Giving up on webhook after %s retries', self.attempt)
+            return
+        t = retries[self.attempt]
+        log.info('Retrying webhook in %s seconds', t)
+        send_webhook.post(self.webhook._id, self.payload, self.attempt + 1, delay=t)
 
     def _send(self, url, data, headers):
         try:
-            r = requests.post(
+            r = http_session().post(
                 url,
                 data=data,
                 headers=headers,
@@ -385,9 +403,12 @@ def _send(self, url, data, headers):
 
 
 @task()
-def send_webhook(webhook_id, payload):
+def send_webhook(webhook_id, payload, attempt=0):
     webhook = M.Webhook.query.get(_id=webhook_id)
-    SendWebhookHelper(webhook, payload).send()
+    if webhook is None:
+        log.info('Webhook %s was removed, not sending', webhook_id)
+        return
+    SendWebhookHelper(webhook, payload, attempt).send()
 
 
 class WebhookSender(object):